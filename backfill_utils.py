@@ -0,0 +1,251 @@
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby
+
+from pynamodb.exceptions import UpdateError
+
+from dynamodb_utils import AppUser, BackfillRange, MetricsPartial
+from metrics_utils import OrderColumns, iter_order_totals, merge_order_totals
+from rolling_utils import epoch_day
+from sync_utils import SYNC_METRICS_CHUNK_SIZE, SYNC_PAGE_SIZE, watermark_string
+
+__all__ = ['Backfill', 'Recompute', 'scan_stale_backfills']
+
+BACKFILL_RANGE_SIZE = int(os.environ.get('BACKFILL_RANGE_SIZE', 5000))
+BACKFILL_MAX_WORKERS = int(os.environ.get('BACKFILL_MAX_WORKERS', 4))
+BACKFILL_LEASE_SECONDS = int(os.environ.get('BACKFILL_LEASE_SECONDS', 120))
+BACKFILL_PLAN_POLL_SECONDS = int(os.environ.get('BACKFILL_PLAN_POLL_SECONDS', 5))
+# Staged partials, and the ranges of nightly recomputes, are removed by the table TTL on expires_at.
+BACKFILL_RETENTION_SECONDS = int(os.environ.get('BACKFILL_RETENTION_SECONDS', 7 * 86400))
+
+
+def scan_stale_backfills(stale_seconds):
+    """
+    Stores with webhooks registered whose backfill hasn't completed and had no
+    slice run in the last stale_seconds. Stores that were synced before backfills
+    existed and never started one are left alone.
+    """
+    before = int(time.time()) - stale_seconds
+    condition = ((AppUser.bc_webhooks_registered == True) &
+                 (AppUser.bc_deleted == False) &
+                 AppUser.hs_access_token.exists() &
+                 AppUser.hm_backfill_completed_at.does_not_exist() &
+                 (AppUser.hm_backfill_started_at.exists() | AppUser.hm_last_sync_timestamp.does_not_exist()) &
+                 (AppUser.hm_backfill_slice_at.does_not_exist() | (AppUser.hm_backfill_slice_at < before)))
+    return [user for user in AppUser.scan(condition, attributes_to_get=['bc_store_hash', 'hm_backfill_started_at'])
+            if not user.hm_backfill_started_at or user.hm_backfill_started_at < before]
+
+
+class Backfill(object):
+    """
+    Pushes a store's whole order history to HubSpot in resumable pieces: leased,
+    checkpointed order id ranges whose pages are staged as per-customer MetricsPartial
+    totals, then merged and pushed through IncrementalSync.sync_metrics.
+    """
+    kind = 'backfill'
+
+    def __init__(self, user, client, sync, range_size=BACKFILL_RANGE_SIZE, max_workers=BACKFILL_MAX_WORKERS,
+                 lease_seconds=BACKFILL_LEASE_SECONDS, page_size=SYNC_PAGE_SIZE):
+        self.user = user
+        self.client = client
+        self.sync = sync
+        self.range_size = range_size
+        self.max_workers = max_workers
+        self.lease_seconds = lease_seconds
+        self.page_size = page_size
+        self.owner = uuid.uuid4().hex
+
+    def plan(self):
+        """
+        Creates the range checkpoints once per run. Only the invocation that claims the
+        run's started_at plans; a dead planner is taken over after lease_seconds.
+        """
+        now = int(time.time())
+        started_at = self._state('started_at')
+        if self._value('planned_at') or self._value('completed_at'):
+            return False
+        if self._value('started_at') and self._value('started_at') >= now - self.lease_seconds:
+            return False
+        try:
+            self.user.update(actions=[started_at.set(now)],
+                             condition=(self._state('planned_at').does_not_exist() &
+                                        (started_at.does_not_exist() | (started_at < now - self.lease_seconds))))
+        except UpdateError:
+            self.user.refresh(consistent_read=True)
+            return False
+
+        newest = self.client.Orders.all(sort='id:desc', limit=1)
+        max_id = newest[0]['id'] if newest else 0
+        with BackfillRange.batch_write() as batch:
+            for range_start in range(1, max_id + 1, self.range_size):
+                batch.save(BackfillRange(self._ranges_key(), range_start,
+                                         range_end=min(range_start + self.range_size - 1, max_id),
+                                         next_id=range_start, expires_at=self._expires_at()))
+        try:
+            self.user.update(actions=[self._state('planned_at').set(int(time.time()))],
+                             condition=started_at == now)
+        except UpdateError:
+            self.user.refresh(consistent_read=True)
+            return False
+        return True
+
+    def run(self, deadline):
+        """
+        Works on pending ranges, then merges the staged partials, until deadline. Returns
+        True once the run is complete.
+        """
+        self.plan()
+        if self._value('completed_at'):
+            return True
+        while not self._value('planned_at'):
+            if time.time() + BACKFILL_PLAN_POLL_SECONDS >= deadline:
+                return False
+            time.sleep(BACKFILL_PLAN_POLL_SECONDS)
+            self.user.refresh(consistent_read=True)
+            self.plan()
+        pending = [r for r in BackfillRange.query(self._ranges_key()) if not r.done]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            list(executor.map(lambda backfill_range: self._work(backfill_range, deadline), pending))
+
+        if any(not r.done for r in BackfillRange.query(self._ranges_key(), consistent_read=True)):
+            return False
+        if not self._merge(deadline):
+            return False
+        self._complete()
+        return True
+
+    def progress(self):
+        ranges = list(BackfillRange.query(self._ranges_key()))
+        return dict(ranges=len(ranges),
+                    done=sum(1 for r in ranges if r.done),
+                    orders=sum(r.orders for r in ranges))
+
+    def _state(self, name):
+        return getattr(AppUser, 'hm_{}_{}'.format(self.kind, name))
+
+    def _value(self, name):
+        return getattr(self.user, 'hm_{}_{}'.format(self.kind, name))
+
+    def _ranges_key(self):
+        return self.user.bc_store_hash
+
+    def _run_key(self):
+        return '{}#{}#{}'.format(self.user.bc_store_hash, self.kind, self._value('started_at'))
+
+    def _expires_at(self):
+        return None
+
+    def _work(self, backfill_range, deadline):
+        if not self._lease(backfill_range):
+            return
+        try:
+            while not backfill_range.done and time.time() < deadline:
+                orders = self.client.Orders.all(min_id=backfill_range.next_id, max_id=backfill_range.range_end,
+                                                sort='id:asc', limit=self.page_size)
+                orders = orders or []
+                self._stage(orders, backfill_range.next_id)
+                next_id = orders[-1]['id'] + 1 if orders else backfill_range.range_end + 1
+                backfill_range.update(actions=[BackfillRange.next_id.set(next_id),
+                                               BackfillRange.orders.add(len(orders)),
+                                               BackfillRange.done.set(len(orders) < self.page_size or
+                                                                      next_id > backfill_range.range_end),
+                                               BackfillRange.lease_until.set(int(time.time()) + self.lease_seconds)],
+                                      condition=BackfillRange.lease_owner == self.owner)
+        finally:
+            try:
+                backfill_range.update(actions=[BackfillRange.lease_until.set(0)],
+                                      condition=BackfillRange.lease_owner == self.owner)
+            except UpdateError:
+                pass
+
+    def _stage(self, orders, page_start):
+        # Keyed by the page's first order id, so a redelivered page overwrites its own partials.
+        run = self._run_key()
+        expires_at = int(time.time()) + BACKFILL_RETENTION_SECONDS
+        with MetricsPartial.batch_write() as batch:
+            for email, totals in iter_order_totals(OrderColumns().extend_orders(orders)):
+                batch.save(MetricsPartial(run, '{}#{}'.format(email, page_start), email=email,
+                                          expires_at=expires_at, **totals))
+
+    def _merge(self, deadline):
+        """
+        Pushes every customer's merged partials in email order, recording the last
+        email pushed so a merge cut short by deadline resumes after it.
+        """
+        merged_email = self._value('merged_email')
+        # '$' sorts right after '#', so this skips every partial of merged_email.
+        condition = MetricsPartial.chunk > merged_email + '$' if merged_email else None
+        today = epoch_day()
+        rows = []
+        partials = MetricsPartial.query(self._run_key(), range_key_condition=condition, consistent_read=True)
+        for email, totals in groupby(partials, key=lambda partial: partial.email):
+            rows.append((email, merge_order_totals(totals, today)))
+            if len(rows) >= SYNC_METRICS_CHUNK_SIZE:
+                self._push(rows)
+                rows = []
+                if time.time() >= deadline:
+                    return False
+        if rows:
+            self._push(rows)
+        return True
+
+    def _push(self, rows):
+        self.sync.sync_metrics(rows)
+        self.user.update(actions=[self._state('merged_email').set(rows[-1][0])])
+
+    def _lease(self, backfill_range):
+        now = int(time.time())
+        try:
+            backfill_range.update(actions=[BackfillRange.lease_owner.set(self.owner),
+                                           BackfillRange.lease_until.set(now + self.lease_seconds)],
+                                  condition=((BackfillRange.done == False) &  # noqa: E712
+                                             (BackfillRange.lease_until < now)))
+            return True
+        except UpdateError:
+            return False
+
+    def _complete(self):
+        started = watermark_string(self.user.hm_backfill_started_at)
+        actions = [AppUser.hm_backfill_completed_at.set(int(time.time()))]
+        if not self.user.hm_last_sync_timestamp:
+            actions.append(AppUser.hm_last_sync_timestamp.set(started))
+        if not self.user.hm_customer_sync_timestamp:
+            actions.append(AppUser.hm_customer_sync_timestamp.set(started))
+        self.user.update(actions=actions)
+
+
+class Recompute(Backfill):
+    """
+    The nightly recompute of every customer's metrics: a Backfill under its own run
+    state and ranges.
+    """
+    kind = 'recompute'
+
+    def start(self):
+        """
+        Makes the next plan() begin a new run if the last one is complete.
+        """
+        completed_at = self.user.hm_recompute_completed_at
+        if not completed_at:
+            return False
+        try:
+            self.user.update(actions=[AppUser.hm_recompute_started_at.remove(),
+                                      AppUser.hm_recompute_planned_at.remove(),
+                                      AppUser.hm_recompute_completed_at.remove(),
+                                      AppUser.hm_recompute_merged_email.remove()],
+                             condition=AppUser.hm_recompute_completed_at == completed_at)
+        except UpdateError:
+            self.user.refresh(consistent_read=True)
+            return False
+        return True
+
+    def _ranges_key(self):
+        return self._run_key()
+
+    def _expires_at(self):
+        return int(time.time()) + BACKFILL_RETENTION_SECONDS
+
+    def _complete(self):
+        self.user.update(actions=[AppUser.hm_recompute_completed_at.set(int(time.time()))])
@@ -0,0 +1,81 @@
+"""
+Compares the AppUser lookup paths against a live hubmetrix-user table.
+
+    python benchmarks/bench_app_user_lookup.py <bc_store_hash> [iterations]
+
+Latency is measured through the PynamoDB helpers the app uses. Consumed read
+capacity is taken from the equivalent raw DynamoDB requests, since PynamoDB's
+model API does not surface ReturnConsumedCapacity.
+"""
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import botocore.session
+
+from dynamodb_utils import AppUser, get_query_first_result
+
+INDEX_ATTRIBUTES = ['cb_subscription_id', 'hm_last_sync_timestamp']
+
+
+def time_calls(func, iterations):
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def consumed_rcu(client, operation, **kwargs):
+    kwargs['ReturnConsumedCapacity'] = 'TOTAL'
+    response = getattr(client, operation)(TableName=AppUser.Meta.table_name, **kwargs)
+    return response['ConsumedCapacity']['CapacityUnits']
+
+
+def main(bc_store_hash, iterations=50):
+    client = botocore.session.get_session().create_client('dynamodb', region_name=AppUser.Meta.region)
+    user = AppUser.find_by_store_hash(bc_store_hash, consistent_read=True)
+    if user is None:
+        raise SystemExit('No AppUser for store hash {}'.format(bc_store_hash))
+    key = {'bc_store_hash': {'S': bc_store_hash}, 'bc_id': {'N': str(user.bc_id)}}
+    key_condition = dict(KeyConditionExpression='bc_store_hash = :h',
+                         ExpressionAttributeValues={':h': {'S': bc_store_hash}})
+    projection = ', '.join(INDEX_ATTRIBUTES)
+
+    paths = [
+        ('query, first result (baseline)',
+         lambda: list(AppUser.query(bc_store_hash))[0],
+         lambda: consumed_rcu(client, 'query', **key_condition)),
+        ('query, limit=1',
+         lambda: get_query_first_result(AppUser, bc_store_hash),
+         lambda: consumed_rcu(client, 'query', Limit=1, **key_condition)),
+        ('query, limit=1, projected',
+         lambda: AppUser.find_by_store_hash(bc_store_hash, attributes=INDEX_ATTRIBUTES),
+         lambda: consumed_rcu(client, 'query', Limit=1, ProjectionExpression=projection, **key_condition)),
+        ('get_item, eventually consistent',
+         lambda: AppUser.find(bc_store_hash, user.bc_id),
+         lambda: consumed_rcu(client, 'get_item', Key=key)),
+        ('get_item, strongly consistent',
+         lambda: AppUser.find(bc_store_hash, user.bc_id, consistent_read=True),
+         lambda: consumed_rcu(client, 'get_item', Key=key, ConsistentRead=True)),
+        ('get_item, projected',
+         lambda: AppUser.find(bc_store_hash, user.bc_id, attributes=INDEX_ATTRIBUTES),
+         lambda: consumed_rcu(client, 'get_item', Key=key, ProjectionExpression=projection)),
+    ]
+
+    print('{:<34} {:>8} {:>8} {:>8} {:>6}'.format('path', 'p50 ms', 'p95 ms', 'max ms', 'RCU'))
+    for name, lookup, capacity in paths:
+        timings = sorted(time_calls(lookup, iterations))
+        p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+        print('{:<34} {:>8.1f} {:>8.1f} {:>8.1f} {:>6}'.format(name, statistics.median(timings), p95,
+                                                               timings[-1], capacity()))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        raise SystemExit(__doc__)
+    main(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 50)
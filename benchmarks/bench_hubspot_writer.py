@@ -0,0 +1,83 @@
+"""
+Compares pushing contact properties one createOrUpdate request at a time with the
+buffered ContactWriter, against the local fake HubSpot server.
+
+    python benchmarks/bench_hubspot_writer.py [--updates N] [--contacts N] [--latency S]
+
+Updates are spread over fewer contacts than updates, the way several orders of one
+customer produce several pushes. The fake server enforces HubSpot's per-portal rate
+limit; both paths are paced by the shared outbound scheduler, which starts from
+--rate-limit and follows the server's rate-limit headers.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from fake_hubspot import FakeHubSpot
+
+
+def synthetic_updates(n_updates, n_contacts, seed=7):
+    rng = random.Random(seed)
+    for _ in range(n_updates):
+        yield ('customer{}@example.com'.format(rng.randrange(n_contacts)),
+               {'hubmetrix_order_count': rng.randrange(1, 50),
+                'hubmetrix_total_revenue': round(rng.uniform(5, 5000), 2)})
+
+
+def per_contact(hubspot_utils, updates):
+    start = time.perf_counter()
+    for email, properties in updates:
+        hubspot_utils.update_contact_properties('per-contact-token', email, properties)
+    return time.perf_counter() - start
+
+
+def batched(hubspot_utils, updates):
+    writer = hubspot_utils.ContactWriter()
+    push = writer.for_portal('portal', lambda: 'batched-token')
+    start = time.perf_counter()
+    for email, properties in updates:
+        push(email, properties)
+    push.flush()
+    return time.perf_counter() - start, writer.stats()
+
+
+def main(n_updates, n_contacts, latency, rate_limit, rate_window):
+    updates = list(synthetic_updates(n_updates, n_contacts))
+    with FakeHubSpot(latency=latency, rate_limit=rate_limit, rate_window=rate_window) as hubspot:
+        os.environ['HS_API_BASE'] = hubspot.url
+        import hubspot_utils
+        from ratelimit_utils import outbound_scheduler
+        outbound_scheduler.defaults['hubspot'] = (rate_limit, rate_window)
+
+        seconds = per_contact(hubspot_utils, updates)
+        print('{} updates to {} contacts, {:.0f} ms latency, {} requests per {:.0f} s'.format(
+            n_updates, n_contacts, latency * 1000, rate_limit, rate_window))
+        print('\n{:<14} {:>9} {:>10} {:>14}'.format('path', 'requests', 'seconds', 'updates/s'))
+        print('{:<14} {:>9} {:>10.2f} {:>14.0f}'.format('per contact', hubspot.requests['create_or_update'],
+                                                        seconds, n_updates / seconds))
+        expected = dict(hubspot.contacts)
+        hubspot.contacts.clear()
+
+        seconds, stats = batched(hubspot_utils, updates)
+        print('{:<14} {:>9} {:>10.2f} {:>14.0f}'.format('batched', hubspot.requests['batch'], seconds,
+                                                        n_updates / seconds))
+        print('\nwriter stats: {}'.format(stats))
+        print('scheduler stats: {}'.format(outbound_scheduler.stats()))
+        print('final contact state identical: {}'.format(hubspot.contacts == expected))
+        print('429 responses: {}'.format(hubspot.requests['rate_limited']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--updates', type=int, default=2000)
+    parser.add_argument('--contacts', type=int, default=800)
+    parser.add_argument('--latency', type=float, default=0.01)
+    parser.add_argument('--rate-limit', type=int, default=100)
+    parser.add_argument('--rate-window', type=float, default=1.0)
+    args = parser.parse_args()
+    main(args.updates, args.contacts, args.latency, args.rate_limit, args.rate_window)
@@ -0,0 +1,125 @@
+"""
+Compares the vectorized per-customer metrics engine with the pure-Python
+reference (grouping order dicts and folding each customer's orders).
+
+    python benchmarks/bench_metrics.py [orders] [customers]
+
+Defaults to 1,000,000 synthetic orders across 100,000 customers. End to end,
+both paths start from the same BigCommerce-shaped order dicts, so per-order
+field parsing is included in each. The aggregation step is also compared on
+its own: a Python loop over already parsed orders against the grouped NumPy
+reductions over the same columns. Peak memory is measured in a separate run.
+"""
+import os
+import random
+import sys
+import time
+import tracemalloc
+from email.utils import format_datetime
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from metrics_utils import OrderColumns, compute_metrics_vectorized, iter_metric_rows
+from sync_utils import EXCLUDED_ORDER_STATUS_IDS, compute_customer_metrics, order_email
+
+
+def synthetic_orders(n_orders, n_customers, seed=7):
+    rng = random.Random(seed)
+    start = 1420070400
+    dates = [format_datetime(datetime.fromtimestamp(start + day * 86400, timezone.utc)) for day in range(2000)]
+    for order_id in range(1, n_orders + 1):
+        yield {'id': order_id,
+               'status_id': rng.choice((2, 2, 2, 10, 11, 5, 4)),
+               'total_inc_tax': '{:.4f}'.format(rng.uniform(5, 500)),
+               'date_created': rng.choice(dates),
+               'billing_address': {'email': 'customer{}@example.com'.format(rng.randrange(n_customers))}}
+
+
+def reference(orders):
+    by_customer = {}
+    for order in orders:
+        email = order_email(order)
+        if email:
+            by_customer.setdefault(email, []).append(order)
+    return dict((email, compute_customer_metrics(iter(customer_orders)))
+                for email, customer_orders in by_customer.items())
+
+
+def vectorized(orders, page_size=250):
+    start = time.perf_counter()
+    columns = OrderColumns()
+    for offset in range(0, len(orders), page_size):
+        columns.extend_orders(orders[offset:offset + page_size])
+    built = time.perf_counter()
+    metrics = compute_metrics_vectorized(columns)
+    rows = dict(iter_metric_rows(columns, metrics))
+    done = time.perf_counter()
+    return rows, built - start, done - built
+
+
+def reference_aggregate(columns):
+    """
+    The per-customer fold written as a Python loop over parsed orders.
+    """
+    customer, total, created, status = [column.tolist() for column in columns.arrays()]
+    aggregates = {}
+    for code, order_total, order_created, status_id in zip(customer, total, created, status):
+        if status_id in EXCLUDED_ORDER_STATUS_IDS:
+            continue
+        aggregate = aggregates.get(code)
+        if aggregate is None:
+            aggregates[code] = [1, order_total, order_created, order_created]
+        else:
+            aggregate[0] += 1
+            aggregate[1] += order_total
+            aggregate[2] = min(aggregate[2], order_created)
+            aggregate[3] = max(aggregate[3], order_created)
+    return aggregates
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def peak_memory(func, *args):
+    tracemalloc.start()
+    func(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak / 1e6
+
+
+def main(n_orders=1000000, n_customers=100000):
+    orders = list(synthetic_orders(n_orders, n_customers))
+
+    expected, reference_seconds = timed(reference, orders)
+    (actual, build_seconds, compute_seconds), vectorized_seconds = timed(vectorized, orders)
+    mismatches = [email for email in expected
+                  if expected[email]['rolling'] != actual[email]['rolling'] or
+                  any(abs((expected[email][k] or 0) - (actual[email][k] or 0)) > 0.011
+                      for k in actual[email] if k != 'rolling')]
+
+    columns = OrderColumns().extend_orders(orders)
+    _, loop_seconds = timed(reference_aggregate, columns)
+    _, numpy_seconds = timed(compute_metrics_vectorized, columns)
+
+    print('{} orders, {} customers, mismatched customers: {}'.format(n_orders, len(expected), len(mismatches)))
+    print('\nEnd to end, from order dicts')
+    print('  {:<30} {:>8.2f} s  peak {:>7.1f} MB'.format('pure-Python reference', reference_seconds,
+                                                        peak_memory(reference, orders)))
+    print('  {:<30} {:>8.2f} s  peak {:>7.1f} MB'.format('vectorized engine', vectorized_seconds,
+                                                        peak_memory(vectorized, orders)))
+    print('    {:<28} {:>8.2f} s'.format('column build', build_seconds))
+    print('    {:<28} {:>8.2f} s'.format('reductions + rows', compute_seconds))
+    print('  speedup {:.1f}x'.format(reference_seconds / vectorized_seconds))
+    print('\nAggregation only, from parsed columns')
+    print('  {:<30} {:>8.3f} s'.format('Python loop', loop_seconds))
+    print('  {:<30} {:>8.3f} s'.format('grouped NumPy reductions', numpy_seconds))
+    print('  speedup {:.1f}x'.format(loop_seconds / numpy_seconds))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
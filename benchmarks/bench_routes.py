@@ -0,0 +1,273 @@
+"""
+Drives the Flask app's routes under concurrency against local fake upstreams.
+
+    python benchmarks/bench_routes.py [--requests N] [--concurrency N] [--stores N] [--latency S]
+                                      [--jitter S] [--error-rate R] [--throttle-rate R] [--warmup N]
+                                      [--run-async] [--routes / /planinfo ...] [--json report.json]
+
+Fake BigCommerce, Chargebee, HubSpot and DynamoDB servers (see fake_upstreams.py,
+fake_hubspot.py and fake_dynamodb.py) are seeded with --stores installed stores,
+each with a subscription and a connected portal. Every route then serves
+--requests requests from --concurrency threads, spread over the stores. Each
+route reports latency percentiles, throughput, status codes, upstream calls per
+request as seen by the app (from its Server-Timing header) and requests received
+by each fake, which also counts retries and work done off the request.
+
+Asynchronous invocations are counted but not run unless --run-async is given.
+Every request to a fake takes --latency +- --jitter seconds, and fails with 500 or
+429 at the given rates. The first --warmup requests of each route are not measured,
+so the percentiles leave out creating clients and connections. Tracebacks of failed
+requests are only logged with --verbose.
+"""
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from fake_dynamodb import FakeDynamoDB
+from fake_hubspot import FakeHubSpot
+from fake_upstreams import Faults, FakeBigCommerce, FakeChargebee, FakeLambda, UpstreamRouter
+
+ROUTES = ('/bigcommerce/load', '/hsauth', '/', '/planinfo', '/paymentsuccess', '/subscription-events')
+
+CHARGEBEE_SITE = 'hubmetrix-bench'
+BC_CLIENT_SECRET = 'bench-client-secret'
+
+SERVER_TIMING = re.compile(r'(\w+);dur=([\d.]+)(?:;desc="(\d+) calls?")?')
+
+
+def configure_environment(hubspot):
+    os.environ.update({'HS_API_BASE': hubspot.url,
+                       'SESSION_SECRET': 'bench-session-secret',
+                       'APP_URL': 'http://localhost',
+                       'APP_ID': '4242',
+                       'BC_CLIENT_ID': 'bench-client-id',
+                       'BC_CLIENT_SECRET': BC_CLIENT_SECRET,
+                       'HS_CLIENT_ID': 'bench-hs-client-id',
+                       'HS_CLIENT_SECRET': 'bench-hs-client-secret',
+                       'CHARGEBEE-API-KEY': 'bench-api-key',
+                       'CHARGEBEE-SITE': CHARGEBEE_SITE,
+                       'TIMING_LOG_ENABLED': '0'})
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'bench')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'bench')
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-west-1')
+
+
+def signed_payload(store_hash, email):
+    payload = json.dumps({'user': {'id': 1, 'email': email}, 'owner': {'id': 1, 'email': email},
+                          'context': 'stores/' + store_hash, 'store_hash': store_hash,
+                          'timestamp': time.time()}).encode('utf-8')
+    signature = hmac.new(BC_CLIENT_SECRET.encode('utf-8'), payload, hashlib.sha256).hexdigest()
+    return '{}.{}'.format(base64.b64encode(payload).decode('ascii'),
+                          base64.b64encode(signature.encode('ascii')).decode('ascii'))
+
+
+def seed(n_stores, bigcommerce, chargebee):
+    from dynamodb_utils import AppUser
+    from property_utils import PROPERTY_SCHEMA_VERSION
+
+    stores = []
+    for index in range(n_stores):
+        store_hash = 'store{:04d}'.format(index)
+        email = 'owner@{}.example.com'.format(store_hash)
+        subscription_id = 'sub_{}'.format(store_hash)
+        bigcommerce.add_store(store_hash, admin_email=email)
+        chargebee.add_subscription(subscription_id, email, bc_store_hash=store_hash)
+        chargebee.hosted_pages['hp_' + store_hash] = dict(email=email, subscription_id=subscription_id)
+        AppUser(store_hash, index + 1, bc_email=email, bc_access_token='bc-token-' + store_hash, bc_scope='store_v2',
+                bc_webhooks_registered=True, hs_access_token='hs-token-' + store_hash, hs_refresh_token='refresh',
+                hs_expires_in='21600', hs_hub_id=str(1000 + index), hs_access_token_expires_at=int(time.time()) + 86400,
+                hs_properties_exist=True, hs_properties_version=PROPERTY_SCHEMA_VERSION,
+                cb_subscription_id=subscription_id, cb_subscription_status='active').save()
+        stores.append(dict(store_hash=store_hash, email=email, subscription_id=subscription_id))
+    return stores
+
+
+def route_requests(chargebee):
+    """
+    For each route, a function (client, store) that prepares the session and
+    returns a zero argument callable sending the request.
+    """
+    def with_session(client, store, **values):
+        with client.session_transaction() as session:
+            session['storehash'] = store['store_hash']
+            session.update(values)
+
+    def load(client, store):
+        query = {'signed_payload': signed_payload(store['store_hash'], store['email'])}
+        return lambda: client.get('/bigcommerce/load', query_string=query)
+
+    def hsauth(client, store):
+        with_session(client, store)
+        return lambda: client.get('/hsauth', query_string={'code': 'code-' + store['store_hash']})
+
+    def page(path):
+        def prepare(client, store):
+            with_session(client, store)
+            return lambda: client.get(path)
+        return prepare
+
+    def payment_success(client, store):
+        with_session(client, store, hosted_page_id='hp_' + store['store_hash'])
+        return lambda: client.get('/paymentsuccess')
+
+    def subscription_event(client, store):
+        body = chargebee.event('subscription_renewed', store['subscription_id'])
+        return lambda: client.post('/subscription-events', data=body, content_type='application/json')
+
+    return OrderedDict([('/bigcommerce/load', load), ('/hsauth', hsauth), ('/', page('/')),
+                        ('/planinfo', page('/planinfo')), ('/paymentsuccess', payment_success),
+                        ('/subscription-events', subscription_event)])
+
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] if ordered else 0.0
+
+
+def run_route(app, prepare, stores, n_requests, concurrency):
+    local = threading.local()
+    lock = threading.Lock()
+    latencies = []
+    statuses = Counter()
+    calls = Counter()
+    upstream_ms = Counter()
+
+    def one(index):
+        client = getattr(local, 'client', None)
+        if client is None:
+            client = local.client = app.test_client()
+        send = prepare(client, stores[index % len(stores)])
+        started = time.perf_counter()
+        try:
+            response = send()
+            status = response.status_code
+            timing = response.headers.get('Server-Timing', '')
+        except Exception as e:
+            status = type(e).__name__
+            timing = ''
+        elapsed = (time.perf_counter() - started) * 1000
+        with lock:
+            latencies.append(elapsed)
+            statuses[status] += 1
+            for name, ms, count in SERVER_TIMING.findall(timing):
+                if name != 'total':
+                    calls[name] += int(count or 1)
+                    upstream_ms[name] += float(ms)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, range(n_requests)))
+    seconds = time.perf_counter() - started
+
+    ordered = sorted(latencies)
+    return OrderedDict([('requests', n_requests),
+                        ('seconds', round(seconds, 3)),
+                        ('throughput', round(n_requests / seconds, 1)),
+                        ('p50_ms', round(percentile(ordered, 0.50), 1)),
+                        ('p95_ms', round(percentile(ordered, 0.95), 1)),
+                        ('p99_ms', round(percentile(ordered, 0.99), 1)),
+                        ('statuses', dict((str(status), count) for status, count in statuses.items())),
+                        ('calls_per_request', dict((name, round(count / float(n_requests), 2))
+                                                   for name, count in sorted(calls.items()))),
+                        ('upstream_ms_per_request', dict((name, round(ms / n_requests, 1))
+                                                         for name, ms in sorted(upstream_ms.items())))])
+
+
+def received(fakes, lambda_):
+    counts = dict((name, sum(fake.requests.values())) for name, fake in fakes.items())
+    counts['lambda'] = sum(lambda_.invocations.values())
+    return counts
+
+
+def main(args):
+    def faults(seed):
+        return Faults(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                      throttle_rate=args.throttle_rate, seed=seed)
+
+    hubspot = FakeHubSpot(faults=faults(1)).start()
+    bigcommerce = FakeBigCommerce(faults=faults(2)).start()
+    chargebee = FakeChargebee(faults=faults(3)).start()
+    dynamodb = FakeDynamoDB(faults=faults(4)).start()
+    configure_environment(hubspot)
+
+    import hubmetrix
+    import dynamodb_utils
+    dynamodb.register_models(dynamodb_utils.AppUser, dynamodb_utils.CustomerMetrics, dynamodb_utils.BackfillRange,
+                             dynamodb_utils.ContactIndex, dynamodb_utils.SubscriptionEvent)
+    lambda_ = FakeLambda(execute=args.run_async)
+    hubmetrix.zappa_async = lambda_
+
+    router = UpstreamRouter({'api.bigcommerce.com': bigcommerce.url,
+                             'login.bigcommerce.com': bigcommerce.url,
+                             '{}.chargebee.com'.format(CHARGEBEE_SITE): chargebee.url}).install()
+    fakes = OrderedDict([('bigcommerce', bigcommerce), ('chargebee', chargebee), ('hubspot', hubspot),
+                         ('dynamodb', dynamodb)])
+    if not args.verbose:
+        hubmetrix.app.logger.setLevel(logging.CRITICAL)
+    try:
+        stores = seed(args.stores, bigcommerce, chargebee)
+        requests = route_requests(chargebee)
+        report = OrderedDict()
+        print('{} stores, {} requests per route, concurrency {}, upstream latency {:.0f} +- {:.0f} ms, '
+              'error rate {}, 429 rate {}'.format(args.stores, args.requests, args.concurrency, args.latency * 1000,
+                                                   args.jitter * 1000, args.error_rate, args.throttle_rate))
+        print('\n{:<22} {:>8} {:>8} {:>8} {:>9}  {:<24} {}'.format('route', 'p50 ms', 'p95 ms', 'p99 ms', 'req/s',
+                                                                  'statuses', 'upstream calls per request'))
+        for route in args.routes:
+            if args.warmup:
+                run_route(hubmetrix.app, requests[route], stores, args.warmup, args.concurrency)
+            before = received(fakes, lambda_)
+            result = run_route(hubmetrix.app, requests[route], stores, args.requests, args.concurrency)
+            after = received(fakes, lambda_)
+            result['upstream_requests_received'] = dict((name, after[name] - before[name]) for name in after
+                                                        if after[name] != before[name])
+            report[route] = result
+            print('{:<22} {:>8.1f} {:>8.1f} {:>8.1f} {:>9.1f}  {:<24} {}'.format(
+                route, result['p50_ms'], result['p95_ms'], result['p99_ms'], result['throughput'],
+                json.dumps(result['statuses'], sort_keys=True),
+                ' '.join('{}={}'.format(name, count) for name, count in result['calls_per_request'].items())))
+
+        print('\nrequests received by the fakes per route:')
+        for route, result in report.items():
+            print('  {:<22} {}'.format(route, json.dumps(result['upstream_requests_received'], sort_keys=True)))
+        injected = Counter()
+        for fake in list(fakes.values()):
+            injected.update(fake.faults.injected)
+        print('injected faults: {}'.format(dict(injected)))
+        if args.json:
+            with open(args.json, 'w') as out:
+                json.dump(dict(settings=vars(args), routes=report), out, indent=2)
+    finally:
+        lambda_.shutdown()
+        router.uninstall()
+        for fake in fakes.values():
+            fake.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--stores', type=int, default=50)
+    parser.add_argument('--latency', type=float, default=0.02)
+    parser.add_argument('--jitter', type=float, default=0.005)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--throttle-rate', type=float, default=0.0)
+    parser.add_argument('--warmup', type=int, default=8)
+    parser.add_argument('--run-async', action='store_true')
+    parser.add_argument('--routes', nargs='+', default=list(ROUTES), choices=ROUTES)
+    parser.add_argument('--json')
+    parser.add_argument('--verbose', action='store_true')
+    main(parser.parse_args())
@@ -0,0 +1,107 @@
+"""
+Measures cold start cost of the Flask app: module import time and the time to
+the first response of each route, each in a fresh interpreter.
+
+    python benchmarks/bench_startup.py [--runs N] [--save baseline.json] [--baseline baseline.json]
+
+With --baseline, exits non-zero when any measurement regresses by more than
+--tolerance (default 20%) over the saved numbers.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# Routes that render without any upstream call. Routes that need Chargebee,
+# BigCommerce, HubSpot or DynamoDB are measured by the end-to-end route benchmark.
+STATIC_ROUTES = ['/getstarted', '/releasenotes', '/maybecancelplan', '/maybereactivateplan']
+
+IMPORT_SNIPPET = '''
+import time
+start = time.perf_counter()
+import hubmetrix
+print(time.perf_counter() - start)
+'''
+
+FIRST_RESPONSE_SNIPPET = '''
+import time
+start = time.perf_counter()
+import hubmetrix
+client = hubmetrix.app.test_client()
+response = client.get({route!r})
+assert response.status_code < 500, response.status_code
+print(time.perf_counter() - start)
+'''
+
+
+def run_snippet(snippet):
+    env = dict(os.environ, SESSION_SECRET=os.environ.get('SESSION_SECRET', 'bench'))
+    output = subprocess.check_output([sys.executable, '-c', snippet], cwd=ROOT, env=env)
+    return float(output.decode().strip().splitlines()[-1]) * 1000
+
+
+def heaviest_imports(limit=10):
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import hubmetrix'],
+                            cwd=ROOT, stderr=subprocess.PIPE, stdout=subprocess.DEVNULL)
+    rows = []
+    for line in result.stderr.decode().splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        cumulative_us, name = line.split('|')[1:]
+        if len(name) - len(name.lstrip()) == 3:
+            rows.append((int(cumulative_us) / 1000.0, name.strip()))
+    return sorted(rows, reverse=True)[:limit]
+
+
+def measure(runs):
+    results = {'import': statistics.median(run_snippet(IMPORT_SNIPPET) for _ in range(runs))}
+    for route in STATIC_ROUTES:
+        snippet = FIRST_RESPONSE_SNIPPET.format(route=route)
+        results['first_response ' + route] = statistics.median(run_snippet(snippet) for _ in range(runs))
+    return results
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, value in sorted(results.items()):
+        before = baseline.get(name)
+        change = '' if before is None else '{:+.0%}'.format((value - before) / before)
+        print('{:<40} {:>9.1f} ms {:>8}'.format(name, value, change))
+        if before is not None and value > before * (1 + tolerance):
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--save')
+    parser.add_argument('--baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    results = measure(args.runs)
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    regressions = compare(results, baseline, args.tolerance)
+
+    print('\nHeaviest top-level imports (cumulative):')
+    for cumulative_ms, name in heaviest_imports():
+        print('  {:>8.1f} ms  {}'.format(cumulative_ms, name))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if regressions:
+        print('\nRegressed beyond {:.0%}: {}'.format(args.tolerance, ', '.join(regressions)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,840 @@
+"""
+A local stand-in for DynamoDB, for benchmarks and manual testing without AWS.
+
+Speaks the DynamoDB JSON protocol over HTTP, so PynamoDB and botocore talk to it
+unchanged once a model's Meta.host points at it:
+
+    with FakeDynamoDB(latency=0.005) as dynamodb:
+        dynamodb.register_models(AppUser, CustomerMetrics)   # points Meta.host here
+
+Implements the operations Hubmetrix uses: GetItem, PutItem, UpdateItem,
+DeleteItem, Query, Scan (with parallel segments), BatchGetItem, BatchWriteItem
+and TransactWriteItems, plus CreateTable, DescribeTable, DeleteTable and
+ListTables. Condition, filter, key condition, projection and update expressions
+are evaluated, including attribute_exists, attribute_not_exists, begins_with,
+contains, size, BETWEEN, IN, if_not_exists and list_append. Items live in memory
+behind one lock. Capacity, item size limits, indexes and streams are not modelled.
+
+Run directly to serve on a fixed port: python benchmarks/fake_dynamodb.py --port 8300
+"""
+import argparse
+import base64
+import json
+import re
+import threading
+import time
+import uuid
+import zlib
+from collections import Counter
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from fake_upstreams import Faults
+
+ERROR_PREFIX = 'com.amazonaws.dynamodb.v20120810#'
+
+
+class DynamoError(Exception):
+    def __init__(self, kind, message, status=400, **extra):
+        super(DynamoError, self).__init__(message)
+        self.kind = kind
+        self.message = message
+        self.status = status
+        self.extra = extra
+
+
+def _conditional_failed():
+    return DynamoError('ConditionalCheckFailedException', 'The conditional request failed')
+
+
+#
+# Attribute values
+#
+def _key_of(value):
+    """
+    A hashable, ordered stand-in for a key attribute value.
+    """
+    (kind, raw), = value.items()
+    if kind == 'N':
+        return (0, Decimal(raw))
+    if kind == 'B':
+        return (1, base64.b64decode(raw))
+    return (2, raw)
+
+
+def _comparable(value):
+    if value is None:
+        return None
+    (kind, raw), = value.items()
+    if kind == 'N':
+        return 'N', Decimal(raw)
+    if kind == 'B':
+        return 'B', base64.b64decode(raw)
+    if kind in ('NS',):
+        return kind, frozenset(Decimal(item) for item in raw)
+    if kind in ('SS', 'BS'):
+        return kind, frozenset(raw)
+    if kind == 'L':
+        return kind, tuple(_comparable(item) for item in raw)
+    if kind == 'M':
+        return kind, tuple(sorted((name, _comparable(item)) for name, item in raw.items()))
+    return kind, raw
+
+
+def _number(decimal):
+    text = format(decimal.normalize(), 'f')
+    return text.rstrip('0').rstrip('.') if '.' in text else text
+
+
+#
+# Expressions
+#
+_TOKEN = re.compile(r'\s*(?:(?P<name>#[A-Za-z0-9_]+)|(?P<value>:[A-Za-z0-9_]+)|(?P<number>\d+)|'
+                    r'(?P<word>[A-Za-z_][A-Za-z0-9_]*)|(?P<op><>|<=|>=|[=<>(),.\[\]+\-]))')
+
+
+class _Tokens(object):
+    def __init__(self, text, names, values):
+        self.items = []
+        self.names = names or {}
+        self.values = values or {}
+        position = 0
+        text = text.strip()
+        while position < len(text):
+            match = _TOKEN.match(text, position)
+            if not match or match.end() == position:
+                raise DynamoError('ValidationException', 'Invalid expression near: {}'.format(text[position:]))
+            kind = match.lastgroup
+            self.items.append((kind, match.group(kind)))
+            position = match.end()
+            while position < len(text) and text[position].isspace():
+                position += 1
+        self.index = 0
+
+    def peek(self, offset=0):
+        index = self.index + offset
+        return self.items[index] if index < len(self.items) else (None, None)
+
+    def next(self):
+        token = self.peek()
+        self.index += 1
+        return token
+
+    def accept_word(self, word):
+        kind, text = self.peek()
+        if kind == 'word' and text.upper() == word:
+            self.index += 1
+            return True
+        return False
+
+    def accept(self, op):
+        if self.peek() == ('op', op):
+            self.index += 1
+            return True
+        return False
+
+    def expect(self, op):
+        if not self.accept(op):
+            raise DynamoError('ValidationException', 'Expected {} at token {}'.format(op, self.peek()[1]))
+
+    def done(self):
+        return self.index >= len(self.items)
+
+    def path(self):
+        parts = [self._name()]
+        while True:
+            if self.accept('.'):
+                parts.append(self._name())
+            elif self.accept('['):
+                kind, text = self.next()
+                if kind != 'number':
+                    raise DynamoError('ValidationException', 'List index must be a number')
+                parts.append(int(text))
+                self.expect(']')
+            else:
+                return ('path', tuple(parts))
+
+    def _name(self):
+        kind, text = self.next()
+        if kind == 'name':
+            if text not in self.names:
+                raise DynamoError('ValidationException', 'Undefined attribute name {}'.format(text))
+            return self.names[text]
+        if kind == 'word':
+            return text
+        raise DynamoError('ValidationException', 'Expected an attribute name, got {}'.format(text))
+
+    def value(self):
+        kind, text = self.next()
+        if text not in self.values:
+            raise DynamoError('ValidationException', 'Undefined attribute value {}'.format(text))
+        return ('value', self.values[text])
+
+
+_BOOLEAN_FUNCTIONS = ('attribute_exists', 'attribute_not_exists', 'attribute_type', 'begins_with', 'contains')
+_COMPARATORS = ('=', '<>', '<', '<=', '>', '>=')
+
+
+def parse_condition(text, names, values):
+    tokens = _Tokens(text, names, values)
+    node = _or(tokens)
+    if not tokens.done():
+        raise DynamoError('ValidationException', 'Unexpected token {}'.format(tokens.peek()[1]))
+    return node
+
+
+def _or(tokens):
+    node = _and(tokens)
+    while tokens.accept_word('OR'):
+        node = ('or', node, _and(tokens))
+    return node
+
+
+def _and(tokens):
+    node = _not(tokens)
+    while tokens.accept_word('AND'):
+        node = ('and', node, _not(tokens))
+    return node
+
+
+def _not(tokens):
+    if tokens.accept_word('NOT'):
+        return ('not', _not(tokens))
+    return _primary(tokens)
+
+
+def _primary(tokens):
+    if tokens.accept('('):
+        node = _or(tokens)
+        tokens.expect(')')
+        return node
+    kind, text = tokens.peek()
+    if kind == 'word' and text.lower() in _BOOLEAN_FUNCTIONS and tokens.peek(1) == ('op', '('):
+        tokens.next()
+        tokens.expect('(')
+        args = [_operand(tokens)]
+        while tokens.accept(','):
+            args.append(_operand(tokens))
+        tokens.expect(')')
+        return ('function', text.lower(), args)
+    left = _operand(tokens)
+    if tokens.accept_word('BETWEEN'):
+        low = _operand(tokens)
+        if not tokens.accept_word('AND'):
+            raise DynamoError('ValidationException', 'BETWEEN needs AND')
+        return ('between', left, low, _operand(tokens))
+    if tokens.accept_word('IN'):
+        tokens.expect('(')
+        options = [_operand(tokens)]
+        while tokens.accept(','):
+            options.append(_operand(tokens))
+        tokens.expect(')')
+        return ('in', left, options)
+    kind, op = tokens.next()
+    if kind != 'op' or op not in _COMPARATORS:
+        raise DynamoError('ValidationException', 'Expected a comparator, got {}'.format(op))
+    return ('compare', op, left, _operand(tokens))
+
+
+def _operand(tokens):
+    kind, text = tokens.peek()
+    if kind == 'value':
+        return tokens.value()
+    if kind == 'word' and text.lower() == 'size' and tokens.peek(1) == ('op', '('):
+        tokens.next()
+        tokens.expect('(')
+        path = tokens.path()
+        tokens.expect(')')
+        return ('size', path)
+    return tokens.path()
+
+
+def _resolve(item, path):
+    value = {'M': item}
+    for part in path:
+        if isinstance(part, int):
+            items = value.get('L')
+            if items is None or part >= len(items):
+                return None
+            value = items[part]
+        else:
+            members = value.get('M')
+            if members is None or part not in members:
+                return None
+            value = members[part]
+    return value
+
+
+def _evaluate_operand(item, operand):
+    kind = operand[0]
+    if kind == 'value':
+        return operand[1]
+    if kind == 'path':
+        return _resolve(item, operand[1])
+    value = _resolve(item, operand[1][1])
+    if value is None:
+        return None
+    (value_kind, raw), = value.items()
+    size = len(base64.b64decode(raw)) if value_kind == 'B' else len(raw)
+    return {'N': str(size)}
+
+
+def evaluate(node, item):
+    kind = node[0]
+    if kind == 'or':
+        return evaluate(node[1], item) or evaluate(node[2], item)
+    if kind == 'and':
+        return evaluate(node[1], item) and evaluate(node[2], item)
+    if kind == 'not':
+        return not evaluate(node[1], item)
+    if kind == 'function':
+        name, args = node[1], node[2]
+        value = _evaluate_operand(item, args[0])
+        if name == 'attribute_exists':
+            return value is not None
+        if name == 'attribute_not_exists':
+            return value is None
+        other = _evaluate_operand(item, args[1])
+        if value is None or other is None:
+            return False
+        if name == 'attribute_type':
+            return list(value)[0] == other['S']
+        if name == 'begins_with':
+            (value_kind, raw), = value.items()
+            (_, prefix), = other.items()
+            return value_kind in ('S', 'B') and raw.startswith(prefix)
+        (value_kind, raw), = value.items()
+        if value_kind == 'S':
+            return list(other.values())[0] in raw
+        if value_kind in ('SS', 'NS', 'BS'):
+            return _comparable(other)[1] in _comparable(value)[1]
+        if value_kind == 'L':
+            return _comparable(other) in _comparable(value)[1]
+        return False
+    if kind == 'between':
+        value, low, high = [_comparable(_evaluate_operand(item, operand)) for operand in node[1:]]
+        if value is None or low is None or high is None or not value[0] == low[0] == high[0]:
+            return False
+        return low[1] <= value[1] <= high[1]
+    if kind == 'in':
+        value = _comparable(_evaluate_operand(item, node[1]))
+        return value is not None and any(value == _comparable(_evaluate_operand(item, option))
+                                         for option in node[2])
+    op = node[1]
+    left = _comparable(_evaluate_operand(item, node[2]))
+    right = _comparable(_evaluate_operand(item, node[3]))
+    if left is None or right is None:
+        return False
+    if op == '=':
+        return left == right
+    if op == '<>':
+        return left != right
+    if left[0] != right[0] or left[0] not in ('S', 'N', 'B'):
+        return False
+    return {'<': left[1] < right[1], '<=': left[1] <= right[1],
+            '>': left[1] > right[1], '>=': left[1] >= right[1]}[op]
+
+
+def apply_update(text, names, values, item):
+    tokens = _Tokens(text, names, values)
+    while not tokens.done():
+        kind, word = tokens.next()
+        clause = (word or '').upper()
+        if clause not in ('SET', 'REMOVE', 'ADD', 'DELETE'):
+            raise DynamoError('ValidationException', 'Unknown update clause {}'.format(word))
+        while True:
+            path = tokens.path()
+            if clause == 'SET':
+                tokens.expect('=')
+                _set(item, path[1], _set_value(tokens, item))
+            elif clause == 'REMOVE':
+                _remove(item, path[1])
+            else:
+                _add_or_delete(item, path[1], tokens.value()[1], clause == 'ADD')
+            if not tokens.accept(','):
+                break
+
+
+def _set_value(tokens, item):
+    value = _set_operand(tokens, item)
+    if tokens.accept('+'):
+        return _arithmetic(value, _set_operand(tokens, item), 1)
+    if tokens.accept('-'):
+        return _arithmetic(value, _set_operand(tokens, item), -1)
+    return value
+
+
+def _set_operand(tokens, item):
+    kind, text = tokens.peek()
+    if kind == 'word' and tokens.peek(1) == ('op', '(') and text.lower() in ('if_not_exists', 'list_append'):
+        tokens.next()
+        tokens.expect('(')
+        first = _set_operand(tokens, item) if text.lower() == 'list_append' else _resolve(item, tokens.path()[1])
+        tokens.expect(',')
+        second = _set_operand(tokens, item)
+        tokens.expect(')')
+        if text.lower() == 'if_not_exists':
+            return first if first is not None else second
+        return {'L': list((first or {'L': []})['L']) + list((second or {'L': []})['L'])}
+    if kind == 'value':
+        return tokens.value()[1]
+    value = _resolve(item, tokens.path()[1])
+    if value is None:
+        raise DynamoError('ValidationException', 'The provided expression refers to an attribute that does '
+                                                 'not exist in the item')
+    return value
+
+
+def _arithmetic(left, right, sign):
+    if 'N' not in left or 'N' not in right:
+        raise DynamoError('ValidationException', 'An operand in the update expression has an incorrect data type')
+    return {'N': _number(Decimal(left['N']) + sign * Decimal(right['N']))}
+
+
+def _parent(item, path, create=False):
+    container = {'M': item}
+    for part in path[:-1]:
+        if isinstance(part, int):
+            container = container['L'][part]
+        else:
+            members = container['M']
+            if part not in members:
+                if not create:
+                    return None
+                members[part] = {'M': {}}
+            container = members[part]
+    return container
+
+
+def _set(item, path, value):
+    container = _parent(item, path, create=True)
+    last = path[-1]
+    if isinstance(last, int):
+        items = container['L']
+        if last >= len(items):
+            items.append(value)
+        else:
+            items[last] = value
+    else:
+        container['M'][last] = value
+
+
+def _remove(item, path):
+    container = _parent(item, path)
+    if container is None:
+        return
+    last = path[-1]
+    if isinstance(last, int):
+        if last < len(container.get('L', [])):
+            del container['L'][last]
+    else:
+        container.get('M', {}).pop(last, None)
+
+
+def _add_or_delete(item, path, value, add):
+    current = _resolve(item, path)
+    if 'N' in value:
+        if not add:
+            raise DynamoError('ValidationException', 'DELETE only supports sets')
+        _set(item, path, {'N': _number(Decimal((current or {'N': '0'})['N']) + Decimal(value['N']))})
+        return
+    (kind, members), = value.items()
+    existing = list((current or {kind: []}).get(kind, []))
+    if add:
+        updated = existing + [member for member in members if member not in existing]
+    else:
+        updated = [member for member in existing if member not in members]
+    if updated:
+        _set(item, path, {kind: updated})
+    else:
+        _remove(item, path)
+
+
+def project(item, expression, names):
+    if not expression:
+        return item
+    projected = {}
+    for part in expression.split(','):
+        tokens = _Tokens(part, names, {})
+        path = tokens.path()[1]
+        value = _resolve(item, path)
+        if value is not None:
+            projected[path[0]] = item[path[0]] if len(path) > 1 else value
+    return projected
+
+
+#
+# Tables
+#
+class FakeTable(object):
+    def __init__(self, name, hash_key, range_key=None, attribute_types=None):
+        self.name = name
+        self.hash_key = hash_key
+        self.range_key = range_key
+        self.attribute_types = attribute_types or {}
+        self.partitions = {}
+        self.created_at = time.time()
+
+    def key(self, item):
+        try:
+            hash_value = _key_of(item[self.hash_key])
+            range_value = _key_of(item[self.range_key]) if self.range_key else None
+        except KeyError:
+            raise DynamoError('ValidationException', 'The provided key element does not match the schema')
+        return hash_value, range_value
+
+    def get(self, key):
+        hash_value, range_value = self.key(key)
+        return self.partitions.get(hash_value, {}).get(range_value)
+
+    def put(self, item):
+        hash_value, range_value = self.key(item)
+        self.partitions.setdefault(hash_value, {})[range_value] = item
+
+    def delete(self, key):
+        hash_value, range_value = self.key(key)
+        partition = self.partitions.get(hash_value, {})
+        partition.pop(range_value, None)
+        if not partition:
+            self.partitions.pop(hash_value, None)
+
+    def key_values(self, item):
+        key = {self.hash_key: item[self.hash_key]}
+        if self.range_key:
+            key[self.range_key] = item[self.range_key]
+        return key
+
+    def item_count(self):
+        return sum(len(partition) for partition in self.partitions.values())
+
+    def describe(self):
+        schema = [{'AttributeName': self.hash_key, 'KeyType': 'HASH'}]
+        if self.range_key:
+            schema.append({'AttributeName': self.range_key, 'KeyType': 'RANGE'})
+        return {'TableName': self.name, 'TableStatus': 'ACTIVE', 'KeySchema': schema,
+                'AttributeDefinitions': [{'AttributeName': name, 'AttributeType': kind}
+                                         for name, kind in sorted(self.attribute_types.items())],
+                'ItemCount': self.item_count(), 'CreationDateTime': self.created_at,
+                'BillingModeSummary': {'BillingMode': 'PAY_PER_REQUEST'}}
+
+
+class FakeDynamoDB(object):
+    def __init__(self, port=0, latency=0.0, faults=None):
+        self.faults = faults or Faults(latency=latency)
+        self.tables = {}
+        self.requests = Counter()
+        self._lock = threading.RLock()
+        self._server = _Server(('127.0.0.1', port), _handler(self))
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self._server.server_address[1])
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def create_table(self, name, hash_key, range_key=None, attribute_types=None):
+        with self._lock:
+            if name not in self.tables:
+                self.tables[name] = FakeTable(name, hash_key, range_key, attribute_types)
+            return self.tables[name]
+
+    def register_models(self, *models):
+        """
+        Creates the tables of PynamoDB models and points the models at this server.
+        """
+        for model in models:
+            hash_key = model._hash_key_attribute()
+            range_key = model._range_key_attribute()
+            types = dict((attribute.attr_name, attribute.attr_type) for attribute in (hash_key, range_key)
+                         if attribute is not None)
+            self.create_table(model.Meta.table_name, hash_key.attr_name,
+                              range_key.attr_name if range_key is not None else None, types)
+            model.Meta.host = self.url
+            model._connection = None
+
+    def items(self, table_name):
+        with self._lock:
+            table = self.tables[table_name]
+            return [json.loads(json.dumps(item)) for partition in table.partitions.values()
+                    for item in partition.values()]
+
+    def call(self, operation, body):
+        handler = getattr(self, '_' + re.sub(r'(?<!^)([A-Z])', r'_\1', operation).lower(), None)
+        if handler is None:
+            raise DynamoError('UnknownOperationException', 'Unsupported operation {}'.format(operation))
+        with self._lock:
+            return handler(body)
+
+    def _table(self, name):
+        table = self.tables.get(name)
+        if table is None:
+            raise DynamoError('ResourceNotFoundException', 'Requested resource not found: Table: {} not found'
+                              .format(name))
+        return table
+
+    @staticmethod
+    def _check(body, item, prefix=''):
+        expression = body.get(prefix + 'ConditionExpression')
+        if expression and not evaluate(parse_condition(expression, body.get('ExpressionAttributeNames'),
+                                                       body.get('ExpressionAttributeValues')), item or {}):
+            raise _conditional_failed()
+
+    @staticmethod
+    def _returned(body, old, new):
+        kind = body.get('ReturnValues', 'NONE')
+        if kind == 'ALL_OLD' and old:
+            return {'Attributes': old}
+        if kind == 'ALL_NEW' and new:
+            return {'Attributes': new}
+        if kind in ('UPDATED_NEW', 'UPDATED_OLD'):
+            source, other = (new, old) if kind == 'UPDATED_NEW' else (old, new)
+            changed = dict((name, value) for name, value in (source or {}).items()
+                           if (other or {}).get(name) != value)
+            return {'Attributes': changed} if changed else {}
+        return {}
+
+    # Table operations
+
+    def _create_table(self, body):
+        schema = dict((key['KeyType'], key['AttributeName']) for key in body['KeySchema'])
+        types = dict((attribute['AttributeName'], attribute['AttributeType'])
+                     for attribute in body.get('AttributeDefinitions', []))
+        if body['TableName'] in self.tables:
+            raise DynamoError('ResourceInUseException', 'Table already exists: {}'.format(body['TableName']))
+        return {'TableDescription': self.create_table(body['TableName'], schema['HASH'], schema.get('RANGE'),
+                                                      types).describe()}
+
+    def _describe_table(self, body):
+        return {'Table': self._table(body['TableName']).describe()}
+
+    def _delete_table(self, body):
+        table = self._table(body['TableName'])
+        del self.tables[table.name]
+        return {'TableDescription': table.describe()}
+
+    def _list_tables(self, body):
+        return {'TableNames': sorted(self.tables)}
+
+    def _update_time_to_live(self, body):
+        return {'TimeToLiveSpecification': body['TimeToLiveSpecification']}
+
+    # Item operations
+
+    def _get_item(self, body):
+        item = self._table(body['TableName']).get(body['Key'])
+        if item is None:
+            return {}
+        return {'Item': project(item, body.get('ProjectionExpression'), body.get('ExpressionAttributeNames'))}
+
+    def _put_item(self, body):
+        table = self._table(body['TableName'])
+        old = table.get(body['Item'])
+        self._check(body, old)
+        table.put(json.loads(json.dumps(body['Item'])))
+        return self._returned(body, old, None)
+
+    def _update_item(self, body):
+        table = self._table(body['TableName'])
+        old = table.get(body['Key'])
+        self._check(body, old)
+        new = json.loads(json.dumps(old if old is not None else body['Key']))
+        if body.get('UpdateExpression'):
+            apply_update(body['UpdateExpression'], body.get('ExpressionAttributeNames'),
+                         body.get('ExpressionAttributeValues'), new)
+        table.put(new)
+        return self._returned(body, old, new)
+
+    def _delete_item(self, body):
+        table = self._table(body['TableName'])
+        old = table.get(body['Key'])
+        self._check(body, old)
+        if old is not None:
+            table.delete(body['Key'])
+        return self._returned(body, old, None)
+
+    def _batch_get_item(self, body):
+        responses = {}
+        for table_name, request in body['RequestItems'].items():
+            table = self._table(table_name)
+            found = responses.setdefault(table_name, [])
+            for key in request['Keys']:
+                item = table.get(key)
+                if item is not None:
+                    found.append(project(item, request.get('ProjectionExpression'),
+                                         request.get('ExpressionAttributeNames')))
+        return {'Responses': responses, 'UnprocessedKeys': {}}
+
+    def _batch_write_item(self, body):
+        for table_name, requests in body['RequestItems'].items():
+            table = self._table(table_name)
+            for request in requests:
+                if 'PutRequest' in request:
+                    table.put(json.loads(json.dumps(request['PutRequest']['Item'])))
+                else:
+                    table.delete(request['DeleteRequest']['Key'])
+        return {'UnprocessedItems': {}}
+
+    def _transact_write_items(self, body):
+        reasons = []
+        failed = False
+        for entry in body['TransactItems']:
+            (kind, request), = entry.items()
+            table = self._table(request['TableName'])
+            current = table.get(request['Key'] if 'Key' in request else request['Item'])
+            try:
+                self._check(request, current)
+                reasons.append({'Code': 'None'})
+            except DynamoError:
+                reasons.append({'Code': 'ConditionalCheckFailed', 'Message': 'The conditional request failed'})
+                failed = True
+        if failed:
+            raise DynamoError('TransactionCanceledException',
+                              'Transaction cancelled, please refer cancellation reasons for specific reasons [{}]'
+                              .format(', '.join(reason['Code'] for reason in reasons)),
+                              CancellationReasons=reasons)
+        for entry in body['TransactItems']:
+            (kind, request), = entry.items()
+            if kind == 'Put':
+                self._put_item(dict(request, ConditionExpression=None))
+            elif kind == 'Update':
+                self._update_item(dict(request, ConditionExpression=None))
+            elif kind == 'Delete':
+                self._delete_item(dict(request, ConditionExpression=None))
+        return {}
+
+    # Query and scan
+
+    def _query(self, body):
+        table = self._table(body['TableName'])
+        names = body.get('ExpressionAttributeNames')
+        values = body.get('ExpressionAttributeValues')
+        key_condition = parse_condition(body['KeyConditionExpression'], names, values)
+        hash_value = self._hash_value(key_condition, table)
+        partition = table.partitions.get(hash_value, {})
+        ordered = [partition[key] for key in sorted(partition, key=lambda key: key or (0, 0))]
+        if body.get('ScanIndexForward') is False:
+            ordered.reverse()
+        candidates = [item for item in ordered if evaluate(key_condition, item)]
+        return self._page(table, body, candidates)
+
+    def _scan(self, body):
+        table = self._table(body['TableName'])
+        segments = body.get('TotalSegments')
+        candidates = []
+        for hash_value in sorted(table.partitions):
+            if segments and zlib.crc32(repr(hash_value).encode('utf-8')) % segments != body.get('Segment', 0):
+                continue
+            partition = table.partitions[hash_value]
+            candidates.extend(partition[key] for key in sorted(partition, key=lambda key: key or (0, 0)))
+        return self._page(table, body, candidates)
+
+    @staticmethod
+    def _hash_value(node, table):
+        if node[0] == 'and':
+            return FakeDynamoDB._hash_value(node[1], table) or FakeDynamoDB._hash_value(node[2], table)
+        if node[0] == 'compare' and node[1] == '=':
+            for left, right in ((node[2], node[3]), (node[3], node[2])):
+                if left[0] == 'path' and left[1] == (table.hash_key,) and right[0] == 'value':
+                    return _key_of(right[1])
+        return None
+
+    def _page(self, table, body, candidates):
+        names = body.get('ExpressionAttributeNames')
+        start = body.get('ExclusiveStartKey')
+        if start:
+            start_key = table.key(start)
+            for index, item in enumerate(candidates):
+                if table.key(item) == start_key:
+                    candidates = candidates[index + 1:]
+                    break
+        limit = body.get('Limit')
+        evaluated = candidates[:limit] if limit else candidates
+        last_key = table.key_values(evaluated[-1]) if limit and len(candidates) > limit and evaluated else None
+
+        expression = body.get('FilterExpression')
+        if expression:
+            condition = parse_condition(expression, names, body.get('ExpressionAttributeValues'))
+            matched = [item for item in evaluated if evaluate(condition, item)]
+        else:
+            matched = evaluated
+        result = {'Count': len(matched), 'ScannedCount': len(evaluated)}
+        if body.get('Select') != 'COUNT':
+            result['Items'] = [project(item, body.get('ProjectionExpression'), names) for item in matched]
+        if last_key:
+            result['LastEvaluatedKey'] = last_key
+        return result
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def _handler(dynamodb):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length') or 0)).decode('utf-8') or '{}')
+            operation = (self.headers.get('X-Amz-Target') or '').split('.')[-1]
+            dynamodb.requests[operation] += 1
+            fault = dynamodb.faults.inject()
+            if fault == 'error':
+                return self._error(DynamoError('InternalServerError', 'Injected failure', status=500))
+            if fault == 'throttle':
+                return self._error(DynamoError('ProvisionedThroughputExceededException',
+                                               'The level of configured provisioned throughput for the table was '
+                                               'exceeded'))
+            try:
+                result = dynamodb.call(operation, body)
+            except DynamoError as e:
+                return self._error(e)
+            if body.get('ReturnConsumedCapacity') in ('TOTAL', 'INDEXES') and 'TableName' in body:
+                result['ConsumedCapacity'] = {'TableName': body['TableName'], 'CapacityUnits': 1.0}
+            self._reply(200, result)
+
+        def _error(self, error):
+            payload = dict({'__type': ERROR_PREFIX + error.kind, 'message': error.message}, **error.extra)
+            self._reply(error.status, payload)
+
+        def _reply(self, status, payload):
+            body = json.dumps(payload).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/x-amz-json-1.0')
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('x-amzn-RequestId', str(uuid.uuid4()))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--port', type=int, default=8300)
+    parser.add_argument('--latency', type=float, default=0.0)
+    args = parser.parse_args()
+    server = FakeDynamoDB(args.port, args.latency).start()
+    print('Fake DynamoDB listening on {}'.format(server.url))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
@@ -0,0 +1,275 @@
+"""
+A local stand-in for the HubSpot contacts and properties APIs, for benchmarks and manual testing.
+
+Implements the endpoints Hubmetrix writes through:
+
+    POST /contacts/v1/contact/batch/
+    POST /contacts/v1/contact/createOrUpdate/email/<email>/
+    GET /contacts/v1/contact/emails/batch/
+    GET /contacts/v1/lists/all/contacts/all
+    POST /oauth/v1/token
+    GET /oauth/v1/access-tokens/<token>
+    GET, POST /crm/v3/properties/contacts/groups[/<name>]
+    GET /crm/v3/properties/contacts, POST .../batch/create, PATCH .../<name>
+
+Every request sleeps for `latency` seconds, or goes through the given Faults (see
+fake_upstreams.py) to add jitter and injected errors. Contact writes are rate limited per
+access token the way HubSpot limits a portal, reporting X-HubSpot-RateLimit-*
+headers and answering 429 with Retry-After. Batches over
+100 contacts or with invalid emails are rejected with 400, listing the invalid
+contacts by index. Received contacts and request counts are kept for inspection.
+
+    with FakeHubSpot(latency=0.05) as hubspot:
+        os.environ['HS_API_BASE'] = hubspot.url   # before importing hubspot_utils
+
+Run directly to serve on a fixed port: python benchmarks/fake_hubspot.py --port 8200
+"""
+import argparse
+import json
+import threading
+import time
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, unquote
+
+from fake_upstreams import Faults
+
+BATCH_LIMIT = 100
+PROPERTIES_PATH = '/crm/v3/properties/contacts'
+
+
+class FakeHubSpot(object):
+    def __init__(self, port=0, latency=0.0, rate_limit=100, rate_window=10.0, faults=None):
+        self.faults = faults or Faults(latency=latency)
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.contacts = {}
+        self.vids = {}
+        self.properties = {}
+        self.groups = {}
+        self.requests = Counter()
+        self._sent_at = {}
+        self._lock = threading.Lock()
+        self._server = _Server(('127.0.0.1', port), _handler(self))
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self._server.server_address[1])
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def allow(self, token):
+        """
+        Sliding window limit per token. Returns (seconds to wait or 0 if allowed,
+        the X-HubSpot-RateLimit-* headers to answer with).
+        """
+        now = time.time()
+        with self._lock:
+            sent_at = self._sent_at.setdefault(token, deque())
+            while sent_at and sent_at[0] <= now - self.rate_window:
+                sent_at.popleft()
+            wait = 0
+            if len(sent_at) >= self.rate_limit:
+                wait = sent_at[0] + self.rate_window - now
+            else:
+                sent_at.append(now)
+            headers = {'X-HubSpot-RateLimit-Max': str(self.rate_limit),
+                       'X-HubSpot-RateLimit-Remaining': str(self.rate_limit - len(sent_at)),
+                       'X-HubSpot-RateLimit-Interval-Milliseconds': str(int(self.rate_window * 1000))}
+            return wait, headers
+
+    def upsert(self, email, properties):
+        email = email.lower()
+        with self._lock:
+            self.contacts.setdefault(email, {}).update((item['property'], item['value']) for item in properties)
+            return self.vids.setdefault(email, len(self.vids) + 1)
+
+    def email_of(self, vid):
+        with self._lock:
+            for email, known in self.vids.items():
+                if known == vid:
+                    return email
+        return None
+
+    def contact(self, email):
+        return {'vid': self.vids[email], 'properties': {'email': {'value': email}},
+                'identity-profiles': [{'identities': [{'type': 'EMAIL', 'value': email, 'is-primary': True}]}]}
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def _handler(hubspot):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self._faulted():
+                return
+            path, _, query = self.path.partition('?')
+            path = path.rstrip('/')
+            params = parse_qs(query)
+            if path.startswith('/oauth/v1/access-tokens/'):
+                hubspot.requests['token_info'] += 1
+                return self._reply(200, {'token': path.rsplit('/', 1)[1], 'user': 'owner@example.com',
+                                         'hub_domain': 'example.hubspot.com', 'scopes': ['contacts'],
+                                         'hub_id': 62515, 'app_id': 4242, 'expires_in': 21600, 'user_id': 123,
+                                         'token_type': 'access'})
+            if path == '/contacts/v1/contact/emails/batch':
+                hubspot.requests['email_lookup'] += 1
+                emails = [email.lower() for email in params.get('email', [])]
+                return self._reply(200, dict((str(hubspot.vids[email]), hubspot.contact(email))
+                                             for email in emails if email in hubspot.vids))
+            if path == '/contacts/v1/lists/all/contacts/all':
+                hubspot.requests['contact_list'] += 1
+                count = int(params.get('count', ['20'])[0])
+                offset = int(params.get('vidOffset', ['0'])[0])
+                page = sorted((vid, email) for email, vid in hubspot.vids.items() if vid > offset)[:count + 1]
+                contacts = [hubspot.contact(email) for _, email in page[:count]]
+                return self._reply(200, {'contacts': contacts, 'has-more': len(page) > count,
+                                         'vid-offset': contacts[-1]['vid'] if contacts else offset})
+
+            hubspot.requests['properties_read'] += 1
+            if path == PROPERTIES_PATH:
+                return self._reply(200, {'results': list(hubspot.properties.values())})
+            if path.startswith(PROPERTIES_PATH + '/groups/'):
+                group = hubspot.groups.get(path.rsplit('/', 1)[1])
+                return self._reply(200, group) if group else self._reply(404, {'status': 'error'})
+            self._reply(404, {'status': 'error', 'message': 'Unknown path {}'.format(path)})
+
+        def do_PATCH(self):
+            if self._faulted():
+                return
+            path = self.path.split('?')[0].rstrip('/')
+            name = path.rsplit('/', 1)[1]
+            if not path.startswith(PROPERTIES_PATH + '/') or name not in hubspot.properties:
+                return self._reply(404, {'status': 'error'})
+            hubspot.requests['properties_write'] += 1
+            hubspot.properties[name].update(self._json())
+            self._reply(200, hubspot.properties[name])
+
+        def do_POST(self):
+            body = self._body()
+            if self._faulted():
+                return
+            path = self.path.split('?')[0]
+
+            if path.rstrip('/') == PROPERTIES_PATH + '/groups':
+                hubspot.requests['properties_write'] += 1
+                group = json.loads(body.decode('utf-8'))
+                hubspot.groups[group['name']] = group
+                return self._reply(201, group)
+
+            if path.rstrip('/') == PROPERTIES_PATH + '/batch/create':
+                hubspot.requests['properties_write'] += 1
+                created = json.loads(body.decode('utf-8'))['inputs']
+                for prop in created:
+                    hubspot.properties[prop['name']] = dict(prop)
+                return self._reply(201, {'status': 'COMPLETE', 'results': created})
+
+            if path == '/oauth/v1/token':
+                hubspot.requests['token'] += 1
+                return self._reply(200, {'access_token': 'fake-access-token', 'refresh_token': 'fake-refresh-token',
+                                         'expires_in': 21600})
+
+            token = (self.headers.get('Authorization') or '').replace('Bearer ', '')
+            wait, self.rate_limit_headers = hubspot.allow(token)
+            if wait:
+                hubspot.requests['rate_limited'] += 1
+                return self._reply(429, {'status': 'error', 'errorType': 'RATE_LIMIT'},
+                                   {'Retry-After': '{:.3f}'.format(wait)})
+
+            if path == '/contacts/v1/contact/batch/':
+                hubspot.requests['batch'] += 1
+                return self._batch(json.loads(body.decode('utf-8')))
+
+            prefix = '/contacts/v1/contact/createOrUpdate/email/'
+            if path.startswith(prefix):
+                hubspot.requests['create_or_update'] += 1
+                email = unquote(path[len(prefix):].strip('/'))
+                is_new = email.lower() not in hubspot.vids
+                vid = hubspot.upsert(email, json.loads(body.decode('utf-8'))['properties'])
+                return self._reply(200, {'vid': vid, 'isNew': is_new})
+
+            self._reply(404, {'status': 'error', 'message': 'Unknown path {}'.format(path)})
+
+        def _faulted(self):
+            fault = hubspot.faults.inject()
+            if fault == 'error':
+                self._reply(500, {'status': 'error', 'message': 'Injected failure'})
+            elif fault == 'throttle':
+                self._reply(429, {'status': 'error', 'errorType': 'RATE_LIMIT'},
+                            {'Retry-After': str(hubspot.faults.retry_after)})
+            return fault is not None
+
+        def _body(self):
+            return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+        def _json(self):
+            return json.loads(self._body().decode('utf-8'))
+
+        def _batch(self, contacts):
+            if len(contacts) > BATCH_LIMIT:
+                return self._reply(400, {'status': 'error',
+                                         'message': 'Batch size {} exceeds {}'.format(len(contacts), BATCH_LIMIT)})
+            failures = []
+            emails = []
+            for index, contact in enumerate(contacts):
+                email = hubspot.email_of(contact['vid']) if 'vid' in contact else contact.get('email') or ''
+                emails.append(email)
+                if not email or '@' not in email:
+                    failures.append({'index': index, 'error': {'status': 'error',
+                                                               'message': 'Invalid email or unknown vid'}})
+            if failures:
+                return self._reply(400, {'status': 'error', 'message': 'Errors found processing batch update',
+                                         'failureMessages': failures})
+            for email, contact in zip(emails, contacts):
+                hubspot.upsert(email, contact['properties'])
+            self._reply(202)
+
+        def _reply(self, status, payload=None, headers=None):
+            body = json.dumps(payload).encode('utf-8') if payload is not None else b''
+            self.send_response(status)
+            headers = dict(getattr(self, 'rate_limit_headers', None) or {}, **(headers or {}))
+            for name, value in headers.items():
+                self.send_header(name, value)
+            if body:
+                self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--port', type=int, default=8200)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--rate-limit', type=int, default=100)
+    parser.add_argument('--rate-window', type=float, default=10.0)
+    args = parser.parse_args()
+    server = FakeHubSpot(args.port, args.latency, args.rate_limit, args.rate_window).start()
+    print('Fake HubSpot listening on {}'.format(server.url))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
@@ -0,0 +1,484 @@
+"""
+In-process fakes of the upstreams Hubmetrix calls, for benchmarks and manual testing.
+
+    Faults           latency, jitter, injected 5xx errors and 429s, shared by every fake
+    FakeBigCommerce  OAuth token exchange, store info and webhooks of the v2 API
+    FakeChargebee    subscriptions (list, retrieve, update, cancel, reactivate) and
+                     hosted pages of the v2 API, plus webhook event bodies
+    FakeLambda       stands in for zappa.asynchronous, counting asynchronous invocations
+    UpstreamRouter   sends requests for the real hosts to the fakes
+
+See fake_hubspot.py and fake_dynamodb.py for HubSpot and DynamoDB. The BigCommerce
+and Chargebee clients build their own URLs, so UpstreamRouter rewrites the host of
+every request sent through requests' HTTPAdapter:
+
+    with FakeBigCommerce() as bigcommerce, FakeChargebee() as chargebee:
+        with UpstreamRouter({'api.bigcommerce.com': bigcommerce.url,
+                             'site.chargebee.com': chargebee.url}):
+            ...
+"""
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlsplit, urlunsplit
+
+
+class Faults(object):
+    """
+    Per-request latency (latency +- jitter seconds) and failure injection: a
+    fraction error_rate of requests fail with 500 and throttle_rate with 429.
+    """
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, throttle_rate=0.0, retry_after=1.0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.injected = Counter()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def inject(self):
+        """
+        Sleeps for the request's latency, then returns 'error', 'throttle' or None.
+        """
+        with self._lock:
+            delay = self.latency + (self._random.uniform(-self.jitter, self.jitter) if self.jitter else 0)
+            roll = self._random.random()
+        if delay > 0:
+            time.sleep(delay)
+        fault = None
+        if roll < self.error_rate:
+            fault = 'error'
+        elif roll < self.error_rate + self.throttle_rate:
+            fault = 'throttle'
+        if fault:
+            with self._lock:
+                self.injected[fault] += 1
+        return fault
+
+
+class SlidingWindow(object):
+    """
+    A per-key request limit over a sliding window, like the upstreams' own.
+    """
+    def __init__(self, limit, window):
+        self.limit = limit
+        self.window = window
+        self._sent_at = {}
+        self._lock = threading.Lock()
+
+    def allow(self, key):
+        """
+        Returns (seconds to wait or 0 if allowed, requests left in the window).
+        """
+        now = time.time()
+        with self._lock:
+            sent_at = self._sent_at.setdefault(key, deque())
+            while sent_at and sent_at[0] <= now - self.window:
+                sent_at.popleft()
+            if len(sent_at) >= self.limit:
+                return sent_at[0] + self.window - now, 0
+            sent_at.append(now)
+            return 0, self.limit - len(sent_at)
+
+
+class FakeUpstream(object):
+    """
+    A threaded local HTTP server dispatching to handlers by (method, path regex).
+    Subclasses list their routes as (method, pattern, name) and implement
+    handle_<name>(match, params, body, headers) returning (status, payload) or
+    (status, payload, headers). Requests are counted by route name.
+    """
+    routes = ()
+
+    def __init__(self, port=0, faults=None):
+        self.faults = faults or Faults()
+        self.requests = Counter()
+        self._lock = threading.Lock()
+        self._routes = [(method, re.compile(pattern + '$'), name) for method, pattern, name in self.routes]
+        self._server = _Server(('127.0.0.1', port), _handler(self))
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self._server.server_address[1])
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def dispatch(self, method, path, query, body, headers):
+        for route_method, pattern, name in self._routes:
+            match = pattern.match(path) if route_method == method else None
+            if match:
+                break
+        else:
+            return 404, {'message': 'Unknown path {} {}'.format(method, path)}
+        with self._lock:
+            self.requests[name] += 1
+        fault = self.faults.inject()
+        if fault == 'error':
+            return 500, {'message': 'Injected failure'}
+        if fault == 'throttle':
+            return 429, {'message': 'Injected rate limit'}, {'Retry-After': str(self.faults.retry_after)}
+        params = dict((key, values[-1]) for key, values in parse_qs(query).items())
+        return getattr(self, 'handle_' + name)(match, params, body, headers)
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def _handler(upstream):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def _dispatch(self):
+            path, _, query = self.path.partition('?')
+            body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+            result = upstream.dispatch(self.command, path.rstrip('/') or '/', query, body, self.headers)
+            status, payload = result[:2]
+            headers = result[2] if len(result) > 2 else {}
+            data = json.dumps(payload).encode('utf-8') if payload is not None else b''
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = _dispatch
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+def _form(body):
+    return dict((key, values[-1]) for key, values in parse_qs(body.decode('utf-8')).items())
+
+
+def _json(body):
+    return json.loads(body.decode('utf-8')) if body else {}
+
+
+class FakeBigCommerce(FakeUpstream):
+    """
+    Stores with their info and webhooks. Each store is rate limited like a
+    standard plan (rate_limit requests per rate_window seconds) and responses carry
+    the X-Rate-Limit-* headers.
+    """
+    routes = (('POST', r'/oauth2/token', 'token'),
+              ('GET', r'/stores/(?P<store>[^/]+)/v2/store', 'store'),
+              ('GET', r'/stores/(?P<store>[^/]+)/v2/hooks', 'hooks_list'),
+              ('POST', r'/stores/(?P<store>[^/]+)/v2/hooks', 'hooks_create'),
+              ('PUT', r'/stores/(?P<store>[^/]+)/v2/hooks/(?P<id>\d+)', 'hooks_update'),
+              ('DELETE', r'/stores/(?P<store>[^/]+)/v2/hooks/(?P<id>\d+)', 'hooks_delete'))
+
+    def __init__(self, port=0, faults=None, rate_limit=150, rate_window=30.0):
+        super(FakeBigCommerce, self).__init__(port, faults)
+        self.stores = {}
+        self.limiter = SlidingWindow(rate_limit, rate_window)
+        self._hook_ids = 0
+
+    def add_store(self, store_hash, **info):
+        store = dict(id=store_hash, domain='{}.example.com'.format(store_hash),
+                     secure_url='https://{}.example.com'.format(store_hash), name='Store {}'.format(store_hash),
+                     first_name='Pat', last_name='Owner', admin_email='owner@{}.example.com'.format(store_hash),
+                     phone='555-0100', country_code='US',
+                     address='Store {}\n1 Main St\nAustin, TX 78701\nUnited States'.format(store_hash))
+        store.update(info)
+        with self._lock:
+            self.stores[store_hash] = dict(info=store, hooks={})
+        return store
+
+    def dispatch(self, method, path, query, body, headers):
+        match = re.match(r'/stores/([^/]+)/', path)
+        if not match:
+            return super(FakeBigCommerce, self).dispatch(method, path, query, body, headers)
+        wait, left = self.limiter.allow(match.group(1))
+        limit_headers = {'X-Rate-Limit-Requests-Quota': str(self.limiter.limit),
+                         'X-Rate-Limit-Time-Window-Ms': str(int(self.limiter.window * 1000)),
+                         'X-Rate-Limit-Requests-Left': str(left),
+                         'X-Rate-Limit-Time-Reset-Ms': str(int(wait * 1000))}
+        if wait:
+            with self._lock:
+                self.requests['rate_limited'] += 1
+            return 429, {'status': 429, 'title': 'Too many requests'}, limit_headers
+        result = super(FakeBigCommerce, self).dispatch(method, path, query, body, headers)
+        return result[0], result[1], dict(limit_headers, **(result[2] if len(result) > 2 else {}))
+
+    def _store(self, match):
+        return self.stores.get(match.group('store'))
+
+    def handle_token(self, match, params, body, headers):
+        form = _form(body)
+        store_hash = form.get('context', 'stores/unknown').split('/', 1)[1]
+        if store_hash not in self.stores:
+            self.add_store(store_hash)
+        return 200, {'access_token': 'bc-token-{}'.format(store_hash), 'scope': form.get('scope', ''),
+                     'user': {'id': abs(hash(store_hash)) % 100000, 'email': 'owner@{}.example.com'.format(store_hash)},
+                     'context': form.get('context')}
+
+    def handle_store(self, match, params, body, headers):
+        store = self._store(match)
+        return (200, store['info']) if store else (404, [{'status': 404, 'message': 'Store not found'}])
+
+    def handle_hooks_list(self, match, params, body, headers):
+        store = self._store(match) or dict(hooks={})
+        with self._lock:
+            return 200, sorted(store['hooks'].values(), key=lambda hook: hook['id'])
+
+    def handle_hooks_create(self, match, params, body, headers):
+        store = self._store(match)
+        hook = _json(body)
+        with self._lock:
+            self._hook_ids += 1
+            hook = dict(hook, id=self._hook_ids, store_hash=match.group('store'), is_active=hook.get('is_active', True),
+                        created_at=int(time.time()), updated_at=int(time.time()))
+            store['hooks'][hook['id']] = hook
+        return 201, hook
+
+    def handle_hooks_update(self, match, params, body, headers):
+        store = self._store(match)
+        with self._lock:
+            hook = store['hooks'].get(int(match.group('id')))
+            if hook is None:
+                return 404, [{'status': 404, 'message': 'Hook not found'}]
+            hook.update(_json(body), updated_at=int(time.time()))
+            return 200, dict(hook)
+
+    def handle_hooks_delete(self, match, params, body, headers):
+        store = self._store(match)
+        with self._lock:
+            store['hooks'].pop(int(match.group('id')), None)
+        return 204, None
+
+
+class FakeChargebee(FakeUpstream):
+    """
+    Subscriptions and hosted pages of a Chargebee site. Subscriptions are plain
+    dicts in the v2 API's shape; every change bumps resource_version.
+    """
+    routes = (('GET', r'/api/v2/subscriptions', 'list'),
+              ('GET', r'/api/v2/subscriptions/(?P<id>[^/]+)', 'retrieve'),
+              ('POST', r'/api/v2/subscriptions/(?P<id>[^/]+)', 'update'),
+              ('POST', r'/api/v2/subscriptions/(?P<id>[^/]+)/cancel', 'cancel'),
+              ('POST', r'/api/v2/subscriptions/(?P<id>[^/]+)/reactivate', 'reactivate'),
+              ('POST', r'/api/v2/hosted_pages/checkout_new', 'checkout_new'),
+              ('GET', r'/api/v2/hosted_pages/(?P<id>[^/]+)', 'hosted_page'))
+
+    TERM = 30 * 86400
+
+    def __init__(self, port=0, faults=None):
+        super(FakeChargebee, self).__init__(port, faults)
+        self.subscriptions = {}
+        self.customers = {}
+        self.hosted_pages = {}
+        self._events = 0
+
+    def add_subscription(self, subscription_id, email, bc_store_hash=None, status='active', **values):
+        now = int(time.time())
+        customer_id = 'cust_{}'.format(subscription_id)
+        subscription = dict(id=subscription_id, customer_id=customer_id, plan_id='hubmetrix-base-plan',
+                            plan_unit_price=4900, plan_quantity=1, billing_period=1, billing_period_unit='month',
+                            status=status, current_term_start=now, current_term_end=now + self.TERM,
+                            next_billing_at=now + self.TERM, created_at=now, started_at=now, updated_at=now,
+                            due_invoices_count=0, resource_version=now * 1000, object='subscription')
+        if bc_store_hash:
+            subscription['meta_data'] = {'bc_store_hash': bc_store_hash}
+        subscription.update(values)
+        with self._lock:
+            self.subscriptions[subscription_id] = subscription
+            self.customers[customer_id] = dict(id=customer_id, email=email, object='customer')
+        return subscription
+
+    def event(self, event_type, subscription_id):
+        """
+        The body Chargebee posts to /subscription-events for a change of a subscription.
+        """
+        with self._lock:
+            self._events += 1
+            subscription = dict(self.subscriptions[subscription_id])
+            customer = self.customers[subscription['customer_id']]
+            return json.dumps({'id': 'ev_{}_{}'.format(subscription_id, self._events), 'event_type': event_type,
+                               'occurred_at': int(time.time()), 'object': 'event', 'api_version': 'v2',
+                               'content': {'subscription': subscription, 'customer': customer}})
+
+    def _change(self, subscription, **values):
+        subscription.update(values, updated_at=int(time.time()),
+                            resource_version=max(subscription['resource_version'] + 1, int(time.time() * 1000)))
+
+    def _entry(self, subscription):
+        return {'subscription': dict(subscription), 'customer': dict(self.customers[subscription['customer_id']])}
+
+    def handle_list(self, match, params, body, headers):
+        limit = int(params.get('limit', 10))
+        offset = int(params.get('offset') or 0)
+        email = params.get('email') or params.get('email[is]')
+        with self._lock:
+            matching = [self._entry(subscription) for _, subscription in sorted(self.subscriptions.items())
+                        if email is None or self.customers[subscription['customer_id']]['email'] == email]
+        page = {'list': matching[offset:offset + limit]}
+        if offset + limit < len(matching):
+            page['next_offset'] = str(offset + limit)
+        return 200, page
+
+    def _subscription(self, match):
+        subscription = self.subscriptions.get(match.group('id'))
+        if subscription is None:
+            return None, (404, {'message': 'Subscription not found', 'api_error_code': 'resource_not_found',
+                                'http_status_code': 404})
+        return subscription, None
+
+    def handle_retrieve(self, match, params, body, headers):
+        with self._lock:
+            subscription, error = self._subscription(match)
+            return error or (200, self._entry(subscription))
+
+    def handle_update(self, match, params, body, headers):
+        form = _form(body)
+        with self._lock:
+            subscription, error = self._subscription(match)
+            if error:
+                return error
+            values = {}
+            if 'meta_data' in form:
+                values['meta_data'] = json.loads(form['meta_data'])
+            self._change(subscription, **values)
+            return 200, self._entry(subscription)
+
+    def handle_cancel(self, match, params, body, headers):
+        end_of_term = _form(body).get('end_of_term') == 'true'
+        with self._lock:
+            subscription, error = self._subscription(match)
+            if error:
+                return error
+            if end_of_term:
+                self._change(subscription, status='non_renewing', cancelled_at=subscription['current_term_end'])
+            else:
+                self._change(subscription, status='cancelled', cancelled_at=int(time.time()))
+            return 200, self._entry(subscription)
+
+    def handle_reactivate(self, match, params, body, headers):
+        with self._lock:
+            subscription, error = self._subscription(match)
+            if error:
+                return error
+            self._change(subscription, status='active', cancelled_at=None)
+            subscription.pop('cancelled_at', None)
+            return 200, self._entry(subscription)
+
+    def handle_checkout_new(self, match, params, body, headers):
+        form = _form(body)
+        with self._lock:
+            page_id = 'hp_{}'.format(len(self.hosted_pages) + 1)
+            self.hosted_pages[page_id] = dict(email=form.get('customer[email]'), subscription_id=None)
+        return 200, {'hosted_page': {'id': page_id, 'type': 'checkout_new', 'state': 'created', 'embed': True,
+                                     'url': 'https://example.chargebee.com/pages/v2/{}/checkout'.format(page_id),
+                                     'object': 'hosted_page'}}
+
+    def handle_hosted_page(self, match, params, body, headers):
+        with self._lock:
+            page = self.hosted_pages.get(match.group('id'))
+        if page is None:
+            return 404, {'message': 'Hosted page not found', 'api_error_code': 'resource_not_found'}
+        if page['subscription_id'] is None:
+            page['subscription_id'] = 'sub_{}'.format(match.group('id'))
+            self.add_subscription(page['subscription_id'], page['email'] or 'buyer@example.com')
+        with self._lock:
+            content = self._entry(self.subscriptions[page['subscription_id']])
+        return 200, {'hosted_page': {'id': match.group('id'), 'type': 'checkout_new', 'state': 'succeeded',
+                                     'content': content, 'object': 'hosted_page'}}
+
+
+class FakeLambda(object):
+    """
+    Stands in for zappa.asynchronous. run() counts the asynchronous invocation
+    and, with execute=True, runs it on a background thread like Lambda would.
+    """
+    def __init__(self, execute=False, max_workers=4):
+        self.execute = execute
+        self.invocations = Counter()
+        self.failures = 0
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=max_workers) if execute else None
+
+    def run(self, func, args=None, kwargs=None, **options):
+        with self._lock:
+            self.invocations[func.__name__] += 1
+        if self._pool is not None:
+            self._pool.submit(self._invoke, func, args or [], kwargs or {})
+        return True
+
+    def _invoke(self, func, args, kwargs):
+        try:
+            func(*args, **kwargs)
+        except Exception:
+            with self._lock:
+                self.failures += 1
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+
+
+class UpstreamRouter(object):
+    """
+    Rewrites the scheme and host of requests for the given hosts to local base
+    URLs, by wrapping requests' HTTPAdapter.send for the life of the context.
+    """
+    def __init__(self, routes):
+        self.routes = dict((host, urlsplit(url)) for host, url in routes.items())
+        self.requests = Counter()
+        self._original = None
+
+    def install(self):
+        from requests.adapters import HTTPAdapter
+
+        original = self._original = HTTPAdapter.send
+        router = self
+
+        def send(adapter, request, **kwargs):
+            parts = urlsplit(request.url)
+            target = router.routes.get(parts.hostname)
+            if target is not None:
+                router.requests[parts.hostname] += 1
+                request.url = urlunsplit((target.scheme, target.netloc, parts.path, parts.query, parts.fragment))
+            return original(adapter, request, **kwargs)
+
+        HTTPAdapter.send = send
+        return self
+
+    def uninstall(self):
+        from requests.adapters import HTTPAdapter
+
+        if self._original is not None:
+            HTTPAdapter.send = self._original
+            self._original = None
+
+    def __enter__(self):
+        return self.install()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.uninstall()
@@ -0,0 +1,72 @@
+"""
+Builds the static assets and pre-rendered pages the app serves, see static_utils.
+
+    python build_static.py [--static-url https://cdn.example.com/static] [--upload BUCKET [--prefix static]]
+
+Run it before each deploy with the deploy's environment (APP_URL, STAGE-PREFIX,
+HS_CLIENT_ID, ...) since the pre-rendered pages embed it. With --upload the
+fingerprinted assets are also copied to the bucket --static-url serves.
+"""
+import argparse
+import json
+import logging
+import os
+
+# Render the pages from the templates, not from a previous build.
+os.environ['STATIC_ASSETS_ENABLED'] = '0'
+
+from hubmetrix import app  # noqa: E402
+from static_utils import STATIC_BUILD_DIR, STATIC_SOURCE_DIR, STATIC_URL, build_static, upload_static  # noqa: E402
+
+
+def _size(path):
+    return os.path.getsize(path) if os.path.exists(path) else None
+
+
+def report(manifest, out_dir):
+    static_dir = os.path.join(out_dir, 'static')
+    rows = []
+    for name, built in sorted(manifest['assets'].items()):
+        path = os.path.join(static_dir, built)
+        sizes = [os.path.getsize(os.path.join(STATIC_SOURCE_DIR, name)), _size(path),
+                 _size(path + '.gz'), _size(path + '.br')]
+        for suffix in ('.webp', '.avif'):
+            variant = manifest['images'].get(name, {}).get(suffix)
+            sizes.append(_size(os.path.join(static_dir, variant)) if variant else None)
+        rows.append([built] + sizes)
+    print('{:<58} {:>9} {:>9} {:>9} {:>9} {:>9} {:>9}'.format('asset', 'source', 'built', 'gzip', 'brotli',
+                                                             'webp', 'avif'))
+    for row in rows:
+        print('{:<58} {:>9} {:>9} {:>9} {:>9} {:>9} {:>9}'.format(*[value if value is not None else '-'
+                                                                   for value in row]))
+    source = sum(row[1] for row in rows)
+    smallest = sum(min(value for value in row[2:] if value is not None) for row in rows)
+    print('{} assets, {} bytes -> {} bytes at their smallest encoding; pages: {}'.format(
+        len(rows), source, smallest, ', '.join(sorted(manifest['pages']))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--out', default=STATIC_BUILD_DIR, help='build directory (default: %(default)s)')
+    parser.add_argument('--static-url', default=STATIC_URL,
+                        help='absolute URL pages link assets from; empty links the app\'s /static route')
+    parser.add_argument('--base-url', help='public URL of the app the pages are rendered for '
+                                           '(default: APP_URL + STAGE-PREFIX)')
+    parser.add_argument('--upload', metavar='BUCKET', help='S3 bucket to copy the fingerprinted assets to')
+    parser.add_argument('--prefix', default='', help='key prefix in the bucket')
+    parser.add_argument('--json', action='store_true', help='print the manifest instead of the size report')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format='%(levelname)s %(message)s')
+    manifest = build_static(app, args.out, args.static_url.rstrip('/'), args.base_url)
+    if args.json:
+        print(json.dumps(manifest, indent=2, sort_keys=True))
+    else:
+        report(manifest, args.out)
+    if args.upload:
+        print('Uploaded {} new assets to s3://{}/{}'.format(upload_static(args.upload, args.prefix, args.out),
+                                                             args.upload, args.prefix))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+from flask import copy_current_request_context, has_request_context
+from werkzeug.exceptions import GatewayTimeout
+
+from timing_utils import bind_request_timings
+
+__all__ = ['FanOut', 'fan_out', 'submit_step']
+
+FANOUT_MAX_WORKERS = int(os.environ.get('FANOUT_MAX_WORKERS', 8))
+FANOUT_STEP_TIMEOUT = float(os.environ.get('FANOUT_STEP_TIMEOUT', 10))
+
+executor = ThreadPoolExecutor(max_workers=FANOUT_MAX_WORKERS)
+
+
+def submit_step(func, *args, **kwargs):
+    """
+    Runs func on the shared pool with a copy of the request context, if any. Steps must
+    not load or save AppUser items through the unit of work.
+    """
+    if has_request_context():
+        func = copy_current_request_context(func)
+    return executor.submit(bind_request_timings(func), *args, **kwargs)
+
+
+class FanOut(object):
+    """
+    A set of independent steps started together. Each result is awaited lazily,
+    so a speculative step only costs latency if the caller actually needs it.
+    """
+    def __init__(self, steps, timeout=FANOUT_STEP_TIMEOUT):
+        self.started_at = time.monotonic()
+        self._timeouts = {}
+        self._futures = {}
+        for name, step in steps.items():
+            step_timeout = timeout
+            if isinstance(step, tuple):
+                step, step_timeout = step
+            self._timeouts[name] = step_timeout
+            self._futures[name] = submit_step(step)
+
+    def result(self, name):
+        remaining = self.started_at + self._timeouts[name] - time.monotonic()
+        try:
+            return self._futures[name].result(timeout=max(remaining, 0))
+        except FutureTimeoutError:
+            self._futures[name].cancel()
+            raise GatewayTimeout('Step {} did not finish within {}s'.format(name, self._timeouts[name]))
+
+    def results(self):
+        return dict((name, self.result(name)) for name in self._futures)
+
+    def cancel(self):
+        for future in self._futures.values():
+            future.cancel()
+
+
+def fan_out(timeout=FANOUT_STEP_TIMEOUT, **steps):
+    """
+    Starts each keyword step concurrently. A step is a zero argument callable, or a
+    (callable, timeout) tuple to override the default per-step timeout.
+    """
+    return FanOut(steps, timeout=timeout)
@@ -0,0 +1,165 @@
+import os
+import threading
+import time
+
+from cache_utils import TTLCache
+from dynamodb_utils import ContactIndex
+from http_utils import get_http_session
+from hubspot_utils import HS_CONTACTS_URI, bearer_headers
+
+__all__ = ['ContactResolver', 'contact_email']
+
+CONTACT_INDEX_CACHE_TTL = int(os.environ.get('CONTACT_INDEX_CACHE_TTL', 86400))
+CONTACT_INDEX_CACHE_MAX_SIZE = int(os.environ.get('CONTACT_INDEX_CACHE_MAX_SIZE', 100000))
+CONTACT_MISS_CACHE_TTL = int(os.environ.get('CONTACT_MISS_CACHE_TTL', 300))
+CONTACT_LOOKUP_BATCH_SIZE = 100
+CONTACT_FILL_PAGE_SIZE = 100
+
+# Cached in place of a vid for emails with no known contact; vids start at 1.
+_NO_CONTACT = 0
+
+
+def contact_email(contact):
+    """
+    The primary email of a contact record from the v1 contacts API, lower cased.
+    """
+    email = ((contact.get('properties') or {}).get('email') or {}).get('value')
+    if not email:
+        for profile in contact.get('identity-profiles') or []:
+            for identity in profile.get('identities') or []:
+                if identity.get('type') == 'EMAIL' and identity.get('is-primary', True):
+                    email = identity.get('value')
+                    break
+            if email:
+                break
+    return (email or '').strip().lower() or None
+
+
+class ContactResolver(object):
+    """
+    Maps emails to HubSpot contact vids per portal, through an in-process LRU, then the
+    ContactIndex table, then HubSpot. Misses are remembered for miss_ttl seconds.
+    """
+    def __init__(self, ttl=CONTACT_INDEX_CACHE_TTL, max_size=CONTACT_INDEX_CACHE_MAX_SIZE,
+                 miss_ttl=CONTACT_MISS_CACHE_TTL):
+        self._cache = TTLCache(max_size=max_size, ttl=ttl)
+        self.miss_ttl = miss_ttl
+        self._lock = threading.Lock()
+        self.cache_hits = 0
+        self.index_hits = 0
+        self.hubspot_hits = 0
+        self.unknown = 0
+
+    def resolve(self, portal, access_token, emails, lookup=True):
+        """
+        Returns a dict of email to vid for the emails that have a contact. With
+        lookup=False, e.g. once the portal's contacts were filled into the index,
+        emails missing from the index aren't looked up in HubSpot.
+        """
+        vids = {}
+        missing = []
+        cached_misses = 0
+        for email in set(emails):
+            vid = self._cache.get((portal, email))
+            if vid is None:
+                missing.append(email)
+            elif vid == _NO_CONTACT:
+                cached_misses += 1
+            else:
+                vids[email] = vid
+        cache_hits = len(vids) + cached_misses
+
+        found = self._from_index(portal, missing) if missing else {}
+        index_hits = len(found)
+        missing = [email for email in missing if email not in found]
+        if missing and lookup:
+            from_hubspot = self._from_hubspot(access_token, missing)
+            self._store(portal, from_hubspot)
+            found.update(from_hubspot)
+
+        for email, vid in found.items():
+            self._cache.set((portal, email), vid)
+        for email in missing:
+            if email not in found:
+                self._cache.set((portal, email), _NO_CONTACT, ttl=self.miss_ttl)
+        vids.update(found)
+        with self._lock:
+            self.cache_hits += cache_hits
+            self.index_hits += index_hits
+            self.hubspot_hits += len(found) - index_hits
+            self.unknown += cached_misses + len(missing) - (len(found) - index_hits)
+        return vids
+
+    def learn(self, portal, access_token, emails):
+        """
+        Looks up and indexes contacts that were just written by email, and so may
+        have been created. Returns a dict of email to vid for those found.
+        """
+        found = self._from_hubspot(access_token, sorted(set(emails)))
+        self._store(portal, found)
+        for email, vid in found.items():
+            self._cache.set((portal, email), vid)
+        return found
+
+    def forget(self, portal, email):
+        """
+        Drops a vid HubSpot no longer accepts, e.g. after contacts were merged.
+        """
+        self._cache.invalidate((portal, email))
+        ContactIndex(portal, email).delete()
+
+    def fill(self, portal, access_token, offset=None, deadline=None):
+        """
+        Pages through the portal's contacts into the index, starting from offset
+        (a vidOffset from a previous call). Returns the offset to resume from when
+        the deadline passes first, or None once every contact is indexed.
+        """
+        session = get_http_session('hubspot')
+        while deadline is None or time.time() < deadline:
+            params = {'count': CONTACT_FILL_PAGE_SIZE, 'property': 'email'}
+            if offset:
+                params['vidOffset'] = offset
+            response = session.get(HS_CONTACTS_URI + '/lists/all/contacts/all', params=params,
+                                   headers=bearer_headers(access_token))
+            response.raise_for_status()
+            page = response.json()
+            found = {}
+            for contact in page.get('contacts', []):
+                email = contact_email(contact)
+                if email:
+                    found[email] = contact['vid']
+            self._store(portal, found)
+            if not page.get('has-more'):
+                return None
+            offset = page['vid-offset']
+        return offset
+
+    def stats(self):
+        with self._lock:
+            return dict(cache_hits=self.cache_hits, index_hits=self.index_hits, hubspot_hits=self.hubspot_hits,
+                        unknown=self.unknown)
+
+    def _from_index(self, portal, emails):
+        return dict((item.email, item.vid) for item in
+                    ContactIndex.batch_get([(portal, email) for email in emails]))
+
+    def _from_hubspot(self, access_token, emails):
+        found = {}
+        session = get_http_session('hubspot')
+        for start in range(0, len(emails), CONTACT_LOOKUP_BATCH_SIZE):
+            params = [('email', email) for email in emails[start:start + CONTACT_LOOKUP_BATCH_SIZE]]
+            response = session.get(HS_CONTACTS_URI + '/contact/emails/batch/', params=params + [('property', 'email')],
+                                   headers=bearer_headers(access_token))
+            response.raise_for_status()
+            for contact in response.json().values():
+                email = contact_email(contact)
+                if email:
+                    found[email] = contact['vid']
+        return found
+
+    def _store(self, portal, vids):
+        if not vids:
+            return
+        with ContactIndex.batch_write() as batch:
+            for email, vid in vids.items():
+                batch.save(ContactIndex(portal, email, vid=vid))
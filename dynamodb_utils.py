@@ -1,13 +1,33 @@
-from pynamodb.attributes import UnicodeAttribute, NumberAttribute, ListAttribute, BooleanAttribute
+import copy
+
+from pynamodb.attributes import UnicodeAttribute, NumberAttribute, ListAttribute, BooleanAttribute, BinaryAttribute
 from pynamodb.exceptions import QueryError
 from pynamodb.models import Model
 
-__all__ = ['AppUser', 'get_query_first_result', 'QueryError']
+__all__ = ['AppUser', 'AppUserUnitOfWork', 'BackfillRange', 'ContactIndex', 'CustomerMetrics', 'IngestQueueItem',
+           'MetricsPartial', 'SubscriptionEvent', 'get_query_first_result', 'QueryError']
+
+
+def changed_attributes(snapshot, current):
+    names = set(snapshot) | set(current)
+    return sorted(name for name in names if snapshot.get(name) != current.get(name))
+
+
+def update_changed_attributes(user, names):
+    """
+    Writes the named attributes of user in one UpdateItem, removing those set to None.
+    """
+    actions = []
+    for name in names:
+        attribute = getattr(type(user), name)
+        value = user.attribute_values.get(name)
+        actions.append(attribute.remove() if value is None else attribute.set(value))
+    user.update(actions=actions)
 
 
 def get_query_first_result(model, query_text):
     try:
-        for response in model.query(query_text):
+        for response in model.query(query_text, limit=1):
             return response
     except QueryError:
         return None
@@ -41,6 +61,294 @@ class AppUser(Model):
     hs_user_id = UnicodeAttribute(null=True)
     hs_scopes = ListAttribute(null=True)
     hs_properties_exist = BooleanAttribute(default=False)
+    hs_properties_version = UnicodeAttribute(null=True)
+    hs_contact_index_offset = NumberAttribute(null=True)
+    hs_contact_index_filled_at = NumberAttribute(null=True)
     hs_access_token_timestamp = UnicodeAttribute(null=True)
+    hs_access_token_expires_at = NumberAttribute(null=True)
+    hs_token_refresh_lease = NumberAttribute(null=True)
     cb_subscription_id = UnicodeAttribute(null=True)
+    cb_subscription_status = UnicodeAttribute(null=True)
+    cb_subscription_version = NumberAttribute(null=True)
     hm_last_sync_timestamp = UnicodeAttribute(null=True)
+    hm_customer_sync_timestamp = UnicodeAttribute(null=True)
+    hm_backfill_started_at = NumberAttribute(null=True)
+    hm_backfill_planned_at = NumberAttribute(null=True)
+    hm_backfill_slice_at = NumberAttribute(null=True)
+    hm_backfill_completed_at = NumberAttribute(null=True)
+    hm_backfill_merged_email = UnicodeAttribute(null=True)
+    hm_recompute_started_at = NumberAttribute(null=True)
+    hm_recompute_planned_at = NumberAttribute(null=True)
+    hm_recompute_slice_at = NumberAttribute(null=True)
+    hm_recompute_completed_at = NumberAttribute(null=True)
+    hm_recompute_merged_email = UnicodeAttribute(null=True)
+
+    @classmethod
+    def from_raw_data(cls, data):
+        user = super(AppUser, cls).from_raw_data(data)
+        user._loaded_values = copy.deepcopy(user.attribute_values)
+        return user
+
+    @classmethod
+    def from_values(cls, values):
+        """
+        Rebuilds an item from attribute values that were read earlier, e.g. cached.
+        """
+        user = cls(**copy.deepcopy(values))
+        user._loaded_values = copy.deepcopy(values)
+        return user
+
+    def update(self, actions, condition=None, **kwargs):
+        """
+        Model.update() replaces attribute_values with the item it returns; changes
+        made locally and not yet written are put back on top of it, unless the
+        update itself wrote them.
+        """
+        loaded = getattr(self, '_loaded_values', None)
+        pending = {}
+        if loaded is not None:
+            written = set(action.values[0].path[0] for action in actions)
+            pending = dict((name, self.attribute_values.get(name))
+                           for name in changed_attributes(loaded, self.attribute_values) if name not in written)
+        data = super(AppUser, self).update(actions, condition=condition, **kwargs)
+        self._loaded_values = copy.deepcopy(self.attribute_values)
+        for name, value in pending.items():
+            setattr(self, name, value)
+        return data
+
+    def save_changes(self):
+        """
+        Writes only the attributes changed since the item was read, so conditional
+        updates other workers made to the rest of it (watermarks, token lease,
+        backfill markers) survive. Items that were never read are put whole.
+        """
+        loaded = getattr(self, '_loaded_values', None)
+        if loaded is None:
+            self.save()
+        else:
+            changed = changed_attributes(loaded, self.attribute_values)
+            if changed:
+                update_changed_attributes(self, changed)
+        self._loaded_values = copy.deepcopy(self.attribute_values)
+
+    @classmethod
+    def find(cls, bc_store_hash, bc_id, attributes=None, consistent_read=False):
+        """
+        Point read by full primary key. Returns None when the item does not exist.
+        """
+        try:
+            return cls.get(bc_store_hash, bc_id, consistent_read=consistent_read, attributes_to_get=attributes)
+        except cls.DoesNotExist:
+            return None
+
+    @classmethod
+    def find_by_store_hash(cls, bc_store_hash, attributes=None, consistent_read=False):
+        """
+        Reads the single item for a store with a Limit=1 Query. Items loaded with a
+        projection are partial and must never be save()d.
+        """
+        for user in cls.query(bc_store_hash, limit=1, attributes_to_get=attributes,
+                              consistent_read=consistent_read):
+            return user
+        return None
+
+
+class CustomerMetrics(Model):
+    """
+    The sales metrics last pushed to HubSpot for one customer of a store
+    """
+    class Meta:
+        table_name = 'hubmetrix-customer-metrics'
+        region = 'us-west-1'
+
+    bc_store_hash = UnicodeAttribute(hash_key=True)
+    email = UnicodeAttribute(range_key=True)
+    order_count = NumberAttribute(default=0)
+    total_revenue = NumberAttribute(default=0)
+    average_order_value = NumberAttribute(default=0)
+    first_order_at = NumberAttribute(null=True)
+    last_order_at = NumberAttribute(null=True)
+    purchase_frequency_days = NumberAttribute(null=True)
+    orders_30_days = NumberAttribute(default=0)
+    revenue_30_days = NumberAttribute(default=0)
+    orders_90_days = NumberAttribute(default=0)
+    revenue_90_days = NumberAttribute(default=0)
+    orders_365_days = NumberAttribute(default=0)
+    revenue_365_days = NumberAttribute(default=0)
+    rolling = BinaryAttribute(null=True, legacy_encoding=False)
+    synced_at = NumberAttribute(null=True)
+
+
+class BackfillRange(Model):
+    """
+    Checkpoint for one order id range of a store's historical backfill or recompute
+    """
+    class Meta:
+        table_name = 'hubmetrix-backfill'
+        region = 'us-west-1'
+
+    bc_store_hash = UnicodeAttribute(hash_key=True)
+    range_start = NumberAttribute(range_key=True)
+    range_end = NumberAttribute()
+    next_id = NumberAttribute()
+    done = BooleanAttribute(default=False)
+    lease_owner = UnicodeAttribute(null=True)
+    lease_until = NumberAttribute(default=0)
+    orders = NumberAttribute(default=0)
+    expires_at = NumberAttribute(null=True)
+
+
+class MetricsPartial(Model):
+    """
+    One page of orders' share of a customer's metrics, staged by a backfill or recompute run
+    """
+    class Meta:
+        table_name = 'hubmetrix-metrics-partials'
+        region = 'us-west-1'
+
+    run = UnicodeAttribute(hash_key=True)
+    chunk = UnicodeAttribute(range_key=True)
+    email = UnicodeAttribute()
+    order_count = NumberAttribute(default=0)
+    amount = NumberAttribute(default=0)
+    first_order_at = NumberAttribute(null=True)
+    last_order_at = NumberAttribute(null=True)
+    rolling = BinaryAttribute(null=True, legacy_encoding=False)
+    expires_at = NumberAttribute()
+
+
+class ContactIndex(Model):
+    """
+    The HubSpot contact vid of an email address in one portal
+    """
+    class Meta:
+        table_name = 'hubmetrix-contact-index'
+        region = 'us-west-1'
+
+    hs_portal = UnicodeAttribute(hash_key=True)
+    email = UnicodeAttribute(range_key=True)
+    vid = NumberAttribute()
+
+
+class IngestQueueItem(Model):
+    """
+    A queued webhook event. Events are spread over a few shard partitions and sort
+    by when they were queued, so the oldest visible ones are read with one Query
+    per shard.
+    """
+    class Meta:
+        table_name = 'hubmetrix-ingest-queue'
+        region = 'us-west-1'
+
+    queue = UnicodeAttribute(hash_key=True)
+    event_id = UnicodeAttribute(range_key=True)
+    kind = UnicodeAttribute()
+    bc_store_hash = UnicodeAttribute()
+    payload = UnicodeAttribute()
+    enqueued_at = NumberAttribute()
+    claimed_until = NumberAttribute(default=0)
+    expires_at = NumberAttribute()
+
+
+class SubscriptionEvent(Model):
+    """
+    A Chargebee webhook event, recorded once per event id and processed off the request
+    """
+    class Meta:
+        table_name = 'hubmetrix-subscription-events'
+        region = 'us-west-1'
+
+    event_id = UnicodeAttribute(hash_key=True)
+    event_type = UnicodeAttribute()
+    occurred_at = NumberAttribute(null=True)
+    content = UnicodeAttribute()
+    received_at = NumberAttribute()
+    lease_until = NumberAttribute(default=0)
+    attempts = NumberAttribute(default=0)
+    processed_at = NumberAttribute(null=True)
+    outcome = UnicodeAttribute(null=True)
+    expires_at = NumberAttribute()
+
+
+class AppUserUnitOfWork(object):
+    """
+    Identity map for the AppUser items of one request, each loaded at most once and
+    written back with only its changed attributes when flushed.
+    """
+    def __init__(self, cache=None):
+        self.cache = cache
+        self._identity_map = {}
+        self._new = set()
+
+    def get(self, bc_store_hash):
+        if bc_store_hash in self._identity_map:
+            return self._identity_map[bc_store_hash]
+
+        values = self.cache.get(bc_store_hash) if self.cache is not None else None
+        if values is not None:
+            user = AppUser.from_values(values)
+        else:
+            user = AppUser.find_by_store_hash(bc_store_hash, consistent_read=True)
+        if user:
+            self._track(user)
+        return user
+
+    def add(self, user):
+        self._identity_map[user.bc_store_hash] = user
+        self._new.add(user.bc_store_hash)
+        return user
+
+    def delete(self, user):
+        self.forget(user)
+        user.delete()
+
+    def forget(self, user):
+        self._identity_map.pop(user.bc_store_hash, None)
+        self._new.discard(user.bc_store_hash)
+        if self.cache is not None:
+            self.cache.invalidate(user.bc_store_hash)
+
+    def peek(self, bc_store_hash):
+        """
+        The item if this request already loaded it. The container cache is not
+        consulted, so callers reading only a few attributes get them fresh.
+        """
+        return self._identity_map.get(bc_store_hash)
+
+    def mark_persisted(self, user, names):
+        """
+        Records attributes that were already written by a conditional update so the
+        flush does not write them again.
+        """
+        loaded = getattr(user, '_loaded_values', None)
+        if loaded is None or user.bc_store_hash in self._new:
+            return
+        for name in names:
+            loaded[name] = copy.deepcopy(user.attribute_values.get(name))
+
+    def is_tracked(self, user):
+        return self._identity_map.get(user.bc_store_hash) is user
+
+    def dirty_attributes(self, user):
+        return changed_attributes(getattr(user, '_loaded_values', None) or {}, user.attribute_values)
+
+    def mark_clean(self, user):
+        user._loaded_values = copy.deepcopy(user.attribute_values)
+        if self.cache is not None:
+            self.cache.set(user.bc_store_hash, copy.deepcopy(user.attribute_values))
+
+    def flush(self):
+        for bc_store_hash, user in list(self._identity_map.items()):
+            if bc_store_hash in self._new:
+                user.save()
+                self._new.discard(bc_store_hash)
+            else:
+                dirty = self.dirty_attributes(user)
+                if not dirty:
+                    continue
+                update_changed_attributes(user, dirty)
+            self.mark_clean(user)
+
+    def _track(self, user):
+        self._identity_map[user.bc_store_hash] = user
+        self.mark_clean(user)
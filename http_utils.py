@@ -0,0 +1,85 @@
+import os
+import threading
+import weakref
+from collections import defaultdict
+
+from import_utils import lazy_import
+from ratelimit_utils import RateLimitedAdapter
+from timing_utils import TimedAdapter
+
+__all__ = ['get_http_session', 'register_http_session', 'get_pool_stats']
+
+requests = lazy_import('requests')
+requests_adapters = lazy_import('requests.adapters')
+
+HTTP_POOL_CONNECTIONS = int(os.environ.get('HTTP_POOL_CONNECTIONS', 4))
+HTTP_POOL_MAXSIZE = int(os.environ.get('HTTP_POOL_MAXSIZE', 16))
+
+_shared_sessions = {}
+_registered_sessions = weakref.WeakValueDictionary()
+_request_counts = defaultdict(int)
+_lock = threading.Lock()
+_create_lock = threading.Lock()
+
+
+def get_http_session(upstream):
+    """
+    Returns the container wide keep-alive session for an upstream, e.g. 'hubspot'.
+    """
+    session = _shared_sessions.get(upstream)
+    if session is None:
+        with _create_lock:
+            session = _shared_sessions.get(upstream)
+            if session is None:
+                session = register_http_session(upstream, requests.Session())
+                _shared_sessions[upstream] = session
+    return session
+
+
+def register_http_session(upstream, session, key=None):
+    """
+    Mounts a pooled, rate limited and timed adapter on a session owned elsewhere
+    (such as a BigCommerce client's) and tracks it under its upstream for
+    get_pool_stats(). key selects the rate limit bucket, e.g. the store hash.
+    """
+    adapter = TimedAdapter(RateLimitedAdapter(requests_adapters.HTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS,
+                                                                            pool_maxsize=HTTP_POOL_MAXSIZE),
+                                              upstream, key), upstream)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.hooks['response'].append(_count_response(upstream))
+    with _lock:
+        _registered_sessions[(upstream, key)] = session
+    return session
+
+
+def get_pool_stats():
+    stats = {}
+    with _lock:
+        sessions = list(_registered_sessions.items())
+        counts = dict(_request_counts)
+    for (upstream, _), session in sessions:
+        upstream_stats = stats.setdefault(upstream, dict(sessions=0, requests=counts.get(upstream, 0), pools=[]))
+        upstream_stats['sessions'] += 1
+        for adapter in set(session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for pool_key in pools.keys():
+                pool = pools.get(pool_key)
+                if pool is None:
+                    continue
+                upstream_stats['pools'].append(dict(host=pool.host,
+                                                    connections_opened=pool.num_connections,
+                                                    requests=pool.num_requests,
+                                                    idle=pool.pool.qsize() if pool.pool else 0))
+    for upstream, count in counts.items():
+        stats.setdefault(upstream, dict(sessions=0, requests=count, pools=[]))
+    return stats
+
+
+def _count_response(upstream):
+    def hook(response, *args, **kwargs):
+        with _lock:
+            _request_counts[upstream] += 1
+        return response
+
+    return hook
@@ -12,16 +12,24 @@ app.config['APP_URL'] = os.environ.get('APP_URL', 'http://localhost')
 app.config['APP_BACKEND_URL'] = os.environ.get('APP_BACKEND_URL', 'http://localhost/backend')
 app.config['BC_CLIENT_ID'] = os.environ.get('BC_CLIENT_ID', '')
 app.config['BC_CLIENT_SECRET'] = os.environ.get('BC_CLIENT_SECRET', '')
+app.config['BC_WEBHOOK_SECRET'] = os.environ.get('BC_WEBHOOK_SECRET', '')
 app.config['SESSION_SECRET'] = os.environ.get('SESSION_SECRET')
 app.config['HS_REDIRECT_URI'] = os.environ.get('APP_URL', '') + app.config['STAGE-PREFIX'] + '/hsauth'
 app.config['HS_CLIENT_ID'] = os.environ.get('HS_CLIENT_ID', '')
 app.config['HS_CLIENT_SECRET'] = os.environ.get('HS_CLIENT_SECRET', '')
 app.config['CHARGEBEE-API-KEY'] = os.environ.get('CHARGEBEE-API-KEY', '')
 app.config['CHARGEBEE-SITE'] = os.environ.get('CHARGEBEE-SITE', '')
+app.config['CHARGEBEE-WEBHOOK-USERNAME'] = os.environ.get('CHARGEBEE-WEBHOOK-USERNAME', '')
+app.config['CHARGEBEE-WEBHOOK-PASSWORD'] = os.environ.get('CHARGEBEE-WEBHOOK-PASSWORD', '')
 app.config['APP_ID'] = os.environ.get('APP_ID')
 
 app.secret_key = app.config['SESSION_SECRET']
 
+install_dynamodb_timing()
+install_request_timing(app)
+
+zappa_async = lazy_import('zappa.asynchronous')
+
 
 #
 # Error handling and helpers
@@ -51,11 +59,19 @@ def bad_request(e):
     return content, 400
 
 
+@app.after_request
+def flush_unit_of_work(response):
+    flush_app_users()
+    return response
+
+
 @app.route('/')
 def index():
     bc_store_hash = session['storehash']
-    app_user = get_query_first_result(AppUser, bc_store_hash)
-    sub = get_chargebee_subscription_by_id(app_user.cb_subscription_id, config=app.config)
+    app_user = get_app_user_fields(bc_store_hash, 'cb_subscription_id', 'cb_subscription_version',
+                                   'hm_last_sync_timestamp')
+    sub = get_cached_chargebee_subscription(app_user.cb_subscription_id, app.config,
+                                            min_version=app_user.cb_subscription_version)
     if sub.status == 'cancelled':
         return redirect(url_for('maybe_reactivate_plan'))
 
@@ -77,7 +93,7 @@ def index():
 def load():
     with payload_manager(request.args, app.config) as payload_ctx:
         bc_store_hash, bc_email = payload_ctx
-        app_user = get_query_first_result(AppUser, bc_store_hash)
+        app_user = get_app_user(bc_store_hash)
 
         session['storehash'] = bc_store_hash
         session.permanent = True
@@ -85,13 +101,16 @@ def load():
         if not app_user.hs_access_token:
             return redirect(app.config['APP_URL'] + url_for('get_started'))
 
-        if check_and_provision_subscription(app_user, app.config):
+        lookups = start_provisioning_lookups(app_user, app.config)
+        if provision_subscription(app_user, lookups.result('subscription'), app.config):
+            lookups.cancel()
             return redirect(app.config['APP_URL'] + url_for('index'))
 
         app_url = app.config['APP_URL']
         stage = app.config['STAGE-PREFIX']
-        store_info = get_bc_store_info(app_user, app.config)
-        signup_page_id, signup_page_url = construct_chargebee_signup_url(store_info, app_url, config=app.config)
+        store_details = lookups.result('store_details')
+        signup_page_id, signup_page_url = construct_chargebee_signup_url(store_details.store_info, app_url,
+                                                                         store_details.address, config=app.config)
         session['hosted_page_id'] = signup_page_id
         return render_template('success_hubspot.html', chargebee_hosted_url=signup_page_url, app_url=app_url+stage+'/')
 
@@ -121,11 +140,12 @@ def uninstall():
     with payload_manager(request.args, app.config) as payload_ctx:
         bc_store_hash, bc_email = payload_ctx
 
-    app_user = get_query_first_result(AppUser, bc_store_hash)
+    app_user = get_app_user(bc_store_hash)
 
     delete_all_webhooks(app_user, app.config)
 
-    app_user.delete()
+    delete_app_user(app_user)
+    invalidate_bc_store_details(bc_store_hash)
 
     return Response('Deleted', status=204)
 
@@ -142,13 +162,16 @@ def hs_auth_callback():
         bc_store_hash = session['storehash']
 
         with app_user_hubspot_token_manager(bc_store_hash, hubspot_auth_ctx) as app_user:
-            if check_and_provision_subscription(app_user, app.config):
+            lookups = start_provisioning_lookups(app_user, app.config)
+            if provision_subscription(app_user, lookups.result('subscription'), app.config):
+                lookups.cancel()
                 return redirect(app.config['APP_URL'] + url_for('index'))
 
-            app_user.save()
+            save_app_user(app_user)
             app_url = app.config['APP_URL']
-            store_info = get_bc_store_info(app_user, app.config)
-            signup_page_id, signup_page_url = (construct_chargebee_signup_url(store_info, app_url,
+            store_details = lookups.result('store_details')
+            signup_page_id, signup_page_url = (construct_chargebee_signup_url(store_details.store_info, app_url,
+                                                                              store_details.address,
                                                                               config=app.config))
             session['hosted_page_id'] = signup_page_id
         return render_template('success_hubspot.html', chargebee_hosted_url=signup_page_url)
@@ -158,18 +181,20 @@ def hs_auth_callback():
 def payment_success():
     bc_store_hash = session['storehash']
     hosted_page_id = session['hosted_page_id']
-    app_user = get_query_first_result(AppUser, bc_store_hash)
-    store_info = get_bc_store_info(app_user, app.config)
-    cb_subscription = get_chargebee_hosted_page(hosted_page_id, config=app.config)
+    app_user = get_app_user(bc_store_hash)
+    lookups = fan_out(store_info=lambda: get_bc_store_info(app_user, app.config),
+                      hosted_page=lambda: get_chargebee_hosted_page(hosted_page_id, config=app.config))
+    cb_subscription = lookups.result('hosted_page')
     cb_subscription_id = cb_subscription.content.subscription.id
     update_chargebee_subscription_with_meta_data(cb_subscription_id, bc_store_hash, config=app.config)
     app_user.cb_subscription_id = cb_subscription_id
 
-    app_user.save()
+    save_app_user(app_user)
     register_or_activate_bc_webhooks(app_user, app.config)
+    start_backfill(bc_store_hash)
 
     app_id = app.config['APP_ID']
-    secure_url = store_info['secure_url']
+    secure_url = lookups.result('store_info')['secure_url']
 
     redirect_url = '{}/manage/app/{}'.format(secure_url, app_id)
     return redirect(redirect_url)
@@ -183,7 +208,7 @@ def maybe_cancel_plan():
 @app.route('/cancelplan')
 def cancel_plan():
     bc_store_hash = session['storehash']
-    app_user = get_query_first_result(AppUser, bc_store_hash)
+    app_user = get_app_user_fields(bc_store_hash, 'cb_subscription_id')
     subscription_id = app_user.cb_subscription_id
 
     cancelled_sub = cancel_chargebee_subscription_by_id(subscription_id, config=app.config)
@@ -195,8 +220,9 @@ def cancel_plan():
 @app.route('/planinfo')
 def plan_info():
     bc_store_hash = session['storehash']
-    app_user = get_query_first_result(AppUser, bc_store_hash)
-    sub = get_chargebee_subscription_by_id(app_user.cb_subscription_id, config=app.config)
+    app_user = get_app_user_fields(bc_store_hash, 'cb_subscription_id', 'cb_subscription_version')
+    sub = get_cached_chargebee_subscription(app_user.cb_subscription_id, app.config,
+                                            min_version=app_user.cb_subscription_version)
     start = pendulum.from_timestamp(sub.current_term_start).to_date_string() if sub.current_term_start else 'In Trial'
     end = pendulum.from_timestamp(sub.current_term_end).to_date_string() if sub.current_term_end else 'In Trial'
 
@@ -219,7 +245,7 @@ def maybe_reactivate_plan():
 @app.route('/reactivateplan')
 def reactivate_plan():
     bc_store_hash = session['storehash']
-    app_user = get_query_first_result(AppUser, bc_store_hash)
+    app_user = get_app_user(bc_store_hash)
     reactivated_sub = reactivate_chargebee_subscription_by_id(app_user.cb_subscription_id, config=app.config)
     if reactivated_sub.status == 'active':
         register_or_activate_bc_webhooks(app_user, app.config)
@@ -228,15 +254,25 @@ def reactivate_plan():
 
 
 @app.route('/subscription-events', methods=['POST'])
-def subscription_cancelled():
-    data = json.loads(request.data)
-    subscription = data.get('content').get('subscription')
-    if subscription and subscription.get('status') == 'cancelled':
-        sub = get_chargebee_subscription_by_id(subscription['id'], config=app.config)
-        meta_data = sub.meta_data
-        bc_store_hash = meta_data['bc_store_hash']
-        app_user = get_query_first_result(AppUser, bc_store_hash)
-        deactivate_bc_webhooks(app_user, app.config)
+def subscription_events():
+    event = record_subscription_event(verify_subscription_event(request.get_data(), request.authorization,
+                                                                app.config))
+    if event is not None:
+        start_subscription_event(event.event_id, lambda event_id: zappa_async.run(subscription_event,
+                                                                                  args=[event_id]))
+    return 'Ok'
+
+
+@app.route('/bc-ingest-orders', methods=['POST'])
+def ingest_orders():
+    enqueue_bc_webhook('orders', request.get_data(), request.headers.get(BC_WEBHOOK_TOKEN_HEADER), app.config)
+    return 'Ok'
+
+
+@app.route('/bc-ingest-customers', methods=['POST'])
+def ingest_customers():
+    enqueue_bc_webhook('customers', request.get_data(), request.headers.get(BC_WEBHOOK_TOKEN_HEADER),
+                       app.config)
     return 'Ok'
 
 
@@ -245,5 +281,143 @@ def release_notes():
     return render_template('release_notes.html')
 
 
+def warm_up(event=None, context=None):
+    """
+    Scheduled by Zappa (see zappa_settings.json) so warm containers already hold
+    imported clients and open connections when a real request arrives.
+    """
+    warm_up_clients(app.config)
+    return 'Warm'
+
+
+def sync_all(event=None, context=None):
+    """
+    Scheduled by Zappa. Catches up every store that webhooks missed or left behind,
+    and logs how far behind each one was.
+    """
+    report = sync_all_stores(app.config, invocation_deadline(context))
+    logger.info('Scheduled sync: %s', json.dumps(report))
+    return dict((name, value) for name, value in report.items() if name != 'lags')
+
+
+def subscription_event(event_id):
+    """
+    Processes one recorded Chargebee event in its own asynchronous invocation.
+    """
+    return process_subscription_event(event_id, app.config)
+
+
+def sweep_subscription_events(event=None, context=None):
+    """
+    Scheduled by Zappa. Retries Chargebee events that were recorded but never
+    processed, e.g. because their asynchronous invocation failed.
+    """
+    outcomes = process_pending_subscription_events(app.config)
+    if outcomes:
+        logger.info('Swept subscription events: %s', json.dumps(outcomes))
+    return outcomes
+
+
+def reconcile_all_subscriptions(event=None, context=None):
+    """
+    Scheduled by Zappa. Repairs subscription state that drifted from Chargebee
+    through missed events, and logs the report of each phase.
+    """
+    report = reconcile_subscriptions(app.config, dry_run=bool((event or {}).get('dry_run')),
+                                     deadline=invocation_deadline(context))
+    logger.info('Subscription reconciliation: %s', json.dumps(report))
+    return report
+
+
+def backfill(bc_store_hash):
+    """
+    Runs one slice of a store's historical backfill and, until it completes,
+    hands the rest to a fresh asynchronous invocation.
+    """
+    deadline = invocation_deadline(started_at=time.time())
+    app_user = get_app_user(bc_store_hash)
+    if app_user and not backfill_store(app_user, app.config, deadline):
+        start_backfill(bc_store_hash)
+
+
+def start_backfill(bc_store_hash):
+    zappa_async.run(backfill, args=[bc_store_hash])
+
+
+def resume_backfills(event=None, context=None):
+    """
+    Scheduled by Zappa. Restarts backfills whose chain of invocations stopped, e.g.
+    after a slice failed past Lambda's retries, or that never started.
+    """
+    stores = [user.bc_store_hash for user in scan_stale_backfills(BACKFILL_STALE_SECONDS)]
+    for bc_store_hash in stores:
+        start_backfill(bc_store_hash)
+    if stores:
+        logger.info('Resumed backfills of %s', json.dumps(stores))
+    return len(stores)
+
+
+def recompute_all(event=None, context=None):
+    """
+    Scheduled by Zappa. Starts the nightly full recompute of every syncable store,
+    one asynchronous invocation per store.
+    """
+    stores = [user.bc_store_hash for user in scan_syncable_stores()]
+    for bc_store_hash in stores:
+        zappa_async.run(recompute, args=[bc_store_hash, True])
+    logger.info('Started recompute of %s stores', len(stores))
+    return len(stores)
+
+
+def recompute(bc_store_hash, restart=False):
+    """
+    Runs one slice of a store's nightly recompute and, until it completes, hands
+    the rest to a fresh asynchronous invocation.
+    """
+    deadline = invocation_deadline(started_at=time.time())
+    app_user = get_app_user(bc_store_hash)
+    if app_user and not recompute_store(app_user, app.config, deadline, restart=restart):
+        zappa_async.run(recompute, args=[bc_store_hash])
+
+
+def refresh_all_webhooks(event=None, context=None):
+    """
+    Run once with `zappa invoke` after changing the webhook headers: re-registers
+    the hooks of every store with registered webhooks, one asynchronous invocation
+    per store.
+    """
+    stores = [user.bc_store_hash for user in scan_app_users(attributes=['bc_store_hash', 'bc_webhooks_registered'])
+              if user.bc_webhooks_registered]
+    for bc_store_hash in stores:
+        zappa_async.run(refresh_webhooks, args=[bc_store_hash])
+    logger.info('Started webhook refresh of %s stores', len(stores))
+    return len(stores)
+
+
+def refresh_webhooks(bc_store_hash):
+    app_user = get_app_user(bc_store_hash)
+    if app_user and app_user.bc_webhooks_registered:
+        outcomes = reconcile_user_webhooks(app_user, app.config, active=True)
+        logger.info('Refreshed webhooks of %s: %s', bc_store_hash, 'ok' if webhooks_ok(outcomes) else 'failed')
+
+
+def drain_ingest(event=None, context=None):
+    """
+    Scheduled by Zappa. Works through queued webhook events in batches, off the
+    request path that BigCommerce is waiting on.
+    """
+    deadline = invocation_deadline(context)
+    handled = drain_ingest_queue(get_ingest_queue(), lambda events: handle_ingest_batch(events, app.config, deadline),
+                                 coalescer=ingest_coalescer, deadline=deadline)
+    logger.info('Drained %s events, coalescer: %s, HubSpot writes: %s, outbound: %s, latency: %s', handled,
+                json.dumps(ingest_coalescer.stats()), json.dumps(contact_writer.stats()),
+                json.dumps(outbound_scheduler.stats()), json.dumps(upstream_timings.stats()))
+    return handled
+
+
+# Must follow every route: it swaps in pre-rendered versions of their views.
+install_static_assets(app)
+
+
 if __name__ == '__main__':
     app.run('0.0.0.0', debug=True, port=8100)
@@ -1,16 +1,90 @@
+import logging
+import os
+import threading
+import time
+from collections import namedtuple
 from contextlib import contextmanager
 from datetime import datetime
 
-import chargebee
-import pendulum
 import json
-from bigcommerce.api import BigcommerceApi
-from bigcommerce.exception import ClientRequestException
-from flask import url_for, render_template
-from werkzeug.exceptions import BadGateway
-
+from flask import url_for, render_template, g, has_app_context
+from hmac import compare_digest
+from werkzeug.exceptions import BadRequest, Unauthorized
+
+from backfill_utils import *
+from cache_utils import *
+from concurrency_utils import *
+from concurrency_utils import executor
+from contact_utils import *
 from dynamodb_utils import *
+from http_utils import *
 from hubspot_utils import *
+from import_utils import lazy_import
+from ingest_utils import *
+from metrics_utils import *
+from property_utils import *
+from ratelimit_utils import *
+from reconcile_utils import *
+from scheduler_utils import *
+from static_utils import *
+from subscription_utils import *
+from sync_utils import *
+from timing_utils import *
+from webhook_utils import *
+
+logger = logging.getLogger(__name__)
+
+chargebee = lazy_import('chargebee')
+pendulum = lazy_import('pendulum')
+BigcommerceApi = lazy_import('bigcommerce.api', 'BigcommerceApi')
+
+SUBSCRIPTION_CACHE_MAX_SIZE = int(os.environ.get('SUBSCRIPTION_CACHE_MAX_SIZE', 512))
+SUBSCRIPTION_CACHE_TTL = int(os.environ.get('SUBSCRIPTION_CACHE_TTL', 300))
+
+CHARGEBEE_LIST_PAGE_SIZE = 100
+
+subscription_cache = TTLCache(max_size=SUBSCRIPTION_CACHE_MAX_SIZE, ttl=SUBSCRIPTION_CACHE_TTL)
+
+APP_USER_CACHE_MAX_SIZE = int(os.environ.get('APP_USER_CACHE_MAX_SIZE', 256))
+APP_USER_CACHE_TTL = int(os.environ.get('APP_USER_CACHE_TTL', 30))
+
+app_user_cache = TTLCache(max_size=APP_USER_CACHE_MAX_SIZE, ttl=APP_USER_CACHE_TTL)
+
+BC_CLIENT_CACHE_MAX_SIZE = int(os.environ.get('BC_CLIENT_CACHE_MAX_SIZE', 128))
+BC_CLIENT_CACHE_TTL = int(os.environ.get('BC_CLIENT_CACHE_TTL', 3600))
+
+bc_client_cache = TTLCache(max_size=BC_CLIENT_CACHE_MAX_SIZE, ttl=BC_CLIENT_CACHE_TTL)
+
+STORE_INFO_CACHE_MAX_SIZE = int(os.environ.get('STORE_INFO_CACHE_MAX_SIZE', 256))
+STORE_INFO_CACHE_TTL = int(os.environ.get('STORE_INFO_CACHE_TTL', 86400))
+STORE_INFO_REFRESH_AFTER = int(os.environ.get('STORE_INFO_REFRESH_AFTER', 900))
+
+StoreDetails = namedtuple('StoreDetails', ['store_info', 'address', 'fetched_at'])
+
+store_info_cache = TTLCache(max_size=STORE_INFO_CACHE_MAX_SIZE, ttl=STORE_INFO_CACHE_TTL)
+_store_info_refreshing = set()
+_store_info_refresh_lock = threading.Lock()
+
+hubspot_token_manager = HubSpotTokenManager()
+contact_resolver = ContactResolver()
+contact_writer = ContactWriter(resolver=contact_resolver)
+property_provisioner = PropertyProvisioner()
+
+# 'dynamodb' shares one queue across containers; 'sqlite' keeps a container local
+# file at INGEST_QUEUE_PATH, for local runs only.
+INGEST_QUEUE_BACKEND = os.environ.get('INGEST_QUEUE_BACKEND', 'dynamodb')
+INGEST_QUEUE_PATH = os.environ.get('INGEST_QUEUE_PATH', '/tmp/hubmetrix-ingest.sqlite3')
+
+_ingest_queue = []
+_ingest_queue_lock = threading.Lock()
+
+ingest_coalescer = EventCoalescer()
+
+# Keep LAMBDA_TIMEOUT_SECONDS in step with timeout_seconds in zappa_settings.json.
+LAMBDA_TIMEOUT_SECONDS = int(os.environ.get('LAMBDA_TIMEOUT_SECONDS', 300))
+INVOCATION_MARGIN_SECONDS = int(os.environ.get('INVOCATION_MARGIN_SECONDS', 20))
+BACKFILL_STALE_SECONDS = int(os.environ.get('BACKFILL_STALE_SECONDS', 900))
+SCHEDULED_SYNC_MAX_PAGES = int(os.environ.get('SCHEDULED_SYNC_MAX_PAGES', 20))
 
 
 @contextmanager
@@ -38,11 +112,11 @@ def bc_token_manager(context, config):
 def app_user_creation_manager(callback_context, token_context):
     _, _, scope, bc_store_hash, _ = callback_context
     bc_id, email, access_token = token_context
-    app_user = get_query_first_result(AppUser, bc_store_hash)
+    app_user = get_app_user(bc_store_hash)
     if not app_user:
         app_user = (AppUser(bc_store_hash, bc_id, bc_email=email,
                             bc_access_token=access_token, bc_scope=scope))
-    app_user.save()
+    save_app_user(app_user)
     yield app_user
 
 
@@ -69,9 +143,9 @@ def hubspot_auth_manager(request_args, config):
 @contextmanager
 def app_user_hubspot_token_manager(store_hash, ctx):
     code, redir_uri, client_id, client_secret = ctx
-    app_user = get_query_first_result(AppUser, store_hash)
-    token_and_refresh = exchange_code_for_token(code, client_id, client_secret, redir_uri)
-    token_info = get_token_info(token_and_refresh['access_token'])
+    steps = fan_out(tokens=lambda: exchange_code_for_token_and_info(code, client_id, client_secret, redir_uri))
+    app_user = get_app_user(store_hash)
+    token_and_refresh, token_info = steps.result('tokens')
     app_user.hs_refresh_token = token_and_refresh['refresh_token']
     app_user.hs_access_token = token_and_refresh['access_token']
     app_user.hs_expires_in = str(token_and_refresh['expires_in'])
@@ -83,22 +157,339 @@ def app_user_hubspot_token_manager(store_hash, ctx):
     app_user.hs_user_id = str(token_info['user_id'])
     app_user.hs_scopes = token_info['scopes']
     app_user.hs_access_token_timestamp = str(datetime.now())
-    app_user.save()
+    app_user.hs_access_token_expires_at = int(time.time()) + int(token_and_refresh['expires_in'])
+    save_app_user(app_user)
     yield app_user
 
 
+def exchange_code_for_token_and_info(code, client_id, client_secret, redir_uri):
+    token_and_refresh = exchange_code_for_token(code, client_id, client_secret, redir_uri)
+    return token_and_refresh, get_token_info(token_and_refresh['access_token'])
+
+
+def get_unit_of_work():
+    if not has_app_context():
+        return None
+    if 'app_user_uow' not in g:
+        g.app_user_uow = AppUserUnitOfWork(cache=app_user_cache)
+    return g.app_user_uow
+
+
+def get_app_user(bc_store_hash):
+    uow = get_unit_of_work()
+    if uow is None:
+        return get_query_first_result(AppUser, bc_store_hash)
+    return uow.get(bc_store_hash)
+
+
+def get_app_user_fields(bc_store_hash, *attributes):
+    """
+    Read-only lookup for hot routes. Reuses an already loaded item when there is
+    one, otherwise fetches only the requested attributes.
+    """
+    uow = get_unit_of_work()
+    user = uow.peek(bc_store_hash) if uow is not None else None
+    if user is None:
+        user = AppUser.find_by_store_hash(bc_store_hash, attributes=list(attributes))
+    return user
+
+
+def save_app_user(user):
+    uow = get_unit_of_work()
+    if uow is None:
+        user.save_changes()
+    elif not uow.is_tracked(user):
+        uow.add(user)
+
+
+def delete_app_user(user):
+    uow = get_unit_of_work()
+    if uow is None:
+        user.delete()
+    else:
+        uow.delete(user)
+
+
+def flush_app_users():
+    uow = g.pop('app_user_uow', None) if has_app_context() else None
+    if uow is not None:
+        uow.flush()
+
+
+def start_provisioning_lookups(user, config):
+    """
+    Starts the Chargebee subscription lookup and the (speculative) store info fetch
+    for an onboarding user. Only the steps a route awaits cost it latency.
+    """
+    return fan_out(subscription=lambda: get_chargebee_subscription_by_email(user.bc_email, config=config),
+                   store_details=lambda: get_bc_store_details(user, config))
+
+
+def get_hubspot_access_token(user, config):
+    access_token, persisted = hubspot_token_manager.get_access_token(user, get_hs_client_id(config),
+                                                                     get_hs_client_secret(config))
+    uow = get_unit_of_work()
+    if persisted and uow is not None and uow.is_tracked(user):
+        uow.mark_persisted(user, persisted)
+    return access_token
+
+
+def ensure_hubspot_properties(user, config):
+    """
+    Creates the Hubmetrix contact properties in the user's portal unless already
+    recorded for the current schema version, which costs no HubSpot request.
+    """
+    if PropertyProvisioner.is_provisioned(user):
+        return False
+    persisted = property_provisioner.ensure(user, get_hubspot_access_token(user, config))
+    uow = get_unit_of_work()
+    if uow is not None and uow.is_tracked(user):
+        uow.mark_persisted(user, persisted)
+    return True
+
+
+def get_ingest_queue():
+    if not _ingest_queue:
+        with _ingest_queue_lock:
+            if not _ingest_queue:
+                if INGEST_QUEUE_BACKEND == 'sqlite':
+                    _ingest_queue.append(IngestQueue(INGEST_QUEUE_PATH))
+                else:
+                    _ingest_queue.append(DynamoIngestQueue())
+    return _ingest_queue[0]
+
+
+def enqueue_bc_webhook(kind, body, token, config):
+    """
+    Queues a BigCommerce webhook delivery once its token header matches the store's.
+    """
+    bc_store_hash, payload = parse_bc_webhook(body)
+    expected = bc_webhook_token(bc_store_hash, get_bc_webhook_secret(config))
+    if not compare_digest((token or '').encode('utf-8'), expected.encode('utf-8')):
+        raise Unauthorized('Invalid webhook token')
+    get_ingest_queue().put(kind, bc_store_hash, payload)
+
+
+def handle_ingest_batch(events, config, deadline=None):
+    """
+    Runs a bounded incremental sync of each store in the batch, except stores still
+    backfilling. The next sync picks up whatever was cut short.
+    """
+    summary = {}
+    for event in events:
+        counts = summary.setdefault(event.bc_store_hash, {})
+        counts[event.kind] = counts.get(event.kind, 0) + 1
+    logger.info('Ingested batch: %s', json.dumps(summary))
+
+    for bc_store_hash in summary:
+        user = get_app_user(bc_store_hash)
+        if not user or not user.bc_webhooks_registered or not user.hs_access_token:
+            continue
+        if user.hm_backfill_started_at and not user.hm_backfill_completed_at:
+            continue
+        if deadline is not None and time.time() >= deadline:
+            break
+        try:
+            stats = sync_store(user, config, max_pages=SCHEDULED_SYNC_MAX_PAGES, deadline=deadline)
+            logger.info('Synced %s: %s', bc_store_hash, json.dumps(stats))
+        except SyncConflict as e:
+            logger.info(str(e))
+        except Exception:
+            logger.exception('Sync of %s failed, it will resume from its watermark', bc_store_hash)
+    return summary
+
+
+def sync_store(user, config, max_pages=None, deadline=None):
+    return IncrementalSync(user, get_bc_client(user, config), hubspot_pusher(user, config)).run(max_pages=max_pages,
+                                                                                                  deadline=deadline)
+
+
+def sync_all_stores(config, deadline):
+    """
+    One scheduled round over every syncable store until deadline, stalest first,
+    with each store limited to SCHEDULED_SYNC_MAX_PAGES pages so that large stores
+    take turns.
+    """
+    scheduler = SyncScheduler(lambda user: sync_store(user, config, max_pages=SCHEDULED_SYNC_MAX_PAGES,
+                                                      deadline=deadline))
+    return scheduler.run(scan_syncable_stores(), deadline=deadline)
+
+
+def invocation_deadline(context=None, started_at=None):
+    """
+    When the running Lambda invocation should wrap up, INVOCATION_MARGIN_SECONDS
+    before it is killed: from the context of scheduled events, or for asynchronous
+    tasks (which get none) from started_at and LAMBDA_TIMEOUT_SECONDS.
+    """
+    if context is not None and hasattr(context, 'get_remaining_time_in_millis'):
+        return time.time() + context.get_remaining_time_in_millis() / 1000.0 - INVOCATION_MARGIN_SECONDS
+    return (started_at or time.time()) + LAMBDA_TIMEOUT_SECONDS - INVOCATION_MARGIN_SECONDS
+
+
+def backfill_store(user, config, deadline):
+    """
+    Runs one slice of the store's historical backfill until deadline. Returns True
+    once the whole backfill is complete.
+    """
+    user.update(actions=[AppUser.hm_backfill_slice_at.set(int(time.time()))])
+    if not fill_contact_index(user, config, deadline):
+        return False
+    client = get_bc_client(user, config)
+    sync = IncrementalSync(user, client, hubspot_pusher(user, config))
+    return Backfill(user, client, sync).run(deadline=deadline)
+
+
+def fill_contact_index(user, config, deadline=None):
+    """
+    Loads the portal's existing contacts into the contact index once, ahead of the
+    first backfill, resuming from the recorded offset. Returns True once filled.
+    """
+    if user.hs_contact_index_filled_at:
+        return True
+    offset = contact_resolver.fill(user.hs_hub_id or user.bc_store_hash, get_hubspot_access_token(user, config),
+                                   offset=user.hs_contact_index_offset, deadline=deadline)
+    if offset is None:
+        user.update(actions=[AppUser.hs_contact_index_filled_at.set(int(time.time())),
+                             AppUser.hs_contact_index_offset.remove()])
+        return True
+    user.update(actions=[AppUser.hs_contact_index_offset.set(offset)])
+    return False
+
+
+def recompute_store(user, config, deadline, restart=False):
+    """
+    Runs one slice of the store's nightly recompute until deadline, first starting
+    a new run if restart is set and the last one is complete. Returns True once the
+    run is complete.
+    """
+    user.update(actions=[AppUser.hm_recompute_slice_at.set(int(time.time()))])
+    client = get_bc_client(user, config)
+    recompute = Recompute(user, client, IncrementalSync(user, client, hubspot_pusher(user, config)))
+    if restart:
+        recompute.start()
+    return recompute.run(deadline=deadline)
+
+
+def hubspot_pusher(user, config):
+    """
+    Buffered push(email, properties) into the user's portal; see ContactWriter.
+    """
+    ensure_hubspot_properties(user, config)
+    return contact_writer.for_portal(user.hs_hub_id or user.bc_store_hash,
+                                     lambda: get_hubspot_access_token(user, config),
+                                     lookup=not user.hs_contact_index_filled_at)
+
+
 def check_and_provision_subscription(user, config):
     sub = get_chargebee_subscription_by_email(user.bc_email, config=config)
+    return provision_subscription(user, sub, config)
+
+
+def provision_subscription(user, sub, config):
     if sub:
+        cache_chargebee_subscription(sub)
         user.cb_subscription_id = sub.id
+        user.cb_subscription_status = sub.status
 
-        if sub.status != 'cancelled':
+        if subscription_is_active(sub.status):
             return register_or_activate_bc_webhooks(user, config)
 
         return deactivate_bc_webhooks(user, config)
     return False
 
 
+def start_subscription_event(event_id, run):
+    """
+    Hands a recorded Chargebee event to run(event_id), normally an asynchronous
+    invocation. If that can't be started the scheduled sweep picks it up later.
+    """
+    try:
+        run(event_id)
+    except Exception:
+        logger.exception('Could not start processing of subscription event %s', event_id)
+
+
+def process_subscription_event(event_id, config):
+    """
+    Applies a recorded Chargebee event from the subscription in its payload, unless the
+    store applied a newer version. Returns the outcome, or None when the event was
+    processed or leased elsewhere.
+    """
+    event = claim_subscription_event(event_id)
+    if event is None:
+        return None
+    values = json.loads(event.content).get('subscription')
+    if event.event_type not in SUBSCRIPTION_EVENT_TYPES or not values:
+        outcome = 'ignored'
+    else:
+        outcome = apply_subscription_update(subscription_from_values(values), config)
+    if outcome == 'webhooks_failed':
+        logger.warning('Subscription event %s: webhooks not updated, it will be retried', event_id)
+        return outcome
+    complete_subscription_event(event, outcome)
+    logger.info('Subscription event %s (%s): %s', event_id, event.event_type, outcome)
+    return outcome
+
+
+def apply_subscription_update(sub, config):
+    bc_store_hash = subscription_store_hash(sub)
+    if not bc_store_hash:
+        cache_chargebee_subscription(sub)
+        return 'cached'
+    user = get_app_user(bc_store_hash)
+    if not user:
+        cache_chargebee_subscription(sub)
+        return 'unknown_store'
+    version = sub.resource_version or 0
+    if user.cb_subscription_version and user.cb_subscription_version >= version and \
+            user.cb_subscription_id == sub.id:
+        return 'stale'
+    cache_chargebee_subscription(sub)
+
+    if not provision_subscription(user, sub, config):
+        return 'webhooks_failed'
+    actions = [AppUser.cb_subscription_id.set(sub.id), AppUser.cb_subscription_status.set(sub.status)]
+    if version:
+        user.cb_subscription_version = version
+        actions.append(AppUser.cb_subscription_version.set(version))
+    user.update(actions=actions)
+    uow = get_unit_of_work()
+    if uow is not None and uow.is_tracked(user):
+        uow.mark_persisted(user, ['cb_subscription_id', 'cb_subscription_status', 'cb_subscription_version'])
+    return sub.status
+
+
+def process_pending_subscription_events(config, older_than=60):
+    """
+    Backstop for events whose worker never ran or failed. Returns the outcomes.
+    """
+    outcomes = {}
+    for event_id in pending_subscription_events(older_than):
+        try:
+            outcome = process_subscription_event(event_id, config)
+        except Exception:
+            logger.exception('Subscription event %s failed, it will be retried', event_id)
+            outcome = 'failed'
+        if outcome:
+            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+    return outcomes
+
+
+def subscription_from_values(values):
+    return chargebee.Subscription.construct(values)
+
+
+def reconcile_subscriptions(config, dry_run=False, deadline=None):
+    """
+    Corrects every store's subscription fields and webhooks from a full listing of
+    Chargebee subscriptions; see SubscriptionReconciler.
+    """
+    reconciler = SubscriptionReconciler(lambda: list_chargebee_subscriptions(config=config),
+                                        lambda user, active: webhooks_ok(reconcile_user_webhooks(user, config,
+                                                                                                 active=active)))
+    return reconciler.run(dry_run=dry_run, deadline=deadline)
+
+
 def get_context_for_index(user, sub):
     last_sync = user.hm_last_sync_timestamp
     period_timestamp = sub.cancelled_at if sub.cancelled_at else sub.next_billing_at
@@ -129,6 +520,10 @@ def get_bc_client_secret(config):
     return config['BC_CLIENT_SECRET']
 
 
+def get_bc_webhook_secret(config):
+    return config.get('BC_WEBHOOK_SECRET') or get_bc_client_secret(config)
+
+
 def get_hs_client_id(config):
     return config['HS_CLIENT_ID']
 
@@ -149,17 +544,41 @@ def construct_hubspot_auth_url(config):
             '&scope=contacts%20automation%20timeline&redirect_uri={}'.format(client_id, redir_uri))
 
 
+_chargebee_configuration = {}
+
+
+def configure_chargebee(config):
+    api_key, site = config['CHARGEBEE-API-KEY'], config['CHARGEBEE-SITE']
+    if _chargebee_configuration.get('current') != (api_key, site):
+        chargebee.configure(api_key, site)
+        _chargebee_configuration['current'] = (api_key, site)
+
+
 def configure_chargebee_api(func):
     def wrapper(*args, **kwargs):
-        chargebee.configure(kwargs['config']['CHARGEBEE-API-KEY'], kwargs['config']['CHARGEBEE-SITE'])
-        return func(*args)
+        configure_chargebee(kwargs['config'])
+        with timed('chargebee'):
+            return func(*args)
 
     return wrapper
 
 
+def warm_up_clients(config):
+    """
+    Imports the heavy client libraries and builds the container scoped clients
+    ahead of the first real request.
+    """
+    configure_chargebee(config)
+    pendulum.now()
+    getattr(BigcommerceApi, 'oauth_verify_payload')
+    getattr(AppUser._get_connection().connection, 'client')
+    get_http_session('hubspot')
+
+
 @configure_chargebee_api
-def construct_chargebee_signup_url(store_info, app_url):
-    address_info = parse_bc_address(store_info['address'])
+def construct_chargebee_signup_url(store_info, app_url, address_info=None):
+    if address_info is None:
+        address_info = parse_bc_address(store_info['address'])
 
     result = chargebee.HostedPage.checkout_new({
         "subscription": {
@@ -218,6 +637,29 @@ def update_subscription_id(user, subscription_id):
     )
 
 
+def verify_subscription_event(body, authorization, config):
+    """
+    Returns the body of a Chargebee webhook delivery that is safe to record: checked
+    against the configured basic auth, or else fetched back from Chargebee by its id.
+    """
+    username = config.get('CHARGEBEE-WEBHOOK-USERNAME')
+    if username:
+        check_subscription_event_auth(authorization, username, config.get('CHARGEBEE-WEBHOOK-PASSWORD') or '')
+        return body
+    event_id = parse_subscription_event(body)[0]
+    try:
+        event = get_chargebee_event_by_id(event_id, config=config)
+    except chargebee.InvalidRequestError:
+        raise BadRequest('Unknown event {}'.format(event_id))
+    return json.dumps(event.values)
+
+
+@configure_chargebee_api
+def get_chargebee_event_by_id(event_id):
+    result = chargebee.Event.retrieve(event_id)
+    return result.event
+
+
 @configure_chargebee_api
 def get_chargebee_subscription_by_email(email):
     result = chargebee.Subscription.list({'email': email})
@@ -227,12 +669,61 @@ def get_chargebee_subscription_by_email(email):
         return result
 
 
+@configure_chargebee_api
+def list_chargebee_subscriptions(page_size=CHARGEBEE_LIST_PAGE_SIZE):
+    """
+    Every subscription on the site, paged through in the largest pages Chargebee allows.
+    """
+    subscriptions = []
+    offset = None
+    while True:
+        params = {'limit': page_size}
+        if offset:
+            params['offset'] = offset
+        result = chargebee.Subscription.list(params)
+        subscriptions.extend(entry.subscription for entry in result)
+        offset = result.next_offset
+        if not offset:
+            return subscriptions
+
+
 @configure_chargebee_api
 def get_chargebee_subscription_by_id(subscription_id):
     result = chargebee.Subscription.retrieve(subscription_id)
     return result.subscription
 
 
+def get_cached_chargebee_subscription(subscription_id, config, min_version=None):
+    """
+    min_version is the subscription version the store last applied; a cached copy
+    older than it was cached before an event another container handled.
+    """
+    sub = subscription_cache.get(subscription_id)
+    if sub is None or (min_version and (sub.resource_version or 0) < min_version):
+        sub = get_chargebee_subscription_by_id(subscription_id, config=config)
+        cache_chargebee_subscription(sub)
+    return sub
+
+
+def cache_chargebee_subscription(sub):
+    """
+    Caches sub unless a newer version of it is already cached.
+    """
+    if sub:
+        cached = subscription_cache.get(sub.id)
+        if cached is None or (sub.resource_version or 0) >= (cached.resource_version or 0):
+            subscription_cache.set(sub.id, sub)
+    return sub
+
+
+def invalidate_chargebee_subscription(subscription_id):
+    subscription_cache.invalidate(subscription_id)
+
+
+def get_subscription_cache_stats():
+    return subscription_cache.stats()
+
+
 @configure_chargebee_api
 def get_chargebee_hosted_page(page_id):
     result = chargebee.HostedPage.retrieve(page_id)
@@ -242,94 +733,103 @@ def get_chargebee_hosted_page(page_id):
 @configure_chargebee_api
 def cancel_chargebee_subscription_by_id(subscription_id):
     result = chargebee.Subscription.cancel(subscription_id, {'end_of_term': True})
-    return result.subscription
+    return cache_chargebee_subscription(result.subscription)
 
 
 @configure_chargebee_api
 def reactivate_chargebee_subscription_by_id(subscription_id):
     result = chargebee.Subscription.reactivate(subscription_id)
-    return result.subscription
+    return cache_chargebee_subscription(result.subscription)
 
 
 @configure_chargebee_api
 def update_chargebee_subscription_with_meta_data(subscription_id, store_hash):
     meta_data = json.dumps({'bc_store_hash': store_hash})
     result = chargebee.Subscription.update(subscription_id, {'meta_data': meta_data})
-    return result.subscription
+    return cache_chargebee_subscription(result.subscription)
 
 
 def register_or_activate_bc_webhooks(user, config):
-    client = get_bc_client(user, config)
-
     if not user.bc_webhooks_registered:
-        try:
-            existing_webhooks = get_existing_webhooks(client)
-            if existing_webhooks:
-                for hook in existing_webhooks:
-                    client.Webhooks.get(hook.id).update(is_active=True)
-
-            if not existing_webhooks:
-                order_dest = config['APP_BACKEND_URL'] + '/dev/bc-ingest-orders'
-                customer_dest = config['APP_BACKEND_URL'] + '/dev/bc-ingest-customers'
-
-                client.Webhooks.create(scope='store/order/created', destination=order_dest, is_active=True)
-                client.Webhooks.create(scope='store/order/statusUpdated', destination=order_dest, is_active=True)
-                client.Webhooks.create(scope='store/customer/updated', destination=customer_dest, is_active=True)
-
-            user.bc_webhooks_registered = True
-            user.save()
-            return True
-        except BadGateway:
+        if not webhooks_ok(reconcile_user_webhooks(user, config, active=True)):
             return False
+        user.bc_webhooks_registered = True
+        save_app_user(user)
     return True
 
 
 def deactivate_bc_webhooks(user, config):
-    client = get_bc_client(user, config)
-
-    try:
-        existing_webhooks = get_existing_webhooks(client)
-        if existing_webhooks:
-            for hook in existing_webhooks:
-                client.Webhooks.get(hook.id).update(is_active=False)
-        user.bc_webhooks_registered = False
-        user.save()
-        return True
-    except BadGateway:
+    if not webhooks_ok(reconcile_user_webhooks(user, config, active=False)):
         return False
-
-
-def get_existing_webhooks(client):
-    try:
-        hooks = client.Webhooks.all()
-        if hooks:
-            return hooks
-        return []
-    except ClientRequestException:
-        return []
+    user.bc_webhooks_registered = False
+    save_app_user(user)
+    return True
 
 
 def delete_all_webhooks(user, config):
-    client = get_bc_client(user, config)
+    outcomes = reconcile_bc_webhooks(get_bc_client(user, config), desired=[])
+    return bool(outcomes) and webhooks_ok(outcomes)
 
-    try:
-        hooks = client.Webhooks.all()
-        if hooks:
-            for hook in hooks:
-                client.Webhooks.get(hook.id).delete()
-            return True
-        return False
-    except ClientRequestException:
-        return False
+
+def reconcile_user_webhooks(user, config, active=True):
+    return reconcile_bc_webhooks(get_bc_client(user, config), desired_bc_webhooks(config), active=active,
+                                 headers=bc_webhook_headers(user.bc_store_hash, get_bc_webhook_secret(config)))
 
 
 def get_bc_client(user, config):
-    return BigcommerceApi(client_id=get_bc_client_id(config),
-                          store_hash=user.bc_store_hash,
-                          access_token=user.bc_access_token)
+    key = (get_bc_client_id(config), user.bc_store_hash, user.bc_access_token)
+    client = bc_client_cache.get(key)
+    if client is None:
+        client = BigcommerceApi(client_id=get_bc_client_id(config),
+                                store_hash=user.bc_store_hash,
+                                access_token=user.bc_access_token)
+        session = getattr(client.connection, '_session', None)
+        if session is not None:
+            register_http_session('bigcommerce', session, key=user.bc_store_hash)
+        bc_client_cache.set(key, client)
+    return client
 
 
 def get_bc_store_info(user, config):
+    return get_bc_store_details(user, config).store_info
+
+
+def get_bc_store_details(user, config):
+    """
+    Store metadata rarely changes, so it is served from the container cache and
+    refreshed in the background once it is older than STORE_INFO_REFRESH_AFTER.
+    """
+    details = store_info_cache.get(user.bc_store_hash)
+    if details is None:
+        return fetch_bc_store_details(user, config)
+    if time.monotonic() - details.fetched_at > STORE_INFO_REFRESH_AFTER:
+        refresh_bc_store_details(user, config)
+    return details
+
+
+def fetch_bc_store_details(user, config):
     client = get_bc_client(user, config)
+    store_info = client.Store.all()
+    details = StoreDetails(store_info, parse_bc_address(store_info['address']), time.monotonic())
+    store_info_cache.set(user.bc_store_hash, details)
+    return details
+
+
+def refresh_bc_store_details(user, config):
+    with _store_info_refresh_lock:
+        if user.bc_store_hash in _store_info_refreshing:
+            return
+        _store_info_refreshing.add(user.bc_store_hash)
+
+    def refresh():
+        try:
+            fetch_bc_store_details(user, config)
+        finally:
+            with _store_info_refresh_lock:
+                _store_info_refreshing.discard(user.bc_store_hash)
+
+    executor.submit(refresh)
+
 
-    return client.Store.all()
+def invalidate_bc_store_details(bc_store_hash):
+    store_info_cache.invalidate(bc_store_hash)
@@ -1,8 +1,30 @@
-import requests
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from urllib.parse import quote
 
-HS_BASE_AUTH_URI = 'https://api.hubapi.com/oauth/v1/token'
+from pynamodb.exceptions import UpdateError
 
-__all__ = ['exchange_code_for_token', 'get_token_info']
+from dynamodb_utils import AppUser
+from http_utils import get_http_session
+
+HS_API_BASE = os.environ.get('HS_API_BASE', 'https://api.hubapi.com')
+HS_BASE_AUTH_URI = HS_API_BASE + '/oauth/v1/token'
+HS_CONTACTS_URI = HS_API_BASE + '/contacts/v1'
+HS_BATCH_SIZE = 100
+HS_BATCH_MAX_RETRIES = int(os.environ.get('HS_BATCH_MAX_RETRIES', 3))
+HS_TOKEN_REFRESH_MARGIN = int(os.environ.get('HS_TOKEN_REFRESH_MARGIN', 300))
+HS_TOKEN_REFRESH_LEASE = int(os.environ.get('HS_TOKEN_REFRESH_LEASE', 30))
+HS_TOKEN_ATTRIBUTES = ('hs_access_token', 'hs_refresh_token', 'hs_expires_in',
+                       'hs_access_token_expires_at', 'hs_access_token_timestamp')
+
+__all__ = ['bearer_headers', 'exchange_code_for_token', 'get_token_info', 'refresh_access_token', 'token_expires_at',
+           'update_contact_properties', 'update_contacts_batch', 'ContactWriter', 'HubSpotTokenManager']
+
+logger = logging.getLogger(__name__)
 
 
 def exchange_code_for_token(auth_code, clnt_id, clnt_secret, redir_uri):
@@ -12,9 +34,344 @@ def exchange_code_for_token(auth_code, clnt_id, clnt_secret, redir_uri):
                                                                                                            redir_uri,
                                                                                                            auth_code)
 
-    return requests.post(HS_BASE_AUTH_URI, data=payload, headers=headers).json()
+    return get_http_session('hubspot').post(HS_BASE_AUTH_URI, data=payload, headers=headers).json()
 
 
 def get_token_info(token):
-    base_uri = 'https://api.hubapi.com/oauth/v1/access-tokens/'
-    return requests.get(base_uri + token).json()
+    base_uri = HS_API_BASE + '/oauth/v1/access-tokens/'
+    return get_http_session('hubspot').get(base_uri + token).json()
+
+
+def refresh_access_token(refresh_token, clnt_id, clnt_secret):
+    headers = {'Content-Type': 'application/x-www-form-urlencoded;charset=utf-8'}
+    payload = 'grant_type=refresh_token&client_id={}&client_secret={}&refresh_token={}'.format(clnt_id,
+                                                                                              clnt_secret,
+                                                                                              refresh_token)
+    response = get_http_session('hubspot').post(HS_BASE_AUTH_URI, data=payload, headers=headers)
+    response.raise_for_status()
+    return response.json()
+
+
+def token_expires_at(user):
+    """
+    Epoch seconds at which the user's access token expires. Items written before
+    hs_access_token_expires_at existed are parsed from the timestamp strings once.
+    """
+    if user.hs_access_token_expires_at:
+        return user.hs_access_token_expires_at
+    if not (user.hs_access_token_timestamp and user.hs_expires_in):
+        return 0
+    for fmt in ('%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S'):
+        try:
+            issued = datetime.strptime(user.hs_access_token_timestamp, fmt)
+            return int(time.mktime(issued.timetuple())) + int(user.hs_expires_in)
+        except ValueError:
+            continue
+    return 0
+
+
+class HubSpotTokenManager(object):
+    """
+    Hands out HubSpot access tokens, refreshing them HS_TOKEN_REFRESH_MARGIN seconds
+    before they expire, single-flight per hub within and across containers.
+    """
+    def __init__(self, refresh_margin=HS_TOKEN_REFRESH_MARGIN, lease_seconds=HS_TOKEN_REFRESH_LEASE):
+        self.refresh_margin = refresh_margin
+        self.lease_seconds = lease_seconds
+        self._locks = {}
+        self._tokens = {}
+        self._locks_lock = threading.Lock()
+
+    def needs_refresh(self, user):
+        return token_expires_at(user) - self.refresh_margin <= time.time()
+
+    def get_access_token(self, user, clnt_id, clnt_secret):
+        """
+        Returns (access_token, changed_attributes). changed_attributes lists the
+        AppUser attributes updated in memory that are already persisted.
+        """
+        if not self.needs_refresh(user):
+            return user.hs_access_token, []
+
+        key = user.hs_hub_id or user.bc_store_hash
+        with self._lock_for(key):
+            cached = self._tokens.get(key)
+            if cached and cached['hs_access_token'] != user.hs_access_token and \
+                    cached['hs_access_token_expires_at'] - self.refresh_margin > time.time():
+                return self._apply(user, cached), sorted(cached)
+
+            if not self._acquire_lease(user):
+                return self._wait_for_refresh(user)
+
+            old_access_token = user.hs_access_token
+            token = refresh_access_token(user.hs_refresh_token, clnt_id, clnt_secret)
+            values = dict(hs_access_token=token['access_token'],
+                          hs_refresh_token=token.get('refresh_token', user.hs_refresh_token),
+                          hs_expires_in=str(token['expires_in']),
+                          hs_access_token_expires_at=int(time.time()) + int(token['expires_in']),
+                          hs_access_token_timestamp=str(datetime.now()))
+            actions = [getattr(AppUser, name).set(value) for name, value in values.items()]
+            actions.append(AppUser.hs_token_refresh_lease.remove())
+            user.update(actions=actions, condition=(AppUser.hs_access_token == old_access_token))
+            self._tokens[key] = values
+            return user.hs_access_token, sorted(values) + ['hs_token_refresh_lease']
+
+    def _acquire_lease(self, user):
+        now = int(time.time())
+        try:
+            user.update(actions=[AppUser.hs_token_refresh_lease.set(now + self.lease_seconds)],
+                        condition=(AppUser.hs_access_token == user.hs_access_token) &
+                                  (AppUser.hs_token_refresh_lease.does_not_exist() |
+                                   (AppUser.hs_token_refresh_lease < now)))
+            return True
+        except UpdateError:
+            return False
+
+    def _wait_for_refresh(self, user):
+        deadline = time.time() + self.lease_seconds
+        old_access_token = user.hs_access_token
+        while True:
+            if token_expires_at(user) > time.time():
+                return user.hs_access_token, []
+            if time.time() > deadline:
+                raise LookupError('Timed out waiting for HubSpot token refresh of hub {}'.format(user.hs_hub_id))
+            time.sleep(0.25)
+            fresh = AppUser.find(user.bc_store_hash, user.bc_id, consistent_read=True,
+                                 attributes=list(HS_TOKEN_ATTRIBUTES))
+            if fresh and fresh.hs_access_token != old_access_token:
+                values = dict((name, getattr(fresh, name)) for name in HS_TOKEN_ATTRIBUTES)
+                return self._apply(user, values), sorted(values)
+
+    def _apply(self, user, values):
+        for name, value in values.items():
+            setattr(user, name, value)
+        return user.hs_access_token
+
+    def _lock_for(self, key):
+        with self._locks_lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+
+def update_contact_properties(access_token, email, properties):
+    """
+    Creates or updates the contact with this email. properties is a dict of
+    HubSpot property name to value.
+    """
+    uri = HS_CONTACTS_URI + '/contact/createOrUpdate/email/{}/'.format(quote(email))
+    body = {'properties': [{'property': name, 'value': value} for name, value in properties.items()]}
+    response = get_http_session('hubspot').post(uri, json=body, headers=bearer_headers(access_token))
+    response.raise_for_status()
+    return response.json()
+
+
+def update_contacts_batch(access_token, updates, vids=None):
+    """
+    Creates or updates up to HS_BATCH_SIZE contacts in one request. updates is a
+    list of (email, properties) pairs; contacts with a vid in vids are addressed
+    by it. Returns the response, leaving status handling to the caller.
+    """
+    vids = vids or {}
+    body = [dict([('vid', vids[email]) if email in vids else ('email', email)],
+                 properties=[{'property': name, 'value': value} for name, value in properties.items()])
+            for email, properties in updates]
+    return get_http_session('hubspot').post(HS_CONTACTS_URI + '/contact/batch/', json=body,
+                                            headers=bearer_headers(access_token))
+
+
+class ContactWriter(object):
+    """
+    Buffers contact property updates per portal and writes them through the batch
+    endpoint, by vid where the resolver knows it. Contacts HubSpot rejects are reported
+    by dropped() until a later write of them succeeds.
+    """
+    def __init__(self, batch_size=HS_BATCH_SIZE, max_retries=HS_BATCH_MAX_RETRIES, resolver=None):
+        self.resolver = resolver
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self._buffers = {}
+        self._tokens = {}
+        self._lookups = {}
+        self._portal_locks = {}
+        self._dropped = {}
+        self._lock = threading.Lock()
+        self.updates = 0
+        self.merged = 0
+        self.batches = 0
+        self.contacts = 0
+        self.failed = 0
+        self.send_seconds = 0.0
+
+    def for_portal(self, portal, access_token, lookup=True):
+        """
+        Returns a push(email, properties) callable for one portal, with a flush()
+        method. access_token is called for a current token before each request.
+        lookup=False skips the resolver's HubSpot lookups, see ContactResolver.resolve.
+        """
+        with self._lock:
+            self._tokens[portal] = access_token
+            self._lookups[portal] = lookup
+        return _PortalWriter(self, portal)
+
+    def write(self, portal, email, properties):
+        with self._lock:
+            buffer = self._buffers.setdefault(portal, OrderedDict())
+            self.updates += 1
+            if email in buffer:
+                buffer[email].update(properties)
+                self.merged += 1
+            else:
+                buffer[email] = dict(properties)
+            full = len(buffer) >= self.batch_size
+        if full:
+            self.flush(portal, full_batches_only=True)
+
+    def flush(self, portal=None, full_batches_only=False):
+        portals = [portal] if portal is not None else list(self._buffers)
+        for name in portals:
+            with self._portal_lock(name):
+                while True:
+                    batch = self._take(name, full_batches_only)
+                    if not batch:
+                        break
+                    self._send(name, batch)
+
+    def dropped(self, portal):
+        """
+        Emails of the portal that HubSpot rejected and that have not been written since.
+        """
+        with self._lock:
+            return frozenset(self._dropped.get(portal, ()))
+
+    def pending(self, portal=None):
+        with self._lock:
+            if portal is not None:
+                return len(self._buffers.get(portal, ()))
+            return sum(len(buffer) for buffer in self._buffers.values())
+
+    def stats(self):
+        with self._lock:
+            return dict(updates=self.updates,
+                        merged=self.merged,
+                        batches=self.batches,
+                        contacts=self.contacts,
+                        failed=self.failed,
+                        batch_fill=float(self.contacts) / (self.batches * self.batch_size) if self.batches else 0.0,
+                        contacts_per_second=self.contacts / self.send_seconds if self.send_seconds else 0.0)
+
+    def _take(self, portal, full_batches_only):
+        with self._lock:
+            buffer = self._buffers.get(portal)
+            if not buffer or (full_batches_only and len(buffer) < self.batch_size):
+                return []
+            return [buffer.popitem(last=False) for _ in range(min(self.batch_size, len(buffer)))]
+
+    def _send(self, portal, batch):
+        start = time.time()
+        try:
+            access_token = self._tokens[portal]()
+            vids = self._resolve(portal, access_token, [email for email, _ in batch])
+            for attempt in range(self.max_retries + 1):
+                if attempt:
+                    access_token = self._tokens[portal]()
+                response = update_contacts_batch(access_token, batch, vids)
+                if response.status_code == 400:
+                    batch, stale = self._drop_failures(portal, batch, response, vids)
+                    if stale:
+                        for email in stale:
+                            del vids[email]
+                        vids.update(self._resolve(portal, access_token, stale))
+                    if batch and attempt < self.max_retries:
+                        continue
+                    if not batch:
+                        return
+                response.raise_for_status()
+                with self._lock:
+                    self.batches += 1
+                    self.contacts += len(batch)
+                    self._dropped.get(portal, set()).difference_update(email for email, _ in batch)
+                self._learn(portal, access_token, [email for email, _ in batch if email not in vids])
+                return
+        except Exception as e:
+            status = getattr(getattr(e, 'response', None), 'status_code', None)
+            if status is None or status == 429 or status >= 500:
+                self._requeue(portal, batch)
+            else:
+                with self._lock:
+                    self.failed += len(batch)
+            raise
+        finally:
+            with self._lock:
+                self.send_seconds += time.time() - start
+
+    def _resolve(self, portal, access_token, emails):
+        if self.resolver is None or not emails:
+            return {}
+        return self.resolver.resolve(portal, access_token, emails, lookup=self._lookups.get(portal, True))
+
+    def _learn(self, portal, access_token, emails):
+        if self.resolver is None or not emails:
+            return
+        try:
+            self.resolver.learn(portal, access_token, emails)
+        except Exception:
+            logger.exception('Could not index %s contacts written to portal %s', len(emails), portal)
+
+    def _drop_failures(self, portal, batch, response, vids):
+        """
+        Drops the contacts HubSpot rejected from batch, forgetting the vids of those
+        addressed by vid. Returns the batch to retry and the emails whose vids were
+        forgotten.
+        """
+        try:
+            failures = response.json().get('failureMessages') or []
+        except ValueError:
+            return batch, []
+        failed = set(failure.get('index') for failure in failures)
+        if not failed:
+            return batch, []
+        stale = set(batch[index][0] for index in failed if batch[index][0] in vids)
+        for email in stale:
+            self.resolver.forget(portal, email)
+        with self._lock:
+            self.failed += len(failed) - len(stale)
+            self._dropped.setdefault(portal, set()).update(batch[index][0] for index in failed
+                                                           if batch[index][0] not in stale)
+        return [update for index, update in enumerate(batch) if index not in failed or update[0] in stale], list(stale)
+
+    def _requeue(self, portal, batch):
+        """
+        Puts a batch that failed transiently back, under any newer buffered values,
+        so the next flush retries it.
+        """
+        with self._lock:
+            buffer = self._buffers.setdefault(portal, OrderedDict())
+            for email, properties in batch:
+                properties = dict(properties, **buffer.pop(email, {}))
+                buffer[email] = properties
+
+    def _portal_lock(self, portal):
+        with self._lock:
+            return self._portal_locks.setdefault(portal, threading.Lock())
+
+
+class _PortalWriter(object):
+    def __init__(self, writer, portal):
+        self.writer = writer
+        self.portal = portal
+
+    def __call__(self, email, properties):
+        self.writer.write(self.portal, email, properties)
+
+    def flush(self):
+        """
+        Writes the portal's buffer and returns the emails HubSpot rejected.
+        """
+        self.writer.flush(self.portal)
+        return self.writer.dropped(self.portal)
+
+
+def bearer_headers(access_token):
+    """
+    Authorization headers for HubSpot API requests made with an access token.
+    """
+    return {'Authorization': 'Bearer {}'.format(access_token)}
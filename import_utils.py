@@ -0,0 +1,40 @@
+import importlib
+import threading
+
+__all__ = ['lazy_import']
+
+
+class LazyImport(object):
+    """
+    Stands in for a module (or an attribute of one) and imports it on first use,
+    so routes that never touch a heavy client don't pay for importing it.
+    """
+    def __init__(self, module_name, attribute=None):
+        self._module_name = module_name
+        self._attribute = attribute
+        self._target = None
+        self._lock = threading.Lock()
+
+    def _resolve(self):
+        if self._target is None:
+            with self._lock:
+                if self._target is None:
+                    target = importlib.import_module(self._module_name)
+                    if self._attribute:
+                        target = getattr(target, self._attribute)
+                    self._target = target
+        return self._target
+
+    def __getattr__(self, name):
+        return getattr(self._resolve(), name)
+
+    def __call__(self, *args, **kwargs):
+        return self._resolve()(*args, **kwargs)
+
+    def __repr__(self):
+        name = self._module_name + ('.' + self._attribute if self._attribute else '')
+        return '<lazy {} ({})>'.format(name, 'loaded' if self._target is not None else 'not loaded')
+
+
+def lazy_import(module_name, attribute=None):
+    return LazyImport(module_name, attribute)
@@ -0,0 +1,281 @@
+import copy
+import hashlib
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+import uuid
+from collections import namedtuple, OrderedDict
+
+from pynamodb.exceptions import UpdateError
+from werkzeug.exceptions import BadRequest
+
+from cache_utils import TTLCache
+from dynamodb_utils import IngestQueueItem
+
+__all__ = ['DynamoIngestQueue', 'EventCoalescer', 'IngestEvent', 'IngestQueue', 'parse_bc_webhook',
+           'drain_ingest_queue']
+
+INGEST_BATCH_SIZE = int(os.environ.get('INGEST_BATCH_SIZE', 100))
+INGEST_VISIBILITY_TIMEOUT = int(os.environ.get('INGEST_VISIBILITY_TIMEOUT', 60))
+INGEST_COALESCE_WINDOW = float(os.environ.get('INGEST_COALESCE_WINDOW', 10))
+INGEST_DEDUPE_TTL = int(os.environ.get('INGEST_DEDUPE_TTL', 3600))
+INGEST_DEDUPE_MAX_SIZE = int(os.environ.get('INGEST_DEDUPE_MAX_SIZE', 100000))
+INGEST_RETENTION = int(os.environ.get('INGEST_RETENTION', 14 * 86400))
+INGEST_QUEUE_SHARDS = int(os.environ.get('INGEST_QUEUE_SHARDS', 8))
+
+IngestEvent = namedtuple('IngestEvent', ['id', 'kind', 'bc_store_hash', 'payload', 'enqueued_at'])
+
+
+class IngestQueue(object):
+    """
+    At-least-once queue of webhook events in a local SQLite file, for local runs and
+    tests
+    """
+    def __init__(self, path, visibility_timeout=INGEST_VISIBILITY_TIMEOUT):
+        self.path = path
+        self.visibility_timeout = visibility_timeout
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS events ('
+                         'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                         'kind TEXT NOT NULL, '
+                         'bc_store_hash TEXT NOT NULL, '
+                         'payload TEXT NOT NULL, '
+                         'enqueued_at REAL NOT NULL, '
+                         'claimed_until REAL NOT NULL DEFAULT 0)')
+            conn.execute('CREATE INDEX IF NOT EXISTS events_claimed_until ON events (claimed_until, id)')
+
+    def put(self, kind, bc_store_hash, payload):
+        with self._connection() as conn:
+            conn.execute('INSERT INTO events (kind, bc_store_hash, payload, enqueued_at) VALUES (?, ?, ?, ?)',
+                         (kind, bc_store_hash, json.dumps(payload), time.time()))
+
+    def claim(self, batch_size=INGEST_BATCH_SIZE, min_age=0):
+        """
+        Claims up to batch_size events that have been queued for at least min_age
+        seconds, leaving younger ones for later deliveries to coalesce with.
+        """
+        now = time.time()
+        conn = self._connection()
+        with conn:
+            rows = conn.execute('SELECT id, kind, bc_store_hash, payload, enqueued_at FROM events '
+                                'WHERE claimed_until < ? AND enqueued_at <= ? ORDER BY id LIMIT ?',
+                                (now, now - min_age, batch_size)).fetchall()
+            conn.executemany('UPDATE events SET claimed_until = ? WHERE id = ?',
+                             [(now + self.visibility_timeout, row[0]) for row in rows])
+        return [IngestEvent(row[0], row[1], row[2], json.loads(row[3]), row[4]) for row in rows]
+
+    def ack(self, events):
+        with self._connection() as conn:
+            conn.executemany('DELETE FROM events WHERE id = ?', [(event.id,) for event in events])
+
+    def depth(self):
+        return self._connection().execute('SELECT COUNT(*) FROM events').fetchone()[0]
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = _Transaction(conn)
+            conn = self._local.conn
+        return conn
+
+
+def _event_id(timestamp, suffix=''):
+    """
+    Sort key that orders events by the millisecond they were queued in.
+    """
+    return '{:013d}-{}'.format(int(timestamp * 1000), suffix)
+
+
+class DynamoIngestQueue(object):
+    """
+    At-least-once queue of webhook events in DynamoDB, with IngestQueue's interface,
+    spread over `shards` partitions. Claims are conditional updates of claimed_until.
+    """
+    def __init__(self, name='ingest', visibility_timeout=INGEST_VISIBILITY_TIMEOUT, retention=INGEST_RETENTION,
+                 shards=INGEST_QUEUE_SHARDS):
+        self.name = name
+        self.visibility_timeout = visibility_timeout
+        self.retention = retention
+        self.shards = shards
+
+    def put(self, kind, bc_store_hash, payload):
+        now = time.time()
+        shard = random.randrange(self.shards)
+        IngestQueueItem(self._partition(shard), _event_id(now, '{}.{}'.format(shard, uuid.uuid4().hex[:12])),
+                        kind=kind, bc_store_hash=bc_store_hash, payload=json.dumps(payload), enqueued_at=now,
+                        expires_at=int(now) + self.retention).save()
+
+    def claim(self, batch_size=INGEST_BATCH_SIZE, min_age=0):
+        """
+        Claims up to batch_size of the oldest unclaimed events queued at least
+        min_age seconds ago, across all shards.
+        """
+        now = time.time()
+        events = []
+        candidates = []
+        for shard in range(self.shards):
+            candidates.extend(IngestQueueItem.query(self._partition(shard),
+                                                    IngestQueueItem.event_id <= _event_id(now - min_age, '~'),
+                                                    filter_condition=IngestQueueItem.claimed_until < now,
+                                                    limit=batch_size))
+        for item in sorted(candidates, key=lambda item: item.event_id):
+            try:
+                item.update(actions=[IngestQueueItem.claimed_until.set(now + self.visibility_timeout)],
+                            condition=IngestQueueItem.event_id.exists() & (IngestQueueItem.claimed_until < now))
+            except UpdateError:
+                continue
+            events.append(IngestEvent(item.event_id, item.kind, item.bc_store_hash, json.loads(item.payload),
+                                      item.enqueued_at))
+            if len(events) >= batch_size:
+                break
+        return events
+
+    def ack(self, events):
+        with IngestQueueItem.batch_write() as batch:
+            for event in events:
+                shard = int(event.id.split('-', 1)[1].split('.', 1)[0])
+                batch.delete(IngestQueueItem(self._partition(shard), event.id))
+
+    def depth(self):
+        return sum(IngestQueueItem.count(self._partition(shard)) for shard in range(self.shards))
+
+    def _partition(self, shard):
+        return '{}#{}'.format(self.name, shard)
+
+
+class _Transaction(object):
+    """
+    Autocommit sqlite3 connection whose context manager wraps a write transaction.
+    """
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+    def __enter__(self):
+        self.conn.execute('BEGIN IMMEDIATE')
+        return self.conn
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.conn.execute('ROLLBACK' if exc_type else 'COMMIT')
+
+
+def parse_bc_webhook(body):
+    """
+    Validates a BigCommerce webhook delivery and returns (bc_store_hash, payload).
+    """
+    try:
+        payload = json.loads(body)
+    except (TypeError, ValueError):
+        raise BadRequest('Webhook body is not JSON')
+    if not isinstance(payload, dict) or not isinstance(payload.get('data'), dict):
+        raise BadRequest('Webhook body has no data')
+    producer = payload.get('producer') or ''
+    if not producer.startswith('stores/') or not payload.get('scope') or 'id' not in payload['data']:
+        raise BadRequest('Webhook body is missing producer, scope or data.id')
+    return producer.split('/', 1)[1], payload
+
+
+class EventCoalescer(object):
+    """
+    Reduces a batch of webhook events to the net change per resource, dropping
+    redeliveries and order status changes that ended where they started.
+    """
+    def __init__(self, dedupe_ttl=INGEST_DEDUPE_TTL, dedupe_max_size=INGEST_DEDUPE_MAX_SIZE):
+        self._seen = TTLCache(max_size=dedupe_max_size, ttl=dedupe_ttl)
+        self.received = 0
+        self.duplicates = 0
+        self.forwarded = 0
+
+    def coalesce(self, events):
+        """
+        The net change of a batch. Deliveries only count as seen once remember()
+        is called for the batch, so a batch that fails and is claimed again is not
+        dropped as a duplicate of itself.
+        """
+        groups = OrderedDict()
+        batch_hashes = set()
+        for event in events:
+            self.received += 1
+            delivery_hash = _delivery_hash(event)
+            if delivery_hash in self._seen or delivery_hash in batch_hashes:
+                self.duplicates += 1
+                continue
+            batch_hashes.add(delivery_hash)
+            key = (event.bc_store_hash, event.kind, event.payload['data']['id'])
+            groups.setdefault(key, []).append(event)
+
+        merged = [event for event in (_merge_group(group) for group in groups.values()) if event]
+        self.forwarded += len(merged)
+        return merged
+
+    def remember(self, events):
+        """
+        Marks the deliveries of a handled and acked batch as seen.
+        """
+        for event in events:
+            self._seen.set(_delivery_hash(event), True)
+
+    def stats(self):
+        return dict(received=self.received,
+                    duplicates=self.duplicates,
+                    forwarded=self.forwarded,
+                    reduction=1 - float(self.forwarded) / self.received if self.received else 0.0)
+
+
+def _delivery_hash(event):
+    return event.payload.get('hash') or _payload_hash(event.payload)
+
+
+def _payload_hash(payload):
+    return hashlib.sha1(json.dumps(payload, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def _merge_group(group):
+    group = sorted(group, key=lambda event: (event.payload.get('created_at', 0), event.id))
+    latest = group[-1]
+    if len(group) == 1:
+        return latest
+
+    payload = copy.deepcopy(latest.payload)
+    payload['coalesced'] = len(group)
+    created = any(event.payload.get('scope') == 'store/order/created' for event in group)
+    statuses = [event.payload['data'].get('status') for event in group if event.payload['data'].get('status')]
+    if statuses:
+        status = dict(payload['data'].get('status') or statuses[-1])
+        status['previous_status_id'] = statuses[0].get('previous_status_id')
+        payload['data']['status'] = status
+        if not created and status['previous_status_id'] == status.get('new_status_id'):
+            return None
+    if created:
+        payload['scope'] = 'store/order/created'
+    return latest._replace(payload=payload)
+
+
+def drain_ingest_queue(queue, handler, batch_size=INGEST_BATCH_SIZE, max_batches=None, coalescer=None,
+                       min_age=INGEST_COALESCE_WINDOW, deadline=None):
+    """
+    Claims, handles and acks batches until the queue is empty, max_batches were handled
+    or the deadline passed. Returns the number of events handled.
+    """
+    handled = 0
+    batches = 0
+    while (max_batches is None or batches < max_batches) and (deadline is None or time.time() < deadline):
+        events = queue.claim(batch_size, min_age=min_age if coalescer is not None else 0)
+        if not events:
+            break
+        handler(coalescer.coalesce(events) if coalescer is not None else events)
+        queue.ack(events)
+        if coalescer is not None:
+            coalescer.remember(events)
+        handled += len(events)
+        batches += 1
+    return handled
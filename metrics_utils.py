@@ -0,0 +1,223 @@
+from array import array
+
+from import_utils import lazy_import
+from rolling_utils import AMOUNT_SCALE, ROLLING_DAYS, ROLLING_WINDOWS, RollingWindows, epoch_day
+from sync_utils import EXCLUDED_ORDER_STATUS_IDS, metrics_from_totals, order_email, parse_bc_date
+
+__all__ = ['OrderColumns', 'build_rolling_windows', 'compute_metrics_vectorized', 'iter_metric_rows',
+           'iter_order_totals', 'merge_order_totals', 'parse_bc_dates']
+
+np = lazy_import('numpy')
+
+_BC_DATE_WIDTH = len('Tue, 20 Nov 2012 00:00:00 +0000')
+_MONTHS_BY_KEY = sorted((ord(name[0]) << 16 | ord(name[1]) << 8 | ord(name[2]), number + 1) for number, name in
+                        enumerate(('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+                                   'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')))
+
+
+class OrderColumns(object):
+    """
+    Columnar buffer of orders in compact typed arrays, with customer emails interned to
+    integer codes
+    """
+    def __init__(self):
+        self.emails = []
+        self._codes = {}
+        self._customer = array('q')
+        self._total = array('d')
+        self._created = array('q')
+        self._status = array('h')
+        self._id = array('q')
+
+    def append(self, email, total, created, status_id, order_id):
+        code = self._codes.get(email)
+        if code is None:
+            code = self._codes[email] = len(self.emails)
+            self.emails.append(email)
+        self._customer.append(code)
+        self._total.append(total)
+        self._created.append(created)
+        self._status.append(status_id)
+        self._id.append(order_id)
+
+    def extend_orders(self, orders):
+        """
+        Appends a page of BigCommerce order dicts, column by column. Guest orders
+        without an email are skipped.
+        """
+        keyed = [(email, order) for email, order in ((order_email(order), order) for order in orders) if email]
+        codes = self._codes
+        for email, _ in keyed:
+            if email not in codes:
+                codes[email] = len(self.emails)
+                self.emails.append(email)
+        self._customer.extend([codes[email] for email, _ in keyed])
+        self._total.extend([float(order.get('total_inc_tax') or 0) for _, order in keyed])
+        self._created.frombytes(parse_bc_dates([order['date_created'] for _, order in keyed]).tobytes())
+        self._status.extend([int(order.get('status_id', 0)) for _, order in keyed])
+        self._id.extend([int(order['id']) for _, order in keyed])
+        return self
+
+    def __len__(self):
+        return len(self._customer)
+
+    def arrays(self):
+        return (np.frombuffer(self._customer, dtype=np.int64),
+                np.frombuffer(self._total, dtype=np.float64),
+                np.frombuffer(self._created, dtype=np.int64),
+                np.frombuffer(self._status, dtype=np.int16))
+
+    def order_ids(self):
+        return np.frombuffer(self._id, dtype=np.int64)
+
+
+def parse_bc_dates(values):
+    """
+    Vectorized parse_bc_date for a list of 'Tue, 20 Nov 2012 00:00:00 +0000'
+    strings, returning epoch seconds as int64. Values that don't have exactly that
+    layout fall back to parse_bc_date one by one.
+    """
+    raw = np.array([value.encode('ascii', 'replace') for value in values], dtype='S{}'.format(_BC_DATE_WIDTH))
+    chars = raw.view(np.uint8).reshape(len(values), _BC_DATE_WIDTH).astype(np.int64)
+    digits = chars - ord('0')
+
+    def number(start, width):
+        result = np.zeros(len(values), dtype=np.int64)
+        for offset in range(width):
+            result = result * 10 + digits[:, start + offset]
+        return result
+
+    known_keys = np.array([key for key, _ in _MONTHS_BY_KEY], dtype=np.int64)
+    known_numbers = np.array([number for _, number in _MONTHS_BY_KEY], dtype=np.int64)
+    month_keys = chars[:, 8] << 16 | chars[:, 9] << 8 | chars[:, 10]
+    month_index = np.searchsorted(known_keys, month_keys).clip(0, 11)
+    well_formed = ((chars[:, 3] == ord(',')) & (chars[:, 16] == ord(' ')) & (chars[:, 19] == ord(':')) &
+                   (chars[:, 25] == ord(' ')) & (known_keys[month_index] == month_keys) &
+                   np.array([len(value) == _BC_DATE_WIDTH for value in values], dtype=bool))
+
+    months = (number(12, 4) - 1970) * 12 + known_numbers[month_index] - 1
+    days = months.astype('datetime64[M]').astype('datetime64[D]').astype(np.int64) + number(5, 2) - 1
+    offset = (number(27, 2) * 3600 + number(29, 2) * 60) * np.where(chars[:, 26] == ord('-'), -1, 1)
+    seconds = days * 86400 + number(17, 2) * 3600 + number(20, 2) * 60 + number(23, 2) - offset
+
+    for index in np.flatnonzero(~well_formed):
+        seconds[index] = parse_bc_date(values[index])
+    return seconds
+
+
+def compute_metrics_vectorized(columns):
+    """
+    Metrics of every customer in columns from grouped NumPy reductions, as arrays
+    indexed by customer code.
+    """
+    customer, total, created, status = columns.arrays()
+    n_customers = len(columns.emails)
+
+    counted = ~np.isin(status, np.array(sorted(EXCLUDED_ORDER_STATUS_IDS), dtype=np.int16))
+    customer, total, created = customer[counted], total[counted], created[counted]
+
+    count = np.bincount(customer, minlength=n_customers)
+    raw_revenue = np.bincount(customer, weights=total, minlength=n_customers)
+
+    first = np.full(n_customers, -1, dtype=np.int64)
+    last = np.full(n_customers, -1, dtype=np.int64)
+    if len(customer):
+        order = np.argsort(customer, kind='stable')
+        sorted_customer, sorted_created = customer[order], created[order]
+        starts = np.flatnonzero(np.r_[True, sorted_customer[1:] != sorted_customer[:-1]])
+        present = sorted_customer[starts]
+        first[present] = np.minimum.reduceat(sorted_created, starts)
+        last[present] = np.maximum.reduceat(sorted_created, starts)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        average = np.where(count > 0, np.round(raw_revenue / count, 2), 0.0)
+        frequency = np.where(count > 1, np.round((last - first) / 86400.0 / (count - 1), 2), np.nan)
+
+    return dict(order_count=count, total_revenue=np.round(raw_revenue, 4), average_order_value=average,
+                first_order_at=first, last_order_at=last, purchase_frequency_days=frequency)
+
+
+def build_rolling_windows(columns, today=None):
+    """
+    Rebuilds each customer's RollingWindows as of today (epoch day) from their
+    counted orders of the last ROLLING_DAYS days, keyed by customer code.
+    Customers without such orders have no entry.
+    """
+    today = epoch_day() if today is None else today
+    customer, total, created, status = columns.arrays()
+    days = created // 86400
+    recent = ((days > today - ROLLING_DAYS) & (days <= today) &
+              ~np.isin(status, np.array(sorted(EXCLUDED_ORDER_STATUS_IDS), dtype=np.int16)))
+    amounts = np.round(total[recent] * AMOUNT_SCALE).astype(np.int64)
+    windows = {}
+    for code, order_id, day, amount in zip(customer[recent].tolist(), columns.order_ids()[recent].tolist(),
+                                           days[recent].tolist(), amounts.tolist()):
+        ring = windows.get(code)
+        if ring is None:
+            ring = windows[code] = RollingWindows(today)
+        ring.apply(order_id, day, amount, True)
+    return windows
+
+
+def iter_metric_rows(columns, metrics, today=None):
+    """
+    Yields (email, metrics) pairs shaped like compute_customer_metrics() output, with
+    rolling windows rebuilt as of today.
+    """
+    today = epoch_day() if today is None else today
+    windows = build_rolling_windows(columns, today)
+    for code, email in enumerate(columns.emails):
+        count = int(metrics['order_count'][code])
+        first = int(metrics['first_order_at'][code])
+        last = int(metrics['last_order_at'][code])
+        frequency = float(metrics['purchase_frequency_days'][code])
+        ring = windows.get(code) or RollingWindows(today)
+        row = dict(order_count=count,
+                   total_revenue=float(metrics['total_revenue'][code]),
+                   average_order_value=float(metrics['average_order_value'][code]),
+                   first_order_at=first if count else None,
+                   last_order_at=last if count else None,
+                   purchase_frequency_days=None if frequency != frequency else frequency,
+                   rolling=ring.to_bytes())
+        for days in ROLLING_WINDOWS:
+            row['orders_{}_days'.format(days)], row['revenue_{}_days'.format(days)] = ring.window(days)
+        yield email, row
+
+
+def iter_order_totals(columns, today=None):
+    """
+    Yields (email, totals) for every customer in columns: their counted orders'
+    number, amount in AMOUNT_SCALE units, first and last order and rolling windows,
+    which merge_order_totals() adds up over every chunk of a customer's orders.
+    """
+    today = epoch_day() if today is None else today
+    metrics = compute_metrics_vectorized(columns)
+    windows = build_rolling_windows(columns, today)
+    for code, email in enumerate(columns.emails):
+        count = int(metrics['order_count'][code])
+        ring = windows.get(code)
+        yield email, dict(order_count=count,
+                          amount=int(round(float(metrics['total_revenue'][code]) * AMOUNT_SCALE)),
+                          first_order_at=int(metrics['first_order_at'][code]) if count else None,
+                          last_order_at=int(metrics['last_order_at'][code]) if count else None,
+                          rolling=ring.to_bytes() if ring is not None else None)
+
+
+def merge_order_totals(totals, today=None):
+    """
+    One customer's metrics, shaped like compute_customer_metrics() output, from the
+    totals (items with iter_order_totals() attributes) of every chunk of their orders.
+    """
+    windows = RollingWindows(epoch_day() if today is None else today)
+    count = amount = 0
+    first = last = None
+    for chunk in totals:
+        count += int(chunk.order_count)
+        amount += int(chunk.amount)
+        if chunk.first_order_at is not None:
+            first = int(chunk.first_order_at) if first is None else min(first, int(chunk.first_order_at))
+            last = int(chunk.last_order_at) if last is None else max(last, int(chunk.last_order_at))
+        if chunk.rolling is not None:
+            for order_id, (day, order_amount) in RollingWindows.from_bytes(chunk.rolling).orders.items():
+                windows.apply(order_id, day, order_amount, True)
+    return metrics_from_totals(count, amount, first, last, windows)
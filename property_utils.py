@@ -0,0 +1,125 @@
+import hashlib
+import json
+import os
+import threading
+
+from cache_utils import TTLCache
+from dynamodb_utils import AppUser
+from http_utils import get_http_session
+from hubspot_utils import HS_API_BASE, bearer_headers
+from sync_utils import METRIC_PROPERTIES
+
+__all__ = ['PROPERTY_GROUP', 'PROPERTY_SCHEMA_VERSION', 'PropertyProvisioner', 'desired_properties',
+           'plan_property_changes']
+
+HS_PROPERTIES_URI = HS_API_BASE + '/crm/v3/properties/contacts'
+PROPERTY_SCHEMA_CACHE_TTL = int(os.environ.get('PROPERTY_SCHEMA_CACHE_TTL', 3600))
+PROPERTY_SCHEMA_CACHE_MAX_SIZE = int(os.environ.get('PROPERTY_SCHEMA_CACHE_MAX_SIZE', 1000))
+
+PROPERTY_GROUP = {'name': 'hubmetrix', 'label': 'Hubmetrix', 'displayOrder': -1}
+
+# The attributes of a property we own; anything else HubSpot reports is ignored when diffing.
+_COMPARED = ('label', 'type', 'fieldType', 'groupName', 'description')
+
+
+def _label(hs_name):
+    return hs_name.replace('hubmetrix_', '').replace('_', ' ').capitalize()
+
+
+def desired_properties():
+    properties = []
+    for name, hs_name in METRIC_PROPERTIES:
+        kind = 'date' if name.endswith('_at') else 'number'
+        properties.append({'name': hs_name,
+                           'label': _label(hs_name),
+                           'type': kind,
+                           'fieldType': kind,
+                           'groupName': PROPERTY_GROUP['name'],
+                           'description': 'Calculated by Hubmetrix from BigCommerce orders'})
+    return properties
+
+
+PROPERTY_SCHEMA_VERSION = hashlib.sha1(json.dumps([PROPERTY_GROUP, desired_properties()],
+                                                  sort_keys=True).encode('utf-8')).hexdigest()[:12]
+
+
+def plan_property_changes(existing, desired):
+    """
+    Diffs a portal's properties (dict of name to property) against the desired
+    ones. Returns (missing, changed) lists of desired property definitions.
+    """
+    missing = []
+    changed = []
+    for prop in desired:
+        current = existing.get(prop['name'])
+        if current is None:
+            missing.append(prop)
+        elif any(current.get(key) != prop[key] for key in _COMPARED):
+            changed.append(prop)
+    return missing, changed
+
+
+class PropertyProvisioner(object):
+    """
+    Makes sure a portal has the Hubmetrix property group and contact properties, writing
+    only what is missing or changed.
+    """
+    def __init__(self, ttl=PROPERTY_SCHEMA_CACHE_TTL, max_size=PROPERTY_SCHEMA_CACHE_MAX_SIZE):
+        self._schemas = TTLCache(max_size=max_size, ttl=ttl)
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+
+    @staticmethod
+    def is_provisioned(user):
+        return bool(user.hs_properties_exist) and user.hs_properties_version == PROPERTY_SCHEMA_VERSION
+
+    def ensure(self, user, access_token):
+        """
+        Provisions the user's portal if needed. Returns the AppUser attributes that
+        were updated and persisted, empty when nothing had to be done.
+        """
+        if self.is_provisioned(user):
+            return []
+        portal = user.hs_hub_id or user.bc_store_hash
+        with self._lock_for(portal):
+            schema = self._schemas.get(portal)
+            if schema is None or schema['version'] != PROPERTY_SCHEMA_VERSION:
+                schema = self._provision(access_token)
+                self._schemas.set(portal, schema)
+        user.update(actions=[AppUser.hs_properties_exist.set(True),
+                             AppUser.hs_properties_version.set(PROPERTY_SCHEMA_VERSION)])
+        return ['hs_properties_exist', 'hs_properties_version']
+
+    def invalidate(self, portal):
+        self._schemas.invalidate(portal)
+
+    def _provision(self, access_token):
+        session = get_http_session('hubspot')
+        headers = bearer_headers(access_token)
+
+        group = session.get(HS_PROPERTIES_URI + '/groups/' + PROPERTY_GROUP['name'], headers=headers)
+        if group.status_code == 404:
+            session.post(HS_PROPERTIES_URI + '/groups', json=PROPERTY_GROUP, headers=headers).raise_for_status()
+        else:
+            group.raise_for_status()
+
+        response = session.get(HS_PROPERTIES_URI, headers=headers)
+        response.raise_for_status()
+        existing = dict((prop['name'], prop) for prop in response.json().get('results', []))
+
+        missing, changed = plan_property_changes(existing, desired_properties())
+        if missing:
+            session.post(HS_PROPERTIES_URI + '/batch/create', json={'inputs': missing},
+                         headers=headers).raise_for_status()
+        for prop in changed:
+            updates = dict((key, prop[key]) for key in _COMPARED)
+            session.patch(HS_PROPERTIES_URI + '/' + prop['name'], json=updates, headers=headers).raise_for_status()
+
+        for prop in missing + changed:
+            existing[prop['name']] = prop
+        return dict(version=PROPERTY_SCHEMA_VERSION, properties=existing, created=len(missing),
+                    updated=len(changed))
+
+    def _lock_for(self, portal):
+        with self._locks_lock:
+            return self._locks.setdefault(portal, threading.Lock())
@@ -0,0 +1,228 @@
+import hashlib
+import os
+import threading
+import time
+
+from flask import has_request_context
+from werkzeug.exceptions import ServiceUnavailable
+
+__all__ = ['OutboundScheduler', 'RateLimitedAdapter', 'TokenBucket', 'outbound_scheduler']
+
+# Starting points until an upstream's response headers say otherwise: BigCommerce's
+# standard plan quota of 150 requests per 30 s per store, and HubSpot's 100 requests
+# per 10 s per portal.
+BC_RATE_LIMIT_REQUESTS = int(os.environ.get('BC_RATE_LIMIT_REQUESTS', 150))
+BC_RATE_LIMIT_WINDOW = float(os.environ.get('BC_RATE_LIMIT_WINDOW', 30))
+HS_RATE_LIMIT_REQUESTS = int(os.environ.get('HS_RATE_LIMIT_REQUESTS', 100))
+HS_RATE_LIMIT_WINDOW = float(os.environ.get('HS_RATE_LIMIT_WINDOW', 10))
+RATE_LIMIT_MAX_RETRIES = int(os.environ.get('RATE_LIMIT_MAX_RETRIES', 4))
+RATE_LIMIT_MAX_WAIT = float(os.environ.get('RATE_LIMIT_MAX_WAIT', 60))
+# Inside a request the user is waiting, and API Gateway gives up after 29 s.
+RATE_LIMIT_REQUEST_MAX_WAIT = float(os.environ.get('RATE_LIMIT_REQUEST_MAX_WAIT', 3))
+
+# (quota, window ms, remaining, reset ms) response headers per upstream.
+RATE_LIMIT_HEADERS = {
+    'bigcommerce': ('X-Rate-Limit-Requests-Quota', 'X-Rate-Limit-Time-Window-Ms', 'X-Rate-Limit-Requests-Left',
+                    'X-Rate-Limit-Time-Reset-Ms'),
+    'hubspot': ('X-HubSpot-RateLimit-Max', 'X-HubSpot-RateLimit-Interval-Milliseconds',
+                'X-HubSpot-RateLimit-Remaining', None),
+}
+
+
+class TokenBucket(object):
+    """
+    Thread-safe token bucket. acquire() blocks callers while the bucket is empty
+    or paused, so work queues up instead of being sent into a limit.
+    """
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.paused_until = 0.0
+        self._updated = time.time()
+        self._cond = threading.Condition()
+
+    def acquire(self, max_wait=RATE_LIMIT_MAX_WAIT, overdraw=True):
+        """
+        Takes one token, waiting up to max_wait seconds for it; after that the call
+        goes ahead anyway and the upstream's 429 handling takes over, or without
+        overdraw None is returned and no token is taken. Returns the seconds waited.
+        """
+        start = time.time()
+        with self._cond:
+            while True:
+                now = time.time()
+                self._refill(now)
+                if now >= start + max_wait:
+                    if not overdraw:
+                        return None
+                    self.tokens -= 1
+                    return now - start
+                if now < self.paused_until:
+                    self._cond.wait(min(self.paused_until - now, start + max_wait - now))
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    return now - start
+                else:
+                    self._cond.wait(min((1 - self.tokens) / self.rate, start + max_wait - now))
+
+    def update(self, quota=None, window=None, remaining=None):
+        """
+        Adjusts the bucket to what the upstream reports: its quota per window (s),
+        and how much of it is left, which also counts other workers' calls.
+        """
+        with self._cond:
+            self._refill(time.time())
+            if quota and window:
+                self.rate = quota / float(window)
+                self.capacity = float(quota)
+            if remaining is not None:
+                self.tokens = min(self.tokens, float(remaining))
+            self._cond.notify_all()
+
+    def pause(self, seconds):
+        with self._cond:
+            self.tokens = min(self.tokens, 0.0)
+            self.paused_until = max(self.paused_until, time.time() + seconds)
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+
+class OutboundScheduler(object):
+    """
+    Shared rate limiting for outbound API calls, one token bucket per store or portal,
+    following each upstream's rate-limit headers and retrying 429s. Calls made inside a
+    request fail with a 503 after request_max_wait seconds.
+    """
+    def __init__(self, defaults=None, max_retries=RATE_LIMIT_MAX_RETRIES, max_wait=RATE_LIMIT_MAX_WAIT,
+                 request_max_wait=RATE_LIMIT_REQUEST_MAX_WAIT):
+        self.defaults = defaults or {'bigcommerce': (BC_RATE_LIMIT_REQUESTS, BC_RATE_LIMIT_WINDOW),
+                                     'hubspot': (HS_RATE_LIMIT_REQUESTS, HS_RATE_LIMIT_WINDOW)}
+        self.max_retries = max_retries
+        self.max_wait = max_wait
+        self.request_max_wait = request_max_wait
+        self._buckets = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, upstream, key):
+        with self._lock:
+            bucket = self._buckets.get((upstream, key))
+            if bucket is None:
+                quota, window = self.defaults.get(upstream, (100, 10))
+                bucket = self._buckets[(upstream, key)] = TokenBucket(quota / float(window), quota)
+            return bucket
+
+    def send(self, upstream, key, send):
+        """
+        Calls send() once a token is available and returns its response, retrying
+        429 responses up to max_retries times.
+        """
+        bucket = self.bucket(upstream, key)
+        interactive = has_request_context()
+        deadline = time.time() + self.request_max_wait
+        for attempt in range(self.max_retries + 1):
+            if interactive:
+                waited = bucket.acquire(max(deadline - time.time(), 0), overdraw=False)
+                if waited is None:
+                    self._count(upstream, self.request_max_wait, False, failed_fast=True)
+                    raise ServiceUnavailable('{} is rate limiting us, try again shortly'.format(upstream))
+            else:
+                waited = bucket.acquire(self.max_wait)
+            response = send()
+            self._observe(upstream, bucket, response)
+            limited = response.status_code == 429
+            self._count(upstream, waited, limited)
+            if not limited or attempt == self.max_retries:
+                return response
+            pause = self._retry_after(upstream, response, attempt)
+            bucket.pause(pause)
+            response.close()
+            if interactive and time.time() + pause > deadline:
+                self._count(upstream, 0, False, failed_fast=True)
+                raise ServiceUnavailable('{} is rate limiting us, try again shortly'.format(upstream))
+        return response
+
+    def stats(self):
+        with self._lock:
+            stats = dict((upstream, dict(counters)) for upstream, counters in self._counters.items())
+            for (upstream, _), bucket in self._buckets.items():
+                upstream_stats = stats.setdefault(upstream, dict(requests=0, waited_seconds=0.0, rate_limited=0,
+                                                                 failed_fast=0))
+                upstream_stats['buckets'] = upstream_stats.get('buckets', 0) + 1
+        for upstream_stats in stats.values():
+            upstream_stats['waited_seconds'] = round(upstream_stats['waited_seconds'], 3)
+        return stats
+
+    def _observe(self, upstream, bucket, response):
+        names = RATE_LIMIT_HEADERS.get(upstream)
+        if names is None:
+            return
+        headers = response.headers
+        quota, window_ms, remaining, reset_ms = [_number(headers.get(name)) if name else None for name in names]
+        bucket.update(quota=quota, window=window_ms / 1000.0 if window_ms else None, remaining=remaining)
+        if remaining == 0 and reset_ms and response.status_code != 429:
+            bucket.pause(reset_ms / 1000.0)
+
+    def _retry_after(self, upstream, response, attempt):
+        names = RATE_LIMIT_HEADERS.get(upstream) or (None, None, None, None)
+        for value in (response.headers.get('Retry-After'),
+                      _milliseconds(response.headers.get(names[3])) if names[3] else None):
+            seconds = _number(value)
+            if seconds:
+                return seconds
+        return min(2 ** attempt, self.max_wait)
+
+    def _count(self, upstream, waited, limited, failed_fast=False):
+        with self._lock:
+            counters = self._counters.setdefault(upstream, dict(requests=0, waited_seconds=0.0, rate_limited=0,
+                                                                failed_fast=0))
+            if failed_fast:
+                counters['failed_fast'] += 1
+            else:
+                counters['requests'] += 1
+            counters['waited_seconds'] += waited
+            counters['rate_limited'] += int(limited)
+
+
+class RateLimitedAdapter(object):
+    """
+    Wraps a requests transport adapter so every request goes through the scheduler.
+    Requests are bucketed by key, or by their Authorization header when key is
+    None, since HubSpot tokens are per portal.
+    """
+    def __init__(self, adapter, upstream, key=None, scheduler=None):
+        self.adapter = adapter
+        self.upstream = upstream
+        self.key = key
+        self.scheduler = scheduler or outbound_scheduler
+
+    def send(self, request, **kwargs):
+        key = self.key
+        if key is None:
+            authorization = request.headers.get('Authorization') or ''
+            key = hashlib.sha1(authorization.encode('utf-8')).hexdigest()[:16] if authorization else None
+        return self.scheduler.send(self.upstream, key, lambda: self.adapter.send(request, **kwargs))
+
+    def close(self):
+        self.adapter.close()
+
+    def __getattr__(self, name):
+        return getattr(self.adapter, name)
+
+
+def _number(value):
+    try:
+        return float(value) if value not in (None, '') else None
+    except (TypeError, ValueError):
+        return None
+
+
+def _milliseconds(value):
+    number = _number(value)
+    return number / 1000.0 if number is not None else None
+
+
+outbound_scheduler = OutboundScheduler()
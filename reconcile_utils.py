@@ -0,0 +1,246 @@
+import logging
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from pynamodb.connection import Connection
+from pynamodb.exceptions import TransactWriteError, UpdateError
+from pynamodb.transactions import TransactWrite
+
+from dynamodb_utils import AppUser
+from subscription_utils import subscription_is_active, subscription_store_hash
+
+__all__ = ['SubscriptionChange', 'SubscriptionReconciler', 'plan_subscription_changes', 'scan_app_users']
+
+logger = logging.getLogger(__name__)
+
+RECONCILE_SCAN_SEGMENTS = int(os.environ.get('RECONCILE_SCAN_SEGMENTS', 4))
+RECONCILE_WEBHOOK_WORKERS = int(os.environ.get('RECONCILE_WEBHOOK_WORKERS', 8))
+RECONCILE_WRITE_BATCH_SIZE = int(os.environ.get('RECONCILE_WRITE_BATCH_SIZE', 25))
+
+# Everything the join and the webhook toggles read. Items are loaded with this
+# projection, so they are only ever written with update().
+RECONCILE_ATTRIBUTES = ['bc_store_hash', 'bc_id', 'bc_access_token', 'bc_deleted', 'bc_webhooks_registered',
+                        'cb_subscription_id', 'cb_subscription_status', 'cb_subscription_version']
+
+# (user, subscription, {attribute name: new value}, webhooks) where webhooks is
+# True or False when the store's webhooks must be activated or deactivated.
+SubscriptionChange = namedtuple('SubscriptionChange', ['user', 'subscription', 'updates', 'webhooks'])
+
+
+def scan_app_users(segments=RECONCILE_SCAN_SEGMENTS, attributes=None):
+    """
+    Reads the whole AppUser table with one parallel scan segment per thread.
+    """
+    def scan_segment(segment):
+        return list(AppUser.scan(segment=segment, total_segments=segments, attributes_to_get=attributes))
+
+    with ThreadPoolExecutor(max_workers=segments) as pool:
+        return [user for users in pool.map(scan_segment, range(segments)) for user in users]
+
+
+def _pick(user, candidates):
+    """
+    The subscription a store should follow when several name it: the one it already
+    has, else the newest that is active, else the newest.
+    """
+    for sub in candidates:
+        if sub.id == user.cb_subscription_id:
+            return sub
+    newest = sorted(candidates, key=lambda sub: sub.updated_at or 0, reverse=True)
+    for sub in newest:
+        if subscription_is_active(sub.status):
+            return sub
+    return newest[0]
+
+
+def plan_subscription_changes(users, subscriptions):
+    """
+    Joins users with Chargebee subscriptions and returns (changes, counts). Unknown
+    subscriptions and older resource_versions are left alone.
+    """
+    by_store = {}
+    by_id = {}
+    for sub in subscriptions:
+        by_id[sub.id] = sub
+        bc_store_hash = subscription_store_hash(sub)
+        if bc_store_hash:
+            by_store.setdefault(bc_store_hash, []).append(sub)
+
+    changes = []
+    counts = dict(users=len(users), subscriptions=len(by_id), matched=0, unmatched=0, stale=0, in_sync=0,
+                  changed=0, webhooks_on=0, webhooks_off=0)
+    for user in users:
+        candidates = by_store.get(user.bc_store_hash)
+        sub = _pick(user, candidates) if candidates else by_id.get(user.cb_subscription_id)
+        if sub is None:
+            counts['unmatched'] += 1
+            continue
+        counts['matched'] += 1
+        version = sub.resource_version or 0
+        if user.cb_subscription_version and version and user.cb_subscription_version > version:
+            counts['stale'] += 1
+            continue
+
+        updates = {}
+        for name, value in (('cb_subscription_id', sub.id), ('cb_subscription_status', sub.status)):
+            if getattr(user, name) != value:
+                updates[name] = value
+        if version and user.cb_subscription_version != version:
+            updates['cb_subscription_version'] = version
+
+        active = subscription_is_active(sub.status) and not user.bc_deleted
+        webhooks = active if bool(user.bc_webhooks_registered) != active else None
+        if not updates and webhooks is None:
+            counts['in_sync'] += 1
+            continue
+        counts['changed'] += 1
+        if webhooks is not None:
+            counts['webhooks_on' if webhooks else 'webhooks_off'] += 1
+        changes.append(SubscriptionChange(user, sub, updates, webhooks))
+    return changes, counts
+
+
+class SubscriptionReconciler(object):
+    """
+    Brings every AppUser's subscription fields and webhooks in line with Chargebee.
+    Attributes are written with conditional updates first, and only stores whose write
+    went through have their webhooks toggled.
+    """
+    def __init__(self, list_subscriptions, toggle_webhooks, scan_segments=RECONCILE_SCAN_SEGMENTS,
+                 webhook_workers=RECONCILE_WEBHOOK_WORKERS, write_batch_size=RECONCILE_WRITE_BATCH_SIZE):
+        self.list_subscriptions = list_subscriptions
+        self.toggle_webhooks = toggle_webhooks
+        self.scan_segments = scan_segments
+        self.webhook_workers = webhook_workers
+        self.write_batch_size = write_batch_size
+
+    def run(self, dry_run=False, deadline=None):
+        timings = {}
+        started = time.time()
+
+        subscriptions = list(self.list_subscriptions())
+        timings['list'] = time.time() - started
+
+        phase = time.time()
+        users = scan_app_users(self.scan_segments, RECONCILE_ATTRIBUTES)
+        timings['scan'] = time.time() - phase
+
+        phase = time.time()
+        changes, counts = plan_subscription_changes(users, subscriptions)
+        timings['join'] = time.time() - phase
+
+        report = dict(join=counts, dry_run=dry_run)
+        if not dry_run:
+            phase = time.time()
+            changes, report['write'] = self._write(changes, deadline)
+            timings['write'] = time.time() - phase
+
+            phase = time.time()
+            toggled, report['webhooks'] = self._toggle(changes, deadline)
+            timings['webhooks'] = time.time() - phase
+
+            phase = time.time()
+            _, report['registered'] = self._write(toggled, deadline)
+            timings['registered'] = time.time() - phase
+
+        timings['total'] = time.time() - started
+        report['seconds'] = dict((name, round(seconds, 3)) for name, seconds in timings.items())
+        return report
+
+    def _toggle(self, changes, deadline=None):
+        """
+        Toggles the webhooks of changes that need it and returns the changes that
+        record each successful toggle in bc_webhooks_registered.
+        """
+        toggles = [change for change in changes if change.webhooks is not None]
+        counts = dict(toggled=0, failed=0, skipped=0)
+
+        def toggle(change):
+            if deadline is not None and time.time() >= deadline:
+                return None
+            try:
+                return bool(self.toggle_webhooks(change.user, change.webhooks))
+            except Exception:
+                logger.exception('Could not update webhooks of %s', change.user.bc_store_hash)
+                return False
+
+        toggled = []
+        if not toggles:
+            return toggled, counts
+        with ThreadPoolExecutor(max_workers=self.webhook_workers) as pool:
+            for change, ok in zip(toggles, pool.map(toggle, toggles)):
+                counts['skipped' if ok is None else 'toggled' if ok else 'failed'] += 1
+                if ok:
+                    toggled.append(SubscriptionChange(change.user, change.subscription,
+                                                      {'bc_webhooks_registered': change.webhooks}, None))
+        return toggled, counts
+
+    def _write(self, changes, deadline=None):
+        """
+        Applies changes with conditional updates and returns the ones written.
+        """
+        written = []
+        counts = dict(items=0, transactions=0, conflicts=0, retried_batches=0, skipped=0)
+        connection = Connection(region=AppUser.Meta.region, host=getattr(AppUser.Meta, 'host', None))
+        for start in range(0, len(changes), self.write_batch_size):
+            batch = changes[start:start + self.write_batch_size]
+            if deadline is not None and time.time() >= deadline:
+                counts['skipped'] += len(batch)
+                continue
+            try:
+                with TransactWrite(connection=connection) as transaction:
+                    for change in batch:
+                        transaction.update(change.user, self._actions(change), condition=self._condition(change))
+                counts['transactions'] += 1
+                counts['items'] += len(batch)
+                written.extend(batch)
+            except TransactWriteError:
+                counts['retried_batches'] += 1
+                for change in batch:
+                    try:
+                        change.user.update(actions=self._actions(change), condition=self._condition(change))
+                        counts['items'] += 1
+                        written.append(change)
+                    except UpdateError:
+                        logger.info('%s changed during reconciliation, left for the next run',
+                                    change.user.bc_store_hash)
+                        counts['conflicts'] += 1
+        return written, counts
+
+    @staticmethod
+    def _updates(change):
+        """
+        The attributes to write. A store whose webhooks will be toggled always has its
+        subscription status written, so the toggle waits on a write that went through.
+        """
+        updates = dict(change.updates)
+        if change.webhooks is not None:
+            updates.setdefault('cb_subscription_status', change.subscription.status)
+        return updates
+
+    @classmethod
+    def _actions(cls, change):
+        return [getattr(AppUser, name).set(value) for name, value in sorted(cls._updates(change).items())]
+
+    @classmethod
+    def _condition(cls, change):
+        """
+        The scanned values of the updated attributes, and of those the webhook
+        decision was based on, so concurrent writes win.
+        """
+        names = set(cls._updates(change))
+        if change.webhooks is not None:
+            names.update(['bc_deleted', 'bc_webhooks_registered'])
+        condition = AppUser.bc_store_hash.exists()
+        for name in sorted(names):
+            attribute = getattr(AppUser, name)
+            value = getattr(change.user, name)
+            if value is None:
+                condition &= attribute.does_not_exist()
+            elif value is False:
+                condition &= attribute.does_not_exist() | (attribute == False)  # noqa: E712
+            else:
+                condition &= attribute == value
+        return condition
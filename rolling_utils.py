@@ -0,0 +1,121 @@
+import struct
+import time
+import zlib
+from array import array
+
+__all__ = ['AMOUNT_SCALE', 'ROLLING_WINDOWS', 'RollingWindows', 'epoch_day']
+
+ROLLING_WINDOWS = (30, 90, 365)
+ROLLING_DAYS = max(ROLLING_WINDOWS)
+
+# Amounts are kept as integers in BigCommerce's precision of 1/10000 of a currency unit.
+AMOUNT_SCALE = 10000
+
+_HEADER = struct.Struct('<iI')
+_ORDER = struct.Struct('<qiq')
+
+
+def epoch_day(epoch_seconds=None):
+    return int((time.time() if epoch_seconds is None else epoch_seconds) // 86400)
+
+
+class RollingWindows(object):
+    """
+    Per-customer order counts and revenue in daily buckets over the last ROLLING_DAYS
+    days, with running totals for each of ROLLING_WINDOWS. Re-applying an order replaces
+    its contribution.
+    """
+    __slots__ = ('head_day', 'counts', 'amounts', 'window_counts', 'window_amounts', 'orders')
+
+    def __init__(self, head_day=None):
+        self.head_day = epoch_day() if head_day is None else head_day
+        self.counts = array('i', [0]) * ROLLING_DAYS
+        self.amounts = array('q', [0]) * ROLLING_DAYS
+        self.window_counts = [0] * len(ROLLING_WINDOWS)
+        self.window_amounts = [0] * len(ROLLING_WINDOWS)
+        self.orders = {}
+
+    def advance(self, day):
+        if day <= self.head_day:
+            return
+        for current in range(self.head_day + 1, min(day, self.head_day + ROLLING_DAYS) + 1):
+            for index, window in enumerate(ROLLING_WINDOWS):
+                expired = (current - window) % ROLLING_DAYS
+                self.window_counts[index] -= self.counts[expired]
+                self.window_amounts[index] -= self.amounts[expired]
+            slot = current % ROLLING_DAYS
+            self.counts[slot] = 0
+            self.amounts[slot] = 0
+        if day - self.head_day >= ROLLING_DAYS:
+            self.window_counts = [0] * len(ROLLING_WINDOWS)
+            self.window_amounts = [0] * len(ROLLING_WINDOWS)
+        self.head_day = day
+        oldest = day - ROLLING_DAYS
+        for order_id in [order_id for order_id, (order_day, _) in self.orders.items() if order_day <= oldest]:
+            del self.orders[order_id]
+
+    def covers(self, day):
+        return day > self.head_day - ROLLING_DAYS
+
+    def apply(self, order_id, day, amount, counted):
+        """
+        Sets an order's contribution: removes what it previously added, then adds it
+        again if it counts. Returns False for days outside the ring, whose previous
+        contribution is unknown.
+        """
+        self.advance(day)
+        if not self.covers(day):
+            return False
+        previous = self.orders.pop(order_id, None)
+        if previous is not None:
+            self._add(previous[0], -1, -previous[1])
+        if counted:
+            self.orders[order_id] = (day, amount)
+            self._add(day, 1, amount)
+        return True
+
+    def contribution(self, order_id):
+        return self.orders.get(order_id)
+
+    def window(self, days):
+        index = ROLLING_WINDOWS.index(days)
+        return self.window_counts[index], round(self.window_amounts[index] / AMOUNT_SCALE, 2)
+
+    def to_bytes(self):
+        orders = b''.join(_ORDER.pack(order_id, day, amount) for order_id, (day, amount) in sorted(self.orders.items()))
+        return zlib.compress(_HEADER.pack(self.head_day, len(self.orders)) + self.counts.tobytes() +
+                             self.amounts.tobytes() + orders)
+
+    @classmethod
+    def from_bytes(cls, data):
+        raw = zlib.decompress(data)
+        head_day, n_orders = _HEADER.unpack_from(raw)
+        windows = cls(head_day)
+        offset = _HEADER.size
+        windows.counts = array('i')
+        windows.counts.frombytes(raw[offset:offset + ROLLING_DAYS * windows.counts.itemsize])
+        offset += ROLLING_DAYS * windows.counts.itemsize
+        windows.amounts = array('q')
+        windows.amounts.frombytes(raw[offset:offset + ROLLING_DAYS * windows.amounts.itemsize])
+        offset += ROLLING_DAYS * windows.amounts.itemsize
+        for _ in range(n_orders):
+            order_id, day, amount = _ORDER.unpack_from(raw, offset)
+            windows.orders[order_id] = (day, amount)
+            offset += _ORDER.size
+        windows._recount()
+        return windows
+
+    def _add(self, day, count, amount):
+        slot = day % ROLLING_DAYS
+        self.counts[slot] += count
+        self.amounts[slot] += amount
+        for index, window in enumerate(ROLLING_WINDOWS):
+            if day > self.head_day - window:
+                self.window_counts[index] += count
+                self.window_amounts[index] += amount
+
+    def _recount(self):
+        for index, window in enumerate(ROLLING_WINDOWS):
+            slots = [(self.head_day - offset) % ROLLING_DAYS for offset in range(window)]
+            self.window_counts[index] = sum(self.counts[slot] for slot in slots)
+            self.window_amounts[index] = sum(self.amounts[slot] for slot in slots)
@@ -0,0 +1,146 @@
+import heapq
+import logging
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from dynamodb_utils import AppUser
+from subscription_utils import INACTIVE_SUBSCRIPTION_STATUSES
+from sync_utils import SyncConflict, parse_watermark
+
+__all__ = ['StoreLag', 'SyncScheduler', 'scan_syncable_stores']
+
+logger = logging.getLogger(__name__)
+
+SCHEDULER_SCAN_SEGMENTS = int(os.environ.get('SCHEDULER_SCAN_SEGMENTS', 4))
+SCHEDULER_MAX_WORKERS = int(os.environ.get('SCHEDULER_MAX_WORKERS', 8))
+SCHEDULER_MAX_PER_PORTAL = int(os.environ.get('SCHEDULER_MAX_PER_PORTAL', 1))
+
+StoreLag = namedtuple('StoreLag', ['bc_store_hash', 'portal', 'lag_seconds', 'waited_seconds', 'run_seconds',
+                                   'outcome'])
+
+
+def scan_syncable_stores(segments=SCHEDULER_SCAN_SEGMENTS):
+    """
+    Scans AppUser with one parallel scan segment per thread, keeping stores that
+    have webhooks registered, a HubSpot connection, a subscription that isn't
+    cancelled or paused and no backfill in progress.
+    """
+    condition = ((AppUser.bc_webhooks_registered == True) &
+                 (AppUser.bc_deleted == False) &
+                 AppUser.hs_access_token.exists() &
+                 (AppUser.cb_subscription_status.does_not_exist() |
+                  ~AppUser.cb_subscription_status.is_in(*INACTIVE_SUBSCRIPTION_STATUSES)))
+
+    def scan_segment(segment):
+        return [user for user in AppUser.scan(condition, segment=segment, total_segments=segments)
+                if not user.hm_backfill_started_at or user.hm_backfill_completed_at]
+
+    with ThreadPoolExecutor(max_workers=segments) as pool:
+        return [user for users in pool.map(scan_segment, range(segments)) for user in users]
+
+
+class SyncScheduler(object):
+    """
+    Runs sync(user) for many stores, stalest first, with at most max_workers syncs at
+    once and max_per_portal per HubSpot portal.
+    """
+    def __init__(self, sync, max_workers=SCHEDULER_MAX_WORKERS, max_per_portal=SCHEDULER_MAX_PER_PORTAL):
+        self.sync = sync
+        self.max_workers = max_workers
+        self.max_per_portal = max_per_portal
+
+    def run(self, users, deadline=None):
+        """
+        Syncs users until all are done or the deadline (epoch seconds) passes, after
+        which no new syncs start. Returns a report with each store's lag.
+        """
+        start = time.time()
+        queue = []
+        for user in users:
+            watermark = parse_watermark(user.hm_last_sync_timestamp) or 0
+            heapq.heappush(queue, (watermark, user.bc_store_hash, user))
+
+        lags = []
+        running = {}
+        in_flight = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            while queue or running:
+                while queue and len(running) < self.max_workers and (deadline is None or time.time() < deadline):
+                    entry = self._next_runnable(queue, in_flight)
+                    if entry is None:
+                        break
+                    user = entry[2]
+                    portal = self._portal(user)
+                    in_flight[portal] = in_flight.get(portal, 0) + 1
+                    running[pool.submit(self._run_one, user, start)] = portal
+                if deadline is not None and time.time() >= deadline and not running:
+                    break
+                if not running:
+                    continue
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    in_flight[running.pop(future)] -= 1
+                    lags.append(future.result())
+
+        now = time.time()
+        deferred = [StoreLag(user.bc_store_hash, self._portal(user), _lag(user, now), now - start, 0.0, 'deferred')
+                    for _, _, user in queue]
+        return self.report(lags + deferred, now - start)
+
+    @staticmethod
+    def report(lags, seconds):
+        """
+        Summarizes StoreLag rows. Lag is how far each store's order watermark was
+        behind when its sync started; never synced stores have no lag.
+        """
+        ordered = sorted(lag.lag_seconds for lag in lags if lag.lag_seconds is not None)
+        outcomes = {}
+        for lag in lags:
+            outcomes[lag.outcome] = outcomes.get(lag.outcome, 0) + 1
+        return dict(stores=len(lags),
+                    seconds=round(seconds, 3),
+                    outcomes=outcomes,
+                    lag_p50=ordered[len(ordered) // 2] if ordered else 0,
+                    lag_max=ordered[-1] if ordered else 0,
+                    never_synced=len(lags) - len(ordered),
+                    max_wait=round(max([lag.waited_seconds for lag in lags] or [0]), 3),
+                    lags=[dict(lag._asdict()) for lag in
+                          sorted(lags, key=lambda lag: -(lag.lag_seconds if lag.lag_seconds is not None else -1))])
+
+    def _next_runnable(self, queue, in_flight):
+        skipped = []
+        entry = None
+        while queue:
+            candidate = heapq.heappop(queue)
+            if in_flight.get(self._portal(candidate[2]), 0) < self.max_per_portal:
+                entry = candidate
+                break
+            skipped.append(candidate)
+        for candidate in skipped:
+            heapq.heappush(queue, candidate)
+        return entry
+
+    def _run_one(self, user, scheduled_at):
+        started = time.time()
+        lag = _lag(user, started)
+        try:
+            self.sync(user)
+            outcome = 'synced'
+        except SyncConflict:
+            outcome = 'conflict'
+        except Exception:
+            logger.exception('Scheduled sync of %s failed, it will resume from its watermark', user.bc_store_hash)
+            outcome = 'failed'
+        return StoreLag(user.bc_store_hash, self._portal(user), lag, round(started - scheduled_at, 3),
+                        round(time.time() - started, 3), outcome)
+
+    @staticmethod
+    def _portal(user):
+        return user.hs_hub_id or user.bc_store_hash
+
+
+def _lag(user, now):
+    watermark = parse_watermark(user.hm_last_sync_timestamp)
+    return int(now - watermark) if watermark else None
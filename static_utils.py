@@ -0,0 +1,502 @@
+import gzip
+import hashlib
+import io
+import json
+import logging
+import mimetypes
+import os
+import re
+import shutil
+import tempfile
+import time
+
+from flask import Response, request
+from jinja2 import ChoiceLoader, FileSystemLoader
+
+from import_utils import lazy_import
+
+__all__ = ['PRERENDERED_PAGES', 'build_static', 'install_static_assets', 'minify_css', 'minify_js',
+           'upload_static']
+
+logger = logging.getLogger(__name__)
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+TEMPLATES_DIR = os.path.join(ROOT, 'templates')
+STATIC_SOURCE_DIR = os.path.join(TEMPLATES_DIR, 'static')
+
+STATIC_ASSETS_ENABLED = os.environ.get('STATIC_ASSETS_ENABLED', '1') == '1'
+STATIC_BUILD_DIR = os.environ.get('STATIC_BUILD_DIR', os.path.join(ROOT, 'build'))
+# Where pages link assets from, e.g. a CloudFront distribution in front of the
+# bucket upload_static fills. Empty serves them from the app's /static route.
+STATIC_URL = os.environ.get('STATIC_URL', '').rstrip('/')
+STATIC_IMAGE_MAX_WIDTH = int(os.environ.get('STATIC_IMAGE_MAX_WIDTH', 1600))
+STATIC_IMAGE_QUALITY = int(os.environ.get('STATIC_IMAGE_QUALITY', 80))
+PAGE_MAX_AGE = int(os.environ.get('PAGE_MAX_AGE', 300))
+ASSET_MAX_AGE = 365 * 86400
+
+# Endpoints that render the same HTML for every visitor, built once per deploy.
+PRERENDERED_PAGES = {'get_started': '/getstarted',
+                     'release_notes': '/releasenotes',
+                     'maybe_cancel_plan': '/maybecancelplan',
+                     'maybe_reactivate_plan': '/maybereactivateplan'}
+
+ASSET_EXTENSIONS = frozenset(['.css', '.js', '.png', '.jpg', '.jpeg', '.gif', '.svg', '.ico', '.webp',
+                              '.woff', '.woff2', '.ttf'])
+IMAGE_EXTENSIONS = frozenset(['.png', '.jpg', '.jpeg'])
+COMPRESSIBLE_EXTENSIONS = frozenset(['.css', '.js', '.html', '.svg', '.json', '.ico', '.ttf'])
+# Preferred first; the value is the suffix of the precompressed file.
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+MANIFEST_NAME = 'manifest.json'
+
+Image = lazy_import('PIL.Image')
+brotli = lazy_import('brotli')
+rcssmin = lazy_import('rcssmin')
+rjsmin = lazy_import('rjsmin')
+boto3 = lazy_import('boto3')
+
+OPTIONAL_MODULES = ((Image, 'Pillow', 'images are copied without resizing or WebP/AVIF variants'),
+                    (brotli, 'brotli', 'only gzip precompressed files are built'),
+                    (rcssmin, 'rcssmin', 'CSS is minified by the built-in fallback'),
+                    (rjsmin, 'rjsmin', 'JS only has comments and indentation removed'))
+
+mimetypes.add_type('image/webp', '.webp')
+mimetypes.add_type('image/avif', '.avif')
+
+
+def _available(module):
+    try:
+        module.__name__
+    except ImportError:
+        return False
+    return True
+
+
+#
+# Minification
+#
+_CSS_TOKENS = re.compile(r'("(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\')|(/\*!.*?\*/)|/\*.*?\*/|(\s+)', re.S)
+_CSS_PUNCTUATION = re.compile(r' ?([{};,>]) ?')
+
+
+def _css_fallback(text):
+    parts = []
+    code = []
+
+    def flush():
+        if code:
+            chunk = _CSS_PUNCTUATION.sub(r'\1', ''.join(code)).replace(': ', ':').replace(';}', '}')
+            parts.append(chunk)
+            del code[:]
+
+    position = 0
+    for match in _CSS_TOKENS.finditer(text):
+        code.append(text[position:match.start()])
+        position = match.end()
+        string, license, space = match.groups()
+        if string or license:
+            flush()
+            parts.append(string or license)
+        elif space:
+            code.append(' ')
+    code.append(text[position:])
+    flush()
+    return ''.join(parts).strip()
+
+
+def minify_css(text):
+    """
+    Minifies a stylesheet with rcssmin when it is installed, otherwise by removing
+    comments and the whitespace around punctuation. Strings and /*! notices are
+    kept as they are.
+    """
+    if _available(rcssmin):
+        return rcssmin.cssmin(text, keep_bang_comments=True)
+    return _css_fallback(text)
+
+
+def _js_fallback(text):
+    lines = []
+    in_comment = False
+    for line in text.splitlines():
+        stripped = line.strip()
+        if not in_comment and stripped.startswith('/*') and not stripped.startswith('/*!'):
+            in_comment = True
+            stripped = stripped[2:]
+        if in_comment:
+            if '*/' not in stripped:
+                continue
+            in_comment = False
+            stripped = stripped.split('*/', 1)[1].strip()
+        if not stripped or stripped.startswith('//'):
+            continue
+        lines.append(stripped)
+    return '\n'.join(lines)
+
+
+def minify_js(text):
+    """
+    Minifies a script with rjsmin when it is installed. Otherwise it only drops
+    indentation, blank lines and whole line comments, keeping every line break
+    so semicolon insertion is unchanged.
+    """
+    if _available(rjsmin):
+        return rjsmin.jsmin(text, keep_bang_comments=True)
+    return _js_fallback(text)
+
+
+#
+# Build
+#
+def fingerprint(name, data):
+    """
+    img/logo.png -> img/logo.1a2b3c4d5e.png, so the file can be cached forever.
+    """
+    base, extension = os.path.splitext(name)
+    return '{}.{}{}'.format(base, hashlib.sha256(data).hexdigest()[:10], extension)
+
+
+def _gzip(data):
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode='wb', compresslevel=9, mtime=0) as compressed:
+        compressed.write(data)
+    return buffer.getvalue()
+
+
+def compressed_variants(data):
+    """
+    The gzip and, when the brotli module is installed, brotli encodings of data
+    that are smaller than data itself, keyed by file suffix.
+    """
+    variants = {'.gz': _gzip(data)}
+    if _available(brotli):
+        variants['.br'] = brotli.compress(data, quality=11)
+    return dict((suffix, body) for suffix, body in variants.items() if len(body) < len(data))
+
+
+def _encode_image(image, image_format, **options):
+    buffer = io.BytesIO()
+    image.save(buffer, image_format, **options)
+    return buffer.getvalue()
+
+
+def optimize_image(data, extension, max_width=STATIC_IMAGE_MAX_WIDTH, quality=STATIC_IMAGE_QUALITY):
+    """
+    Returns (data, variants): the image scaled and recompressed, and its smaller WebP
+    and AVIF encodings by extension.
+    """
+    if not _available(Image):
+        return data, {}
+    image = Image.open(io.BytesIO(data))
+    image.load()
+    if image.mode == 'P':
+        image = image.convert('RGBA')
+    resized = image.width > max_width
+    if resized:
+        height = int(round(image.height * max_width / float(image.width)))
+        image = image.resize((max_width, height), Image.LANCZOS)
+    if extension == '.png':
+        optimized = _encode_image(image, 'PNG', optimize=True)
+    else:
+        optimized = _encode_image(image.convert('RGB'), 'JPEG', quality=quality, optimize=True, progressive=True)
+    if len(optimized) >= len(data) and not resized:
+        optimized = data
+
+    variants = {'.webp': _encode_image(image, 'WEBP', quality=quality, method=6)}
+    if 'AVIF' in Image.registered_extensions().values():
+        variants['.avif'] = _encode_image(image, 'AVIF', quality=quality - 20)
+    return optimized, dict((suffix, body) for suffix, body in variants.items() if len(body) < len(optimized))
+
+
+def _write(path, data):
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(path, 'wb') as output:
+        output.write(data)
+
+
+def _write_compressed(path, data):
+    _write(path, data)
+    if os.path.splitext(path)[1] in COMPRESSIBLE_EXTENSIONS:
+        for suffix, body in compressed_variants(data).items():
+            _write(path + suffix, body)
+
+
+def build_assets(out_dir, source_dir=STATIC_SOURCE_DIR):
+    """
+    Minifies, recompresses and fingerprints templates/static into out_dir/static.
+    Returns the manifest's assets and images maps.
+    """
+    assets = {}
+    images = {}
+    for directory, _, files in os.walk(source_dir):
+        for file_name in sorted(files):
+            path = os.path.join(directory, file_name)
+            name = os.path.relpath(path, source_dir).replace(os.sep, '/')
+            extension = os.path.splitext(name)[1].lower()
+            if extension not in ASSET_EXTENSIONS:
+                continue
+            with open(path, 'rb') as source:
+                data = source.read()
+            variants = {}
+            if extension == '.css':
+                data = minify_css(data.decode('utf-8')).encode('utf-8')
+            elif extension == '.js':
+                data = minify_js(data.decode('utf-8')).encode('utf-8')
+            elif extension in IMAGE_EXTENSIONS:
+                data, variants = optimize_image(data, extension)
+
+            assets[name] = fingerprint(name, data)
+            _write_compressed(os.path.join(out_dir, 'static', assets[name]), data)
+            if variants:
+                base = os.path.splitext(name)[0]
+                images[name] = {}
+                for suffix, body in sorted(variants.items()):
+                    images[name][suffix] = fingerprint(base + suffix, body)
+                    _write(os.path.join(out_dir, 'static', images[name][suffix]), body)
+    return assets, images
+
+
+_STATIC_REFERENCE = re.compile(r'(?P<attribute>\b(?:src|href)=)(?P<quote>["\'])static/(?P<name>[^"\'?#]+)(?P=quote)')
+_IMAGE_TAG = re.compile(r'<img\b[^>]*>')
+_PICTURE_TYPES = (('.avif', 'image/avif'), ('.webp', 'image/webp'))
+
+
+def rewrite_html(html, assets, images, static_url=STATIC_URL):
+    """
+    Points a page's static/... references at the fingerprinted files and wraps images
+    that have variants in a <picture>.
+    """
+    prefix = static_url + '/' if static_url else 'static/'
+
+    def picture(match):
+        tag = match.group(0)
+        reference = _STATIC_REFERENCE.search(tag)
+        if not reference or reference.group('attribute') != 'src=' or reference.group('name') not in images:
+            return tag
+        variants = images[reference.group('name')]
+        sources = ['<source type="{}" srcset="{}{}">'.format(content_type, prefix, variants[suffix])
+                   for suffix, content_type in _PICTURE_TYPES if suffix in variants]
+        return '<picture>{}{}</picture>'.format(''.join(sources), tag)
+
+    def asset(match):
+        name = match.group('name')
+        if name not in assets:
+            return match.group(0)
+        return '{attribute}{quote}{prefix}{name}{quote}'.format(attribute=match.group('attribute'),
+                                                                quote=match.group('quote'),
+                                                                prefix=prefix, name=assets[name])
+
+    return _STATIC_REFERENCE.sub(asset, _IMAGE_TAG.sub(picture, html))
+
+
+def build_templates(out_dir, assets, images, static_url, templates_dir=TEMPLATES_DIR):
+    """
+    Writes copies of the app's templates that link the fingerprinted assets, so
+    pages still rendered per request benefit from them too.
+    """
+    for file_name in sorted(os.listdir(templates_dir)):
+        if not file_name.endswith('.html'):
+            continue
+        with open(os.path.join(templates_dir, file_name), encoding='utf-8') as template:
+            html = template.read()
+        _write(os.path.join(out_dir, 'templates', file_name),
+               rewrite_html(html, assets, images, static_url).encode('utf-8'))
+
+
+def build_pages(out_dir, app, assets, images, static_url, base_url):
+    """
+    Renders each of PRERENDERED_PAGES through its view, as requested under
+    base_url (the public URL including the stage, so url_for matches what API
+    Gateway requests produce).
+    """
+    pages = {}
+    for endpoint, path in sorted(PRERENDERED_PAGES.items()):
+        view = app.view_functions[endpoint]
+        view = getattr(view, '__wrapped__', view)
+        with app.test_request_context(path, base_url=base_url):
+            html = view()
+        name = 'pages/{}.html'.format(endpoint)
+        _write_compressed(os.path.join(out_dir, name), rewrite_html(html, assets, images, static_url).encode('utf-8'))
+        pages[endpoint] = name
+    return pages
+
+
+def build_static(app, out_dir=STATIC_BUILD_DIR, static_url=STATIC_URL, base_url=None):
+    """
+    Builds the assets, templates and pre-rendered pages into out_dir and writes
+    their manifest last. The build happens in a scratch directory that replaces
+    out_dir only once it is complete. Returns the manifest.
+    """
+    if base_url is None:
+        base_url = app.config['APP_URL'] + app.config['STAGE-PREFIX']
+    for module, package, consequence in OPTIONAL_MODULES:
+        if not _available(module):
+            logger.warning('%s is not installed, %s', package, consequence)
+    parent = os.path.dirname(os.path.abspath(out_dir))
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+    scratch = tempfile.mkdtemp(prefix='.static-', dir=parent)
+    try:
+        assets, images = build_assets(scratch)
+        build_templates(scratch, assets, images, static_url)
+        pages = build_pages(scratch, app, assets, images, static_url, base_url)
+        manifest = dict(built_at=int(time.time()), static_url=static_url, assets=assets, images=images,
+                        pages=pages)
+        _write(os.path.join(scratch, MANIFEST_NAME), json.dumps(manifest, indent=2, sort_keys=True).encode('utf-8'))
+        if os.path.isdir(out_dir):
+            shutil.rmtree(out_dir)
+        os.rename(scratch, out_dir)
+    except Exception:
+        shutil.rmtree(scratch, ignore_errors=True)
+        raise
+    return manifest
+
+
+def load_manifest(build_dir=STATIC_BUILD_DIR):
+    try:
+        with open(os.path.join(build_dir, MANIFEST_NAME), encoding='utf-8') as manifest:
+            return json.load(manifest)
+    except (IOError, ValueError):
+        return None
+
+
+def _content_type(name):
+    content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+    if content_type.startswith('text/') or content_type in ('application/javascript', 'image/svg+xml'):
+        content_type += '; charset=utf-8'
+    return content_type
+
+
+def upload_static(bucket, prefix='', build_dir=STATIC_BUILD_DIR):
+    """
+    Uploads the fingerprinted assets to an S3 bucket with immutable cache headers,
+    skipping files already there. Returns the number uploaded.
+    """
+    manifest = load_manifest(build_dir)
+    if manifest is None:
+        raise ValueError('No static build in {}'.format(build_dir))
+    names = set(manifest['assets'].values())
+    for variants in manifest['images'].values():
+        names.update(variants.values())
+
+    s3 = boto3.client('s3')
+    prefix = prefix.strip('/') + '/' if prefix.strip('/') else ''
+    existing = set()
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+        existing.update(item['Key'] for item in page.get('Contents', []))
+
+    uploaded = 0
+    for name in sorted(names):
+        key = prefix + name
+        if key in existing:
+            continue
+        path = os.path.join(build_dir, 'static', name)
+        extra = dict(ContentType=_content_type(name),
+                     CacheControl='public, max-age={}, immutable'.format(ASSET_MAX_AGE))
+        if os.path.exists(path + '.gz'):
+            path += '.gz'
+            extra['ContentEncoding'] = 'gzip'
+        with open(path, 'rb') as body:
+            s3.put_object(Bucket=bucket, Key=key, Body=body, **extra)
+        uploaded += 1
+    return uploaded
+
+
+#
+# Serving
+#
+def _negotiated_file(path):
+    """
+    The precompressed variant of path the client accepts, as (path, encoding),
+    falling back to (path, None).
+    """
+    for encoding, suffix in ENCODINGS:
+        if request.accept_encodings[encoding] and os.path.exists(path + suffix):
+            return path + suffix, encoding
+    return path, None
+
+
+def _respond(name, body, encoding, cache_control, etag):
+    response = Response(body, content_type=_content_type(name))
+    response.headers['Cache-Control'] = cache_control
+    response.headers['Vary'] = 'Accept-Encoding'
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.set_etag(etag)
+    return response.make_conditional(request)
+
+
+class StaticAssets(object):
+    """
+    Serves a static build (see build_static): fingerprinted assets with
+    year-long immutable cache headers and pre-rendered pages from memory, both
+    in the precompressed encoding the client accepts.
+    """
+    def __init__(self, build_dir, manifest):
+        self.build_dir = build_dir
+        self.manifest = manifest
+        self.files = set(manifest['assets'].values())
+        for variants in manifest['images'].values():
+            self.files.update(variants.values())
+        self.pages = {}
+        for endpoint, name in manifest['pages'].items():
+            path = os.path.join(build_dir, name)
+            bodies = {}
+            for encoding, suffix in ((None, ''),) + ENCODINGS:
+                if os.path.exists(path + suffix):
+                    with open(path + suffix, 'rb') as page:
+                        bodies[encoding] = page.read()
+            self.pages[endpoint] = (name, bodies, hashlib.sha256(bodies[None]).hexdigest()[:16])
+
+    def serve_asset(self, filename):
+        path, encoding = _negotiated_file(os.path.join(self.build_dir, 'static', filename))
+        with open(path, 'rb') as asset:
+            body = asset.read()
+        etag = os.path.splitext(filename)[0].rsplit('.', 1)[-1] + (encoding or '')
+        return _respond(filename, body, encoding, 'public, max-age={}, immutable'.format(ASSET_MAX_AGE), etag)
+
+    def serve_page(self, endpoint):
+        name, bodies, etag = self.pages[endpoint]
+        for encoding, _ in ENCODINGS:
+            if encoding in bodies and request.accept_encodings[encoding]:
+                break
+        else:
+            encoding = None
+        return _respond(name, bodies[encoding], encoding, 'public, max-age={}'.format(PAGE_MAX_AGE),
+                        etag + (encoding or ''))
+
+
+def install_static_assets(app, build_dir=STATIC_BUILD_DIR):
+    """
+    Serves app's static route and PRERENDERED_PAGES from the build in build_dir, if
+    there is one.
+    """
+    manifest = load_manifest(build_dir) if STATIC_ASSETS_ENABLED else None
+    if manifest is None:
+        return app
+    assets = StaticAssets(build_dir, manifest)
+    app.extensions['static_assets'] = assets
+    app.jinja_loader = ChoiceLoader([FileSystemLoader(os.path.join(build_dir, 'templates')), app.jinja_loader])
+
+    send_static_file = app.view_functions['static']
+
+    def static(filename):
+        if filename in assets.files:
+            return assets.serve_asset(filename)
+        return send_static_file(filename=filename)
+
+    app.view_functions['static'] = static
+
+    for endpoint in assets.pages:
+        view = app.view_functions.get(endpoint)
+        if view is None:
+            continue
+
+        def prerendered(endpoint=endpoint, **kwargs):
+            return assets.serve_page(endpoint)
+
+        prerendered.__wrapped__ = view
+        app.view_functions[endpoint] = prerendered
+    return app
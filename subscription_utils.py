@@ -0,0 +1,130 @@
+import json
+import os
+import time
+from hmac import compare_digest
+
+from pynamodb.exceptions import PutError, UpdateError
+from werkzeug.exceptions import BadRequest, Unauthorized
+
+from dynamodb_utils import SubscriptionEvent
+
+__all__ = ['INACTIVE_SUBSCRIPTION_STATUSES', 'SUBSCRIPTION_EVENT_TYPES', 'check_subscription_event_auth',
+           'claim_subscription_event', 'complete_subscription_event', 'parse_subscription_event',
+           'pending_subscription_events', 'record_subscription_event', 'subscription_is_active',
+           'subscription_store_hash']
+
+SUBSCRIPTION_EVENT_LEASE_SECONDS = int(os.environ.get('SUBSCRIPTION_EVENT_LEASE_SECONDS', 120))
+SUBSCRIPTION_EVENT_RETENTION = int(os.environ.get('SUBSCRIPTION_EVENT_RETENTION', 30 * 86400))
+SUBSCRIPTION_EVENT_MAX_ATTEMPTS = int(os.environ.get('SUBSCRIPTION_EVENT_MAX_ATTEMPTS', 5))
+
+# Events whose subscription decides whether a store is synced; anything else is
+# recorded (so redeliveries are still deduplicated) and marked ignored.
+SUBSCRIPTION_EVENT_TYPES = frozenset(['subscription_created', 'subscription_started', 'subscription_activated',
+                                      'subscription_changed', 'subscription_renewed', 'subscription_reactivated',
+                                      'subscription_resumed', 'subscription_paused', 'subscription_cancelled',
+                                      'subscription_cancellation_scheduled',
+                                      'subscription_scheduled_cancellation_removed'])
+
+# Subscription statuses whose stores are neither synced nor sent webhooks.
+INACTIVE_SUBSCRIPTION_STATUSES = frozenset(['cancelled', 'paused'])
+
+
+def subscription_is_active(status):
+    return status not in INACTIVE_SUBSCRIPTION_STATUSES
+
+
+def check_subscription_event_auth(authorization, username, password):
+    """
+    Checks the HTTP basic auth credentials Chargebee sends with each webhook
+    delivery against the configured ones.
+    """
+    if (authorization is None or
+            not compare_digest((authorization.username or '').encode('utf-8'), username.encode('utf-8')) or
+            not compare_digest((authorization.password or '').encode('utf-8'), password.encode('utf-8'))):
+        raise Unauthorized('Invalid webhook credentials')
+
+
+def parse_subscription_event(body):
+    """
+    Validates a Chargebee webhook delivery and returns (event_id, event_type,
+    occurred_at, content).
+    """
+    try:
+        payload = json.loads(body)
+    except (TypeError, ValueError):
+        raise BadRequest('Event body is not JSON')
+    if not isinstance(payload, dict) or not payload.get('id') or not payload.get('event_type'):
+        raise BadRequest('Event body is missing id or event_type')
+    content = payload.get('content')
+    if not isinstance(content, dict):
+        raise BadRequest('Event body has no content')
+    return payload['id'], payload['event_type'], payload.get('occurred_at'), content
+
+
+def record_subscription_event(body):
+    """
+    Stores a Chargebee event under its id. Returns the new SubscriptionEvent, or
+    None when the event was already recorded (Chargebee redelivers on timeouts).
+    """
+    event_id, event_type, occurred_at, content = parse_subscription_event(body)
+    now = int(time.time())
+    event = SubscriptionEvent(event_id, event_type=event_type, occurred_at=occurred_at,
+                              content=json.dumps(content), received_at=now,
+                              expires_at=now + SUBSCRIPTION_EVENT_RETENTION)
+    try:
+        event.save(condition=SubscriptionEvent.event_id.does_not_exist())
+    except PutError:
+        return None
+    return event
+
+
+def claim_subscription_event(event_id, lease_seconds=SUBSCRIPTION_EVENT_LEASE_SECONDS):
+    """
+    Leases an unprocessed event to the caller so the worker started by the route
+    and the scheduled sweep never handle it at the same time. Returns the event,
+    or None when it is processed, leased elsewhere or missing.
+    """
+    now = int(time.time())
+    event = SubscriptionEvent(event_id)
+    try:
+        event.update(actions=[SubscriptionEvent.lease_until.set(now + lease_seconds),
+                              SubscriptionEvent.attempts.add(1)],
+                     condition=(SubscriptionEvent.event_id.exists() &
+                                SubscriptionEvent.processed_at.does_not_exist() &
+                                (SubscriptionEvent.lease_until < now)))
+    except UpdateError:
+        return None
+    return event
+
+
+def complete_subscription_event(event, outcome):
+    event.update(actions=[SubscriptionEvent.processed_at.set(int(time.time())),
+                          SubscriptionEvent.outcome.set(outcome),
+                          SubscriptionEvent.lease_until.set(0)])
+
+
+def pending_subscription_events(older_than, max_attempts=SUBSCRIPTION_EVENT_MAX_ATTEMPTS):
+    """
+    Ids of events nobody has finished, received more than older_than seconds ago,
+    oldest first. Events that failed max_attempts times are left for inspection.
+    """
+    now = int(time.time())
+    condition = (SubscriptionEvent.processed_at.does_not_exist() &
+                 (SubscriptionEvent.received_at < now - older_than) &
+                 (SubscriptionEvent.lease_until < now) &
+                 (SubscriptionEvent.attempts < max_attempts))
+    events = SubscriptionEvent.scan(condition, attributes_to_get=['event_id', 'occurred_at', 'received_at'])
+    return [event.event_id for event in sorted(events, key=lambda event: (event.occurred_at or event.received_at))]
+
+
+def subscription_store_hash(sub):
+    """
+    The store a Chargebee subscription belongs to, from its meta_data.
+    """
+    meta_data = sub.meta_data
+    if isinstance(meta_data, str):
+        try:
+            meta_data = json.loads(meta_data)
+        except ValueError:
+            return None
+    return meta_data.get('bc_store_hash') if isinstance(meta_data, dict) else None
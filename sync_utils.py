@@ -0,0 +1,379 @@
+import calendar
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+from pynamodb.exceptions import PutError, UpdateError
+
+from dynamodb_utils import AppUser, CustomerMetrics
+from rolling_utils import AMOUNT_SCALE, ROLLING_WINDOWS, RollingWindows, epoch_day
+
+__all__ = ['IncrementalSync', 'SyncConflict', 'apply_customer_orders', 'compute_customer_metrics',
+           'iter_modified_pages', 'iter_pages', 'metric_properties', 'metrics_from_totals', 'order_email',
+           'parse_bc_date', 'parse_watermark', 'watermark_string']
+
+SYNC_PAGE_SIZE = int(os.environ.get('SYNC_PAGE_SIZE', 250))
+SYNC_METRICS_CHUNK_SIZE = 100
+WATERMARK_FORMAT = '%Y-%m-%dT%H:%M:%S+00:00'
+
+_MONTHS = dict((name, number + 1) for number, name in
+               enumerate(('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')))
+
+# Incomplete, Refunded, Cancelled and Declined orders don't count towards sales.
+EXCLUDED_ORDER_STATUS_IDS = frozenset([0, 4, 5, 6])
+
+METRIC_PROPERTIES = (('order_count', 'hubmetrix_order_count'),
+                     ('total_revenue', 'hubmetrix_total_revenue'),
+                     ('average_order_value', 'hubmetrix_average_order_value'),
+                     ('first_order_at', 'hubmetrix_first_order_date'),
+                     ('last_order_at', 'hubmetrix_last_order_date'),
+                     ('purchase_frequency_days', 'hubmetrix_purchase_frequency_days'),
+                     ('orders_30_days', 'hubmetrix_orders_last_30_days'),
+                     ('revenue_30_days', 'hubmetrix_revenue_last_30_days'),
+                     ('orders_90_days', 'hubmetrix_orders_last_90_days'),
+                     ('revenue_90_days', 'hubmetrix_revenue_last_90_days'),
+                     ('orders_365_days', 'hubmetrix_orders_last_365_days'),
+                     ('revenue_365_days', 'hubmetrix_revenue_last_365_days'))
+
+
+class SyncConflict(Exception):
+    """
+    Another sync run advanced the store's watermark first
+    """
+
+
+def parse_bc_date(value):
+    """
+    BigCommerce v2 dates are RFC 2822 strings; returns epoch seconds. The fixed
+    'Tue, 20 Nov 2012 00:00:00 +0000' layout is sliced directly since this runs
+    once per order; anything else goes through the email.utils parser.
+    """
+    if not value:
+        return None
+    try:
+        _, day, month, year, clock, offset = value.split(' ')
+        hours, minutes, seconds = clock.split(':')
+        utc_offset = (int(offset[1:3]) * 3600 + int(offset[3:5]) * 60) * (-1 if offset[0] == '-' else 1)
+        return calendar.timegm((int(year), _MONTHS[month], int(day), int(hours), int(minutes),
+                                int(seconds))) - utc_offset
+    except (KeyError, ValueError):
+        return int(parsedate_to_datetime(value).timestamp())
+
+
+def watermark_string(epoch_seconds):
+    return datetime.fromtimestamp(epoch_seconds, timezone.utc).strftime(WATERMARK_FORMAT)
+
+
+def parse_watermark(value):
+    if not value:
+        return None
+    return int(datetime.strptime(value, WATERMARK_FORMAT).replace(tzinfo=timezone.utc).timestamp())
+
+
+def iter_pages(resource, page_size=SYNC_PAGE_SIZE, **filters):
+    """
+    Yields one page (list) at a time from a listable BigCommerce resource.
+    """
+    page = 1
+    while True:
+        items = resource.all(page=page, limit=page_size, **filters)
+        if not items:
+            return
+        yield items
+        if len(items) < page_size:
+            return
+        page += 1
+
+
+def iter_modified_pages(resource, watermark, page_size=SYNC_PAGE_SIZE):
+    """
+    Keyset pagination over items modified at or after watermark, oldest first. Yields
+    (items, new_watermark) pairs.
+    """
+    seen_at_watermark = set()
+    page = 1
+    while True:
+        filters = dict(sort='date_modified:asc', page=page, limit=page_size)
+        if watermark:
+            filters['min_date_modified'] = watermark_string(watermark)
+        items = resource.all(**filters)
+        if not items:
+            return
+        fresh = [item for item in items if item['id'] not in seen_at_watermark]
+        last_modified = parse_bc_date(items[-1]['date_modified'])
+        if last_modified == watermark:
+            # A whole page shares one timestamp: step through it by page number.
+            page += 1
+        else:
+            page = 1
+            seen_at_watermark = set()
+            watermark = last_modified
+        seen_at_watermark.update(item['id'] for item in items
+                                 if parse_bc_date(item['date_modified']) == watermark)
+        if fresh:
+            yield fresh, watermark
+        if len(items) < page_size:
+            return
+
+
+def compute_customer_metrics(orders, today=None):
+    """
+    Folds a stream of one customer's orders into their sales metrics and rolling
+    windows without holding the orders in memory.
+    """
+    windows = RollingWindows(epoch_day() if today is None else today)
+    count = 0
+    amount = 0
+    first = last = None
+    for order in orders:
+        counted = _counted(order)
+        created = parse_bc_date(order['date_created'])
+        windows.apply(order['id'], created // 86400, _amount(order), counted)
+        if not counted:
+            continue
+        count += 1
+        amount += _amount(order)
+        first = created if first is None else min(first, created)
+        last = created if last is None else max(last, created)
+    return metrics_from_totals(count, amount, first, last, windows)
+
+
+def apply_customer_orders(previous, orders, today=None):
+    """
+    Folds changed orders into a customer's stored metrics and rolling windows. Returns
+    None when the customer needs a rescan instead.
+    """
+    if previous is None or previous.rolling is None:
+        return None
+    windows = RollingWindows.from_bytes(previous.rolling)
+    windows.advance(epoch_day() if today is None else today)
+    count = int(previous.order_count or 0)
+    amount = int(round((previous.total_revenue or 0) * AMOUNT_SCALE))
+    first, last = previous.first_order_at, previous.last_order_at
+    for order in orders:
+        counted = _counted(order)
+        created = parse_bc_date(order['date_created'])
+        day = created // 86400
+        removed = windows.contribution(order['id'])
+        if not windows.apply(order['id'], day, _amount(order), counted):
+            return None
+        if removed is not None:
+            if not counted and day in (first // 86400, last // 86400):
+                return None
+            count -= 1
+            amount -= removed[1]
+        if counted:
+            count += 1
+            amount += _amount(order)
+            first = created if first is None else min(first, created)
+            last = created if last is None else max(last, created)
+    return metrics_from_totals(count, amount, first, last, windows)
+
+
+def _counted(order):
+    return int(order.get('status_id', 0)) not in EXCLUDED_ORDER_STATUS_IDS
+
+
+def _amount(order):
+    return int(round(float(order.get('total_inc_tax') or 0) * AMOUNT_SCALE))
+
+
+def metrics_from_totals(count, amount, first, last, windows):
+    """
+    Sales metrics from a customer's counted orders: their number, amount in
+    AMOUNT_SCALE units, first and last order time and rolling windows.
+    """
+    metrics = dict(order_count=count,
+                   total_revenue=round(amount / float(AMOUNT_SCALE), 4),
+                   average_order_value=round(amount / float(AMOUNT_SCALE) / count, 2) if count else 0,
+                   first_order_at=first,
+                   last_order_at=last,
+                   purchase_frequency_days=round((last - first) / 86400.0 / (count - 1), 2) if count > 1 else None,
+                   rolling=windows.to_bytes())
+    for days in ROLLING_WINDOWS:
+        metrics['orders_{}_days'.format(days)], metrics['revenue_{}_days'.format(days)] = windows.window(days)
+    return metrics
+
+
+def metric_properties(metrics, previous=None):
+    """
+    HubSpot properties for the metrics that differ from previous. Dates are sent
+    as midnight UTC epoch milliseconds, which HubSpot date properties require.
+    """
+    properties = {}
+    for name, hs_name in METRIC_PROPERTIES:
+        value = metrics.get(name)
+        if previous is not None and getattr(previous, name) == value:
+            continue
+        if value is not None and name.endswith('_at'):
+            value = int(value) // 86400 * 86400 * 1000
+        properties[hs_name] = '' if value is None else value
+    return properties
+
+
+def order_email(order):
+    return ((order.get('billing_address') or {}).get('email') or '').strip().lower() or None
+
+
+def _customer_email(customer):
+    return (customer.get('email') or '').strip().lower() or None
+
+
+class IncrementalSync(object):
+    """
+    Pushes the changed metrics of customers whose orders or profiles changed since the
+    store's watermarks, which advance with a conditional update after every page.
+    """
+    def __init__(self, user, client, push, page_size=SYNC_PAGE_SIZE):
+        self.user = user
+        self.client = client
+        self.push = push
+        self.page_size = page_size
+        self.pages = 0
+        self.customers = 0
+        self.pushed = 0
+        self.rescanned = 0
+        self._lock = threading.Lock()
+
+    def run(self, max_pages=None, deadline=None):
+        """
+        Syncs page by page until caught up, max_pages pages were handled or the
+        deadline (epoch seconds) passed; the next run resumes from the watermarks.
+        """
+        streams = ((self.client.Orders, 'hm_last_sync_timestamp', self.apply_orders),
+                   (self.client.Customers, 'hm_customer_sync_timestamp', self._sync_changed_customers))
+        for resource, watermark_name, handle in streams:
+            watermark = self._watermark(watermark_name)
+            for items, new_watermark in iter_modified_pages(resource, watermark, self.page_size):
+                handle(items)
+                self._advance(watermark_name, new_watermark)
+                self.pages += 1
+                if (max_pages is not None and self.pages >= max_pages) or \
+                        (deadline is not None and time.time() >= deadline):
+                    return self.stats()
+        return self.stats()
+
+    def sync_customers(self, emails):
+        """
+        Recomputes and pushes metrics for emails from their full order history.
+        """
+        if not emails:
+            return
+        self._write(self._recompute(sorted(emails)), self._previous(emails))
+
+    def apply_orders(self, orders):
+        """
+        Applies a page of changed orders to each customer's stored state, falling back
+        to a full recompute for customers apply_customer_orders() can't update.
+        """
+        by_email = {}
+        for order in orders:
+            email = order_email(order)
+            if email:
+                by_email.setdefault(email, []).append(order)
+        if not by_email:
+            return
+        previous = self._previous(by_email)
+        today = epoch_day()
+        rows = []
+        rescan = []
+        for email in sorted(by_email):
+            metrics = apply_customer_orders(previous.get(email), by_email[email], today)
+            if metrics is None:
+                rescan.append(email)
+            else:
+                rows.append((email, metrics))
+        with self._lock:
+            self.rescanned += len(rescan)
+        self._write(rows + list(self._recompute(rescan)), previous)
+
+    def sync_metrics(self, rows, chunk_size=SYNC_METRICS_CHUNK_SIZE):
+        """
+        Pushes precomputed (email, metrics) rows, e.g. from the vectorized metrics
+        engine, comparing each chunk against the last pushed values.
+        """
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) >= chunk_size:
+                self._write(chunk, self._previous([email for email, _ in chunk]))
+                chunk = []
+        if chunk:
+            self._write(chunk, self._previous([email for email, _ in chunk]))
+
+    def _previous(self, emails):
+        return dict((metrics.email, metrics) for metrics in
+                    CustomerMetrics.batch_get([(self.user.bc_store_hash, email) for email in emails]))
+
+    def _write(self, rows, previous, retry=True):
+        now = round(time.time(), 3)
+        items = []
+        for email, metrics in rows:
+            last = previous.get(email)
+            if 'rolling' not in metrics and last is not None:
+                metrics = dict(metrics, rolling=last.rolling)
+            properties = metric_properties(metrics, last)
+            pushed = 0
+            if properties:
+                self.push(email, properties)
+                pushed = 1
+            if pushed or (last is not None and last.rolling != metrics.get('rolling')):
+                items.append(CustomerMetrics(self.user.bc_store_hash, email, synced_at=now, **metrics))
+            with self._lock:
+                self.customers += 1
+                self.pushed += pushed
+        # A buffering push is flushed before its values are recorded as pushed, and
+        # contacts HubSpot rejected are left unrecorded so the next sync retries them.
+        if hasattr(self.push, 'flush'):
+            dropped = self.push.flush()
+            if dropped:
+                items = [item for item in items if item.email not in dropped]
+        # Each write is conditional on the row read into previous, so a concurrent
+        # sync's newer values are never overwritten; those customers are recomputed.
+        conflicts = []
+        for item in items:
+            last = previous.get(item.email)
+            if last is None:
+                condition = CustomerMetrics.email.does_not_exist()
+            elif last.synced_at is None:
+                condition = CustomerMetrics.synced_at.does_not_exist()
+            else:
+                condition = CustomerMetrics.synced_at == last.synced_at
+            try:
+                item.save(condition=condition)
+            except PutError:
+                conflicts.append(item.email)
+        if conflicts and retry:
+            with self._lock:
+                self.rescanned += len(conflicts)
+            self._write(list(self._recompute(conflicts)), self._previous(conflicts), retry=False)
+
+    def stats(self):
+        return dict(pages=self.pages, customers=self.customers, pushed=self.pushed, rescanned=self.rescanned)
+
+    def _sync_changed_customers(self, customers):
+        self.sync_customers(set(email for email in (_customer_email(customer) for customer in customers) if email))
+
+    def _recompute(self, emails):
+        today = epoch_day()
+        for email in emails:
+            yield email, compute_customer_metrics(self._iter_customer_orders(email), today)
+
+    def _iter_customer_orders(self, email):
+        for page in iter_pages(self.client.Orders, self.page_size, email=email):
+            for order in page:
+                yield order
+
+    def _watermark(self, name):
+        return parse_watermark(getattr(self.user, name))
+
+    def _advance(self, name, watermark):
+        attribute = getattr(AppUser, name)
+        current = getattr(self.user, name)
+        condition = attribute.does_not_exist() if current is None else attribute == current
+        try:
+            self.user.update(actions=[attribute.set(watermark_string(watermark))], condition=condition)
+        except UpdateError:
+            raise SyncConflict('Watermark {} of store {} moved during sync'.format(name, self.user.bc_store_hash))
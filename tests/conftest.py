@@ -0,0 +1,66 @@
+import os
+import sys
+import time
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+sys.path.insert(0, ROOT)
+
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'fake')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'fake')
+
+from fake_dynamodb import FakeDynamoDB  # noqa: E402
+
+
+@pytest.fixture
+def dynamodb():
+    """
+    A fresh fake DynamoDB with every table of dynamodb_utils.
+    """
+    from dynamodb_utils import (AppUser, BackfillRange, ContactIndex, CustomerMetrics, IngestQueueItem,
+                                MetricsPartial, SubscriptionEvent)
+    with FakeDynamoDB() as fake:
+        fake.register_models(AppUser, BackfillRange, ContactIndex, CustomerMetrics, IngestQueueItem,
+                             MetricsPartial, SubscriptionEvent)
+        yield fake
+
+
+def bc_date(epoch_seconds):
+    return time.strftime('%a, %d %b %Y %H:%M:%S +0000', time.gmtime(epoch_seconds))
+
+
+def make_order(order_id, email, created, total=10.0, status_id=11, modified=None):
+    return {'id': order_id, 'date_created': bc_date(created), 'date_modified': bc_date(modified or created),
+            'status_id': status_id, 'total_inc_tax': str(total), 'billing_address': {'email': email}}
+
+
+class FakeResource(object):
+    """
+    A listable BigCommerce v2 resource (Orders, Customers) over a list of dicts.
+    """
+    def __init__(self, items=None):
+        self.items = list(items or [])
+        self.calls = 0
+
+    def all(self, page=1, limit=250, sort=None, min_id=None, max_id=None, email=None, min_date_modified=None):
+        from sync_utils import parse_bc_date, parse_watermark
+        self.calls += 1
+        items = [item for item in self.items
+                 if (min_id is None or item['id'] >= min_id) and (max_id is None or item['id'] <= max_id) and
+                 (email is None or item['billing_address']['email'] == email) and
+                 (min_date_modified is None or
+                  parse_bc_date(item['date_modified']) >= parse_watermark(min_date_modified))]
+        if sort:
+            field, direction = sort.split(':')
+            key = (lambda item: parse_bc_date(item[field])) if field.startswith('date') else \
+                (lambda item: item[field])
+            items.sort(key=lambda item: (key(item), item['id']), reverse=direction == 'desc')
+        return items[(page - 1) * limit:page * limit]
+
+
+class FakeBigCommerce(object):
+    def __init__(self, orders=None, customers=None):
+        self.Orders = FakeResource(orders)
+        self.Customers = FakeResource(customers)
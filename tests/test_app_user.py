@@ -0,0 +1,67 @@
+"""
+AppUser change tracking and the per-request unit of work, against the fake DynamoDB.
+"""
+from cache_utils import TTLCache
+from dynamodb_utils import AppUser, AppUserUnitOfWork
+
+
+def make_user(bc_store_hash='store'):
+    user = AppUser(bc_store_hash, 1, bc_email='owner@example.com', bc_access_token='token', bc_scope='scope')
+    user.save()
+    return AppUser.find_by_store_hash(bc_store_hash, consistent_read=True)
+
+
+def test_update_keeps_pending_changes(dynamodb):
+    user = make_user()
+    AppUser.find_by_store_hash('store').update(actions=[AppUser.hs_hub_id.set('42')])
+
+    user.cb_subscription_id = 'sub'
+    user.update(actions=[AppUser.hm_backfill_started_at.set(100)])
+    assert user.cb_subscription_id == 'sub'
+    assert user.hs_hub_id == '42'
+    assert user.hm_backfill_started_at == 100
+
+    AppUser.find_by_store_hash('store').update(actions=[AppUser.hs_hub_domain.set('example.com')])
+    user.save_changes()
+    stored = AppUser.find_by_store_hash('store', consistent_read=True)
+    assert (stored.cb_subscription_id, stored.hs_hub_id, stored.hm_backfill_started_at,
+            stored.hs_hub_domain) == ('sub', '42', 100, 'example.com')
+
+
+def test_cached_items_are_saved_by_attribute(dynamodb):
+    make_user()
+    cache = TTLCache()
+    AppUserUnitOfWork(cache=cache).get('store')
+    AppUser.find_by_store_hash('store').update(actions=[AppUser.hs_hub_id.set('42')])
+
+    user = AppUserUnitOfWork(cache=cache).get('store')
+    assert user.hs_hub_id is None
+    user.cb_subscription_id = 'sub'
+    user.save_changes()
+    stored = AppUser.find_by_store_hash('store', consistent_read=True)
+    assert (stored.cb_subscription_id, stored.hs_hub_id) == ('sub', '42')
+
+
+def test_flush_writes_only_changes_after_an_update(dynamodb):
+    make_user()
+    uow = AppUserUnitOfWork()
+    user = uow.get('store')
+    user.cb_subscription_status = 'active'
+    user.update(actions=[AppUser.cb_subscription_version.set(3)])
+    AppUser.find_by_store_hash('store').update(actions=[AppUser.hs_hub_id.set('42')])
+
+    assert uow.dirty_attributes(user) == ['cb_subscription_status']
+    uow.flush()
+    stored = AppUser.find_by_store_hash('store', consistent_read=True)
+    assert (stored.cb_subscription_status, stored.cb_subscription_version, stored.hs_hub_id) == ('active', 3, '42')
+
+
+def test_peek_ignores_the_container_cache(dynamodb):
+    make_user()
+    cache = TTLCache()
+    AppUserUnitOfWork(cache=cache).get('store')
+
+    uow = AppUserUnitOfWork(cache=cache)
+    assert uow.peek('store') is None
+    user = uow.get('store')
+    assert uow.peek('store') is user
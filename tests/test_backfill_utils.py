@@ -0,0 +1,157 @@
+"""
+The resumable historical backfill, against the fake DynamoDB and a fake store.
+"""
+import time
+
+from conftest import FakeBigCommerce, make_order
+
+from backfill_utils import Backfill, Recompute, scan_stale_backfills
+from dynamodb_utils import AppUser, BackfillRange, CustomerMetrics, MetricsPartial
+from sync_utils import IncrementalSync, parse_bc_date
+
+DAY = 86400
+
+
+def make_user(bc_store_hash='store', **values):
+    AppUser(bc_store_hash, 1, bc_email='owner@example.com', bc_access_token='token', bc_scope='scope',
+            **values).save()
+    return AppUser.find_by_store_hash(bc_store_hash, consistent_read=True)
+
+
+def make_store(n_orders=25, n_customers=5):
+    now = int(time.time())
+    return FakeBigCommerce(orders=[make_order(order_id, 'customer{}@example.com'.format(order_id % n_customers),
+                                              now - (n_orders - order_id) * DAY, total=order_id)
+                                   for order_id in range(1, n_orders + 1)])
+
+
+def make_backfill(user, client, pushed, **options):
+    sync = IncrementalSync(user, client, lambda email, properties: pushed.append(email))
+    return Backfill(user, client, sync, range_size=10, page_size=4, **options)
+
+
+def test_a_backfill_walks_every_range_once(dynamodb):
+    user = make_user()
+    pushed = []
+    assert make_backfill(user, make_store(), pushed).run(deadline=time.time() + 60)
+
+    assert sorted(set(pushed)) == ['customer{}@example.com'.format(n) for n in range(5)]
+    assert [(r.range_start, r.range_end, r.done) for r in BackfillRange.query('store')] == [
+        (1, 10, True), (11, 20, True), (21, 25, True)]
+    assert sum(r.orders for r in BackfillRange.query('store')) == 25
+    assert CustomerMetrics.get('store', 'customer0@example.com').order_count == 5
+
+    user.refresh()
+    assert user.hm_backfill_completed_at and user.hm_last_sync_timestamp and user.hm_customer_sync_timestamp
+    count = len(pushed)
+    assert make_backfill(user, make_store(), pushed).run(deadline=time.time() + 60)
+    assert len(pushed) == count
+
+
+def test_only_one_invocation_plans(dynamodb):
+    user = make_user()
+    client = make_store()
+    assert make_backfill(user, client, []).plan()
+    assert not make_backfill(AppUser.find_by_store_hash('store', consistent_read=True), client, []).plan()
+    assert BackfillRange.count('store') == 3
+
+
+def test_an_abandoned_plan_is_taken_over_after_its_lease(dynamodb):
+    user = make_user(hm_backfill_started_at=int(time.time()) - 5)
+    assert not make_backfill(user, make_store(), [], lease_seconds=60).plan()
+    assert make_backfill(user, make_store(), [], lease_seconds=1).plan()
+    assert AppUser.find_by_store_hash('store').hm_backfill_planned_at
+
+
+def test_a_leased_range_is_left_to_its_owner(dynamodb):
+    user = make_user()
+    client = make_store()
+    first = make_backfill(user, client, [])
+    first.plan()
+    leased = BackfillRange.get('store', 1)
+    assert first._lease(leased)
+
+    pushed = []
+    second = make_backfill(AppUser.find_by_store_hash('store', consistent_read=True), client, pushed)
+    assert not second.run(deadline=time.time() + 60)
+    assert [r.range_start for r in BackfillRange.query('store') if not r.done] == [1]
+
+    leased.update(actions=[BackfillRange.lease_until.set(0)])
+    assert second.run(deadline=time.time() + 60)
+
+
+def test_a_slice_past_its_deadline_resumes_from_the_checkpoint(dynamodb):
+    user = make_user()
+    client = make_store()
+    assert not make_backfill(user, client, []).run(deadline=time.time() - 1)
+    assert all(r.next_id == r.range_start for r in BackfillRange.query('store'))
+
+    calls = client.Orders.calls
+    assert make_backfill(AppUser.find_by_store_hash('store', consistent_read=True), client, []).run(
+        deadline=time.time() + 60)
+    assert client.Orders.calls > calls
+
+
+def test_a_redelivered_page_is_counted_once(dynamodb):
+    user = make_user()
+    client = make_store()
+    backfill = make_backfill(user, client, [])
+    backfill.plan()
+    backfill._stage(client.Orders.items[:4], 1)
+    assert make_backfill(AppUser.find_by_store_hash('store', consistent_read=True), client, []).run(
+        deadline=time.time() + 60)
+
+    metrics = CustomerMetrics.get('store', 'customer1@example.com')
+    assert (metrics.order_count, metrics.total_revenue) == (5, 1 + 6 + 11 + 16 + 21)
+    assert metrics.first_order_at == parse_bc_date(client.Orders.items[0]['date_created'])
+
+
+def test_a_merge_past_its_deadline_resumes_after_the_last_email(dynamodb):
+    user = make_user()
+    client = make_store(n_orders=150, n_customers=150)
+    pushed = []
+    backfill = make_backfill(user, client, pushed)
+    backfill.plan()
+    for backfill_range in BackfillRange.query('store'):
+        backfill._work(backfill_range, time.time() + 60)
+    assert not backfill._merge(deadline=time.time() - 1)
+    assert len(pushed) == 100
+
+    user = AppUser.find_by_store_hash('store', consistent_read=True)
+    assert user.hm_backfill_merged_email == sorted(pushed)[-1]
+    assert make_backfill(user, client, pushed).run(deadline=time.time() + 60)
+    assert sorted(pushed) == sorted('customer{}@example.com'.format(n) for n in range(150))
+
+
+def test_a_recompute_starts_over_once_complete(dynamodb):
+    user = make_user(hm_backfill_completed_at=int(time.time()))
+    client = make_store()
+    pushed = []
+    assert Recompute(user, client, IncrementalSync(user, client, lambda email, properties: pushed.append(email)),
+                     range_size=10, page_size=4).run(deadline=time.time() + 60)
+    assert CustomerMetrics.get('store', 'customer0@example.com').order_count == 5
+    client.Orders.items[0]['status_id'] = 5
+
+    user = AppUser.find_by_store_hash('store', consistent_read=True)
+    recompute = Recompute(user, client, IncrementalSync(user, client, lambda email, properties: pushed.append(email)),
+                          range_size=10, page_size=4)
+    assert recompute.run(deadline=time.time() + 60)
+    assert CustomerMetrics.get('store', 'customer1@example.com').order_count == 5
+    assert recompute.start()
+    assert recompute.run(deadline=time.time() + 60)
+    assert CustomerMetrics.get('store', 'customer1@example.com').order_count == 4
+    assert BackfillRange.count('store') == 0
+    assert MetricsPartial.count('store#recompute#{}'.format(user.hm_recompute_started_at)) == 25
+
+
+def test_stale_backfills_are_found(dynamodb):
+    now = int(time.time())
+    registered = dict(bc_webhooks_registered=True, hs_access_token='token')
+    make_user('running', hm_backfill_started_at=now - 3600, hm_backfill_slice_at=now - 60, **registered)
+    make_user('stalled', hm_backfill_started_at=now - 3600, hm_backfill_slice_at=now - 3600, **registered)
+    make_user('never_started', **registered)
+    make_user('done', hm_backfill_started_at=now - 3600, hm_backfill_completed_at=now - 60, **registered)
+    make_user('synced_before_backfills', hm_last_sync_timestamp='2020-01-01T00:00:00+00:00', **registered)
+    make_user('unregistered', hm_backfill_started_at=now - 3600)
+
+    assert sorted(user.bc_store_hash for user in scan_stale_backfills(900)) == ['never_started', 'stalled']
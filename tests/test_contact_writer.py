@@ -0,0 +1,117 @@
+"""
+ContactWriter against the local fake HubSpot server, see benchmarks/fake_hubspot.py.
+"""
+import importlib
+import os
+
+import pytest
+import requests
+
+from fake_hubspot import FakeHubSpot
+from fake_upstreams import Faults
+
+from dynamodb_utils import ContactIndex
+
+
+@pytest.fixture(scope='module')
+def hubspot():
+    with FakeHubSpot(rate_limit=1000, rate_window=1.0) as fake:
+        os.environ['HS_API_BASE'] = fake.url
+        yield fake
+
+
+@pytest.fixture(scope='module')
+def hubspot_utils(hubspot):
+    import hubspot_utils
+    return importlib.reload(hubspot_utils)
+
+
+@pytest.fixture
+def contact_utils(hubspot_utils, dynamodb):
+    import contact_utils
+    return importlib.reload(contact_utils)
+
+
+def test_buffered_updates_are_merged(hubspot, hubspot_utils):
+    writer = hubspot_utils.ContactWriter()
+    push = writer.for_portal('merge', lambda: 'merge-token')
+    push('merge@example.com', {'hubmetrix_order_count': 1, 'hubmetrix_total_revenue': 10})
+    push('merge@example.com', {'hubmetrix_order_count': 2})
+    push('other@example.com', {'hubmetrix_order_count': 5})
+
+    assert push.flush() == frozenset()
+    assert writer.stats()['merged'] == 1
+    assert writer.stats()['batches'] == 1
+    assert hubspot.contacts['merge@example.com'] == {'hubmetrix_order_count': 2, 'hubmetrix_total_revenue': 10}
+    assert hubspot.contacts['other@example.com'] == {'hubmetrix_order_count': 5}
+
+
+def test_rejected_contacts_are_dropped_and_returned(hubspot, hubspot_utils):
+    writer = hubspot_utils.ContactWriter()
+    push = writer.for_portal('drop', lambda: 'drop-token')
+    push('valid@example.com', {'hubmetrix_order_count': 3})
+    push('not-an-email', {'hubmetrix_order_count': 4})
+
+    assert push.flush() == frozenset(['not-an-email'])
+    assert writer.stats()['failed'] == 1
+    assert writer.stats()['contacts'] == 1
+    assert hubspot.contacts['valid@example.com'] == {'hubmetrix_order_count': 3}
+    assert 'not-an-email' not in hubspot.contacts
+
+
+def test_transient_failures_are_requeued(hubspot, hubspot_utils):
+    writer = hubspot_utils.ContactWriter()
+    push = writer.for_portal('requeue', lambda: 'requeue-token')
+    push('requeue@example.com', {'hubmetrix_order_count': 1})
+
+    faults, hubspot.faults = hubspot.faults, Faults(error_rate=1.0)
+    try:
+        with pytest.raises(requests.HTTPError):
+            push.flush()
+    finally:
+        hubspot.faults = faults
+    assert writer.pending('requeue') == 1
+    assert 'requeue@example.com' not in hubspot.contacts
+
+    push('requeue@example.com', {'hubmetrix_total_revenue': 20})
+    assert push.flush() == frozenset()
+    assert writer.pending('requeue') == 0
+    assert hubspot.contacts['requeue@example.com'] == {'hubmetrix_order_count': 1, 'hubmetrix_total_revenue': 20}
+
+
+def test_contacts_are_resolved_once_per_batch_and_misses_cached(hubspot, hubspot_utils, contact_utils):
+    hubspot.upsert('known@example.com', [{'property': 'hubmetrix_order_count', 'value': 1}])
+    resolver = contact_utils.ContactResolver()
+    writer = hubspot_utils.ContactWriter(resolver=resolver)
+    push = writer.for_portal('resolve', lambda: 'resolve-token')
+    lookups = hubspot.requests['email_lookup']
+    push('known@example.com', {'hubmetrix_order_count': 2})
+    push('new@example.com', {'hubmetrix_order_count': 1})
+    push('bad-email', {'hubmetrix_order_count': 1})
+
+    assert push.flush() == frozenset(['bad-email'])
+    assert hubspot.requests['email_lookup'] == lookups + 2
+    assert resolver.stats()['hubspot_hits'] == 1
+
+    push('new@example.com', {'hubmetrix_order_count': 2})
+    assert push.flush() == frozenset(['bad-email'])
+    assert hubspot.requests['email_lookup'] == lookups + 2
+    assert hubspot.contacts['known@example.com'] == {'hubmetrix_order_count': 2}
+    assert hubspot.contacts['new@example.com'] == {'hubmetrix_order_count': 2}
+
+
+def test_filled_portals_only_look_up_contacts_written_by_email(hubspot, hubspot_utils, contact_utils):
+    writer = hubspot_utils.ContactWriter(resolver=contact_utils.ContactResolver())
+    push = writer.for_portal('filled', lambda: 'filled-token', lookup=False)
+    lookups = hubspot.requests['email_lookup']
+    push('filled@example.com', {'hubmetrix_order_count': 1})
+
+    assert push.flush() == frozenset()
+    assert hubspot.requests['email_lookup'] == lookups + 1
+    assert hubspot.contacts['filled@example.com'] == {'hubmetrix_order_count': 1}
+    assert ContactIndex.get('filled', 'filled@example.com').vid == hubspot.vids['filled@example.com']
+
+    push('filled@example.com', {'hubmetrix_order_count': 2})
+    assert push.flush() == frozenset()
+    assert hubspot.requests['email_lookup'] == lookups + 1
+    assert hubspot.contacts['filled@example.com'] == {'hubmetrix_order_count': 2}
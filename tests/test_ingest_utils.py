@@ -0,0 +1,127 @@
+"""
+The DynamoDB ingest queue and webhook ingestion, against the fake DynamoDB.
+"""
+import json
+import time
+
+import pytest
+from werkzeug.exceptions import Unauthorized
+
+import hubmetrix_utils
+from dynamodb_utils import IngestQueueItem
+from ingest_utils import DynamoIngestQueue, EventCoalescer, IngestEvent, drain_ingest_queue
+from webhook_utils import bc_webhook_token
+
+CONFIG = {'BC_CLIENT_SECRET': 'client-secret', 'BC_WEBHOOK_SECRET': 'webhook-secret'}
+
+
+def order_payload(order_id, bc_store_hash='store', **values):
+    payload = {'producer': 'stores/' + bc_store_hash, 'scope': 'store/order/created', 'data': {'id': order_id}}
+    payload.update(values)
+    return payload
+
+
+def status_event(event_id, order_id, previous, new, created_at, delivery_hash=None, scope='store/order/statusUpdated'):
+    payload = order_payload(order_id, scope=scope, created_at=created_at,
+                            hash=delivery_hash or 'hash-{}'.format(event_id))
+    payload['data']['status'] = {'previous_status_id': previous, 'new_status_id': new}
+    return IngestEvent(event_id, 'orders', 'store', payload, created_at)
+
+
+def test_events_are_spread_over_shards_and_claimed_oldest_first(dynamodb):
+    queue = DynamoIngestQueue(shards=4)
+    for order_id in range(20):
+        queue.put('orders', 'store', order_payload(order_id))
+        time.sleep(0.002)
+    assert len(set(item['queue']['S'] for item in dynamodb.items(IngestQueueItem.Meta.table_name))) > 1
+    assert queue.depth() == 20
+
+    events = queue.claim(batch_size=8)
+    assert [event.payload['data']['id'] for event in events] == list(range(8))
+    assert [event.payload['data']['id'] for event in queue.claim(batch_size=100)] == list(range(8, 20))
+    assert queue.claim() == []
+
+    queue.ack(events)
+    assert queue.depth() == 12
+
+
+def test_unacked_events_are_claimed_again_after_the_visibility_timeout(dynamodb):
+    queue = DynamoIngestQueue(visibility_timeout=1, shards=2)
+    queue.put('orders', 'store', order_payload(1))
+    assert len(queue.claim()) == 1
+    assert queue.claim() == []
+    time.sleep(1.1)
+    events = queue.claim()
+    assert len(events) == 1
+    queue.ack(events)
+    assert queue.depth() == 0
+
+
+def test_young_events_are_left_to_coalesce(dynamodb):
+    queue = DynamoIngestQueue(shards=2)
+    queue.put('orders', 'store', order_payload(1))
+    assert queue.claim(min_age=60) == []
+    assert len(queue.claim(min_age=0)) == 1
+
+
+def test_webhooks_need_the_store_token(dynamodb, monkeypatch):
+    queue = DynamoIngestQueue(shards=2)
+    monkeypatch.setattr(hubmetrix_utils, 'get_ingest_queue', lambda: queue)
+    body = json.dumps(order_payload(1, bc_store_hash='store'))
+
+    with pytest.raises(Unauthorized):
+        hubmetrix_utils.enqueue_bc_webhook('orders', body, None, CONFIG)
+    with pytest.raises(Unauthorized):
+        hubmetrix_utils.enqueue_bc_webhook('orders', body, bc_webhook_token('other', 'webhook-secret'), CONFIG)
+    assert queue.depth() == 0
+
+    hubmetrix_utils.enqueue_bc_webhook('orders', body, bc_webhook_token('store', 'webhook-secret'), CONFIG)
+    assert queue.depth() == 1
+
+
+def test_status_changes_are_widened_to_the_whole_group():
+    events = [status_event(1, 10, 1, 2, 100), status_event(2, 10, 2, 11, 101), status_event(3, 20, 1, 2, 100)]
+    merged = EventCoalescer().coalesce(events)
+    assert [(event.payload['data']['id'], event.payload['data']['status']) for event in merged] == [
+        (10, {'previous_status_id': 1, 'new_status_id': 11}), (20, {'previous_status_id': 1, 'new_status_id': 2})]
+    assert merged[0].payload['coalesced'] == 2
+
+
+def test_status_round_trips_are_dropped_unless_the_order_was_created():
+    coalescer = EventCoalescer()
+    assert coalescer.coalesce([status_event(1, 10, 1, 2, 100), status_event(2, 10, 2, 1, 101)]) == []
+
+    created = status_event(3, 11, 0, 1, 100, scope='store/order/created')
+    merged = coalescer.coalesce([created, status_event(4, 11, 1, 2, 101), status_event(5, 11, 2, 1, 102)])
+    assert [event.payload['scope'] for event in merged] == ['store/order/created']
+
+
+def test_deliveries_count_as_seen_only_once_remembered():
+    coalescer = EventCoalescer()
+    event = status_event(1, 10, 1, 2, 100, delivery_hash='same')
+    redelivered = event._replace(id=2)
+    assert len(coalescer.coalesce([event, redelivered])) == 1
+    assert len(coalescer.coalesce([event])) == 1
+
+    coalescer.remember([event])
+    assert coalescer.coalesce([redelivered]) == []
+    assert coalescer.stats()['duplicates'] == 2
+
+
+def test_a_failed_batch_is_redelivered(dynamodb):
+    queue = DynamoIngestQueue(visibility_timeout=0, shards=2)
+    queue.put('orders', 'store', order_payload(1, hash='delivery'))
+    coalescer = EventCoalescer()
+
+    def fail(events):
+        raise RuntimeError('handler failed')
+
+    with pytest.raises(RuntimeError):
+        drain_ingest_queue(queue, fail, coalescer=coalescer, min_age=0)
+    assert queue.depth() == 1
+
+    handled = []
+    time.sleep(0.01)
+    assert drain_ingest_queue(queue, handled.extend, coalescer=coalescer, min_age=0) == 1
+    assert [event.payload['data']['id'] for event in handled] == [1]
+    assert queue.depth() == 0
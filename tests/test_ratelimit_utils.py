@@ -0,0 +1,56 @@
+"""
+How long outbound calls wait for the rate limiter inside and outside a request.
+"""
+import time
+
+import pytest
+from flask import Flask
+from werkzeug.exceptions import ServiceUnavailable
+
+from ratelimit_utils import OutboundScheduler, TokenBucket
+
+
+class FakeResponse(object):
+    def __init__(self, status_code=200, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+    def close(self):
+        pass
+
+
+def responses(*statuses, **headers):
+    replies = [FakeResponse(status, dict(headers)) for status in statuses]
+    return lambda: replies.pop(0)
+
+
+def test_an_empty_bucket_waits_or_gives_up_without_a_token():
+    bucket = TokenBucket(rate=10, capacity=1)
+    assert bucket.acquire() < 0.1
+    assert bucket.acquire(max_wait=0, overdraw=False) is None
+    assert bucket.acquire(max_wait=1) > 0
+
+
+def test_a_request_fails_fast_on_a_paused_bucket():
+    scheduler = OutboundScheduler(request_max_wait=0.1)
+    scheduler.bucket('hubspot', 'portal').pause(30)
+    with Flask(__name__).test_request_context():
+        started = time.time()
+        with pytest.raises(ServiceUnavailable):
+            scheduler.send('hubspot', 'portal', responses(200))
+    assert time.time() - started < 1
+    assert scheduler.stats()['hubspot']['failed_fast'] == 1
+
+
+def test_a_request_fails_fast_on_a_long_retry_after():
+    scheduler = OutboundScheduler(request_max_wait=1)
+    with Flask(__name__).test_request_context():
+        with pytest.raises(ServiceUnavailable):
+            scheduler.send('hubspot', 'portal', responses(429, 200, **{'Retry-After': '20'}))
+    assert scheduler.bucket('hubspot', 'portal').paused_until > time.time() + 10
+
+
+def test_a_worker_waits_out_a_429_and_retries():
+    scheduler = OutboundScheduler()
+    assert scheduler.send('hubspot', 'portal', responses(429, 200, **{'Retry-After': '0.2'})).status_code == 200
+    assert scheduler.stats()['hubspot']['rate_limited'] == 1
@@ -0,0 +1,78 @@
+"""
+The bulk subscription reconciliation, against the fake DynamoDB.
+"""
+import time
+from types import SimpleNamespace
+
+import reconcile_utils
+from dynamodb_utils import AppUser
+from reconcile_utils import SubscriptionReconciler
+
+
+def make_user(bc_store_hash, **values):
+    AppUser(bc_store_hash, 1, bc_email='owner@example.com', bc_access_token='token', bc_scope='scope',
+            **values).save()
+
+
+def subscription(bc_store_hash, status):
+    return SimpleNamespace(id='sub_' + bc_store_hash, status=status, resource_version=2, updated_at=1,
+                           meta_data={'bc_store_hash': bc_store_hash})
+
+
+def reconciler(subscriptions, toggled, ok=True):
+    def toggle(user, active):
+        toggled.append((user.bc_store_hash, active))
+        return ok
+    return SubscriptionReconciler(lambda: subscriptions, toggle, scan_segments=1)
+
+
+def test_webhooks_are_toggled_after_the_write_and_then_recorded(dynamodb):
+    make_user('cancelled', cb_subscription_id='sub_cancelled', cb_subscription_status='active',
+              bc_webhooks_registered=True)
+    make_user('renamed', cb_subscription_id='sub_renamed', cb_subscription_status='active',
+              bc_webhooks_registered=True)
+    toggled = []
+    report = reconciler([subscription('cancelled', 'cancelled'), subscription('renamed', 'active')], toggled).run()
+
+    assert toggled == [('cancelled', False)]
+    assert report['write']['items'] == 2 and report['registered']['items'] == 1
+    user = AppUser.find_by_store_hash('cancelled')
+    assert (user.cb_subscription_status, user.bc_webhooks_registered) == ('cancelled', False)
+
+
+def test_a_store_changed_since_the_scan_is_not_toggled(dynamodb, monkeypatch):
+    make_user('store', cb_subscription_id='sub_store', cb_subscription_status='active', bc_webhooks_registered=True)
+    scan = reconcile_utils.scan_app_users
+
+    def scan_then_change(*args):
+        users = scan(*args)
+        AppUser.find_by_store_hash('store').update(actions=[AppUser.cb_subscription_status.set('in_trial')])
+        return users
+
+    monkeypatch.setattr(reconcile_utils, 'scan_app_users', scan_then_change)
+    toggled = []
+    report = reconciler([subscription('store', 'cancelled')], toggled).run()
+
+    assert toggled == []
+    assert report['write']['conflicts'] == 1
+    user = AppUser.find_by_store_hash('store')
+    assert (user.cb_subscription_status, user.bc_webhooks_registered) == ('in_trial', True)
+
+
+def test_a_failed_toggle_leaves_the_webhooks_recorded_as_they_are(dynamodb):
+    make_user('store', cb_subscription_id='sub_store', cb_subscription_status='active', bc_webhooks_registered=True)
+    toggled = []
+    report = reconciler([subscription('store', 'cancelled')], toggled, ok=False).run()
+
+    assert report['webhooks']['failed'] == 1
+    user = AppUser.find_by_store_hash('store')
+    assert (user.cb_subscription_status, user.bc_webhooks_registered) == ('cancelled', True)
+
+
+def test_nothing_is_written_or_toggled_past_the_deadline(dynamodb):
+    make_user('store', cb_subscription_id='sub_store', cb_subscription_status='active', bc_webhooks_registered=True)
+    toggled = []
+    report = reconciler([subscription('store', 'cancelled')], toggled).run(deadline=time.time() - 1)
+
+    assert toggled == [] and report['write']['skipped'] == 1
+    assert AppUser.find_by_store_hash('store').cb_subscription_status == 'active'
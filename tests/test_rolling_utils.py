@@ -0,0 +1,55 @@
+"""
+RollingWindows day buckets, window totals and serialization.
+"""
+from rolling_utils import AMOUNT_SCALE, ROLLING_DAYS, RollingWindows
+
+TODAY = 20000
+
+
+def windows_of(*orders):
+    windows = RollingWindows(TODAY)
+    for order_id, day, amount in orders:
+        windows.apply(order_id, day, amount * AMOUNT_SCALE, True)
+    return windows
+
+
+def test_orders_count_towards_the_windows_covering_their_day():
+    windows = windows_of((1, TODAY, 10), (2, TODAY - 45, 20), (3, TODAY - 200, 30))
+    assert windows.window(30) == (1, 10)
+    assert windows.window(90) == (2, 30)
+    assert windows.window(365) == (3, 60)
+
+
+def test_advancing_expires_only_what_fell_out_of_each_window():
+    windows = windows_of((1, TODAY, 10), (2, TODAY - 45, 20))
+    windows.advance(TODAY + 31)
+    assert windows.window(30) == (0, 0)
+    assert windows.window(90) == (2, 30)
+    windows.advance(TODAY + ROLLING_DAYS)
+    assert windows.window(365) == (0, 0)
+    assert windows.orders == {}
+
+
+def test_reapplying_an_order_replaces_its_contribution():
+    windows = windows_of((1, TODAY, 10))
+    assert windows.apply(1, TODAY, 15 * AMOUNT_SCALE, True)
+    assert windows.window(30) == (1, 15)
+    assert windows.apply(1, TODAY, 15 * AMOUNT_SCALE, False)
+    assert windows.window(30) == (0, 0)
+    assert windows.contribution(1) is None
+
+
+def test_days_before_the_ring_are_refused():
+    windows = RollingWindows(TODAY)
+    assert not windows.apply(1, TODAY - ROLLING_DAYS, AMOUNT_SCALE, True)
+    assert windows.window(365) == (0, 0)
+
+
+def test_bytes_round_trip():
+    windows = windows_of((1, TODAY, 10), (2, TODAY - 45, 20), (3, TODAY - 364, 30))
+    copy = RollingWindows.from_bytes(windows.to_bytes())
+    assert copy.head_day == TODAY
+    assert copy.orders == windows.orders
+    assert list(copy.counts) == list(windows.counts) and list(copy.amounts) == list(windows.amounts)
+    assert [copy.window(days) for days in (30, 90, 365)] == [windows.window(days) for days in (30, 90, 365)]
+    assert copy.to_bytes() == windows.to_bytes()
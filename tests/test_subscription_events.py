@@ -0,0 +1,81 @@
+"""
+Recording, leasing and applying Chargebee subscription events, against the fake DynamoDB.
+"""
+import json
+from types import SimpleNamespace
+
+import pytest
+
+import hubmetrix_utils
+from dynamodb_utils import AppUser, SubscriptionEvent
+from subscription_utils import (claim_subscription_event, complete_subscription_event, pending_subscription_events,
+                                record_subscription_event)
+
+
+def event_body(event_id, event_type='subscription_renewed', occurred_at=1):
+    return json.dumps({'id': event_id, 'event_type': event_type, 'occurred_at': occurred_at,
+                       'content': {'subscription': {'id': 'sub'}}})
+
+
+def subscription(version, status, bc_store_hash='store'):
+    return SimpleNamespace(id='sub', resource_version=version, status=status,
+                           meta_data={'bc_store_hash': bc_store_hash} if bc_store_hash else None)
+
+
+@pytest.fixture(autouse=True)
+def empty_subscription_cache():
+    hubmetrix_utils.subscription_cache.clear()
+
+
+def test_redelivered_events_are_recorded_once(dynamodb):
+    assert record_subscription_event(event_body('ev_1')) is not None
+    assert record_subscription_event(event_body('ev_1')) is None
+    assert SubscriptionEvent.count() == 1
+
+
+def test_an_event_is_leased_to_one_worker(dynamodb):
+    record_subscription_event(event_body('ev_1'))
+    event = claim_subscription_event('ev_1')
+    assert event is not None
+    assert claim_subscription_event('ev_1') is None
+
+    complete_subscription_event(event, 'active')
+    assert claim_subscription_event('ev_1', lease_seconds=0) is None
+    assert claim_subscription_event('ev_missing') is None
+
+
+def test_expired_leases_are_claimed_again(dynamodb):
+    record_subscription_event(event_body('ev_1'))
+    assert claim_subscription_event('ev_1', lease_seconds=-1) is not None
+    assert claim_subscription_event('ev_1') is not None
+    assert SubscriptionEvent.get('ev_1').attempts == 2
+
+
+def test_pending_events_are_swept_oldest_first(dynamodb):
+    for event_id, occurred_at in (('ev_new', 20), ('ev_old', 10), ('ev_done', 5), ('ev_failing', 1)):
+        record_subscription_event(event_body(event_id, occurred_at=occurred_at))
+    complete_subscription_event(claim_subscription_event('ev_done'), 'active')
+    for _ in range(2):
+        claim_subscription_event('ev_failing', lease_seconds=-1)
+
+    assert pending_subscription_events(older_than=-1, max_attempts=2) == ['ev_old', 'ev_new']
+    assert pending_subscription_events(older_than=60) == []
+
+
+def test_older_events_do_not_replace_newer_state(dynamodb):
+    AppUser('store', 1, bc_email='owner@example.com', bc_access_token='token', bc_scope='scope',
+            cb_subscription_id='sub', cb_subscription_status='cancelled', cb_subscription_version=5).save()
+    hubmetrix_utils.cache_chargebee_subscription(subscription(5, 'cancelled'))
+
+    assert hubmetrix_utils.apply_subscription_update(subscription(3, 'active'), {}) == 'stale'
+    assert hubmetrix_utils.subscription_cache.get('sub').status == 'cancelled'
+    assert AppUser.find_by_store_hash('store').cb_subscription_status == 'cancelled'
+
+
+def test_the_cache_keeps_the_newest_version(dynamodb):
+    hubmetrix_utils.cache_chargebee_subscription(subscription(5, 'cancelled', bc_store_hash=None))
+    assert hubmetrix_utils.apply_subscription_update(subscription(3, 'active', bc_store_hash=None), {}) == 'cached'
+    assert hubmetrix_utils.subscription_cache.get('sub').status == 'cancelled'
+
+    hubmetrix_utils.cache_chargebee_subscription(subscription(6, 'active', bc_store_hash=None))
+    assert hubmetrix_utils.subscription_cache.get('sub').status == 'active'
@@ -0,0 +1,139 @@
+"""
+The incremental sync's order folding and watermarks, against the fake DynamoDB and a fake store.
+"""
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from conftest import FakeBigCommerce, make_order
+
+from dynamodb_utils import AppUser, CustomerMetrics
+from rolling_utils import epoch_day
+from sync_utils import (IncrementalSync, SyncConflict, apply_customer_orders, compute_customer_metrics, parse_bc_date,
+                        parse_watermark, watermark_string)
+
+DAY = 86400
+
+
+def make_user(bc_store_hash='store', **values):
+    AppUser(bc_store_hash, 1, bc_email='owner@example.com', bc_access_token='token', bc_scope='scope',
+            **values).save()
+    return AppUser.find_by_store_hash(bc_store_hash, consistent_read=True)
+
+
+def make_store(n_orders=10):
+    start = int(time.time()) - n_orders * DAY
+    return FakeBigCommerce(orders=[make_order(order_id, 'customer{}@example.com'.format(order_id % 3),
+                                              start + order_id * DAY, total=order_id)
+                                   for order_id in range(1, n_orders + 1)])
+
+
+def customer_orders(days_ago, cancelled=()):
+    now = int(time.time())
+    return [make_order(order_id, 'customer@example.com', now - days * DAY, total=order_id * 10,
+                       status_id=5 if order_id in cancelled else 11)
+            for order_id, days in enumerate(days_ago, 1)]
+
+
+def stored(orders):
+    return SimpleNamespace(**compute_customer_metrics(orders, epoch_day()))
+
+
+def make_sync(user, client, pushed):
+    return IncrementalSync(user, client, lambda email, properties: pushed.append(email), page_size=4)
+
+
+def test_folding_a_page_matches_a_full_recompute():
+    orders = customer_orders([300, 200, 100, 50, 20, 1])
+    assert apply_customer_orders(stored(orders[:3]), orders[3:], epoch_day()) == \
+        compute_customer_metrics(orders, epoch_day())
+
+
+def test_a_redelivered_page_is_folded_once():
+    orders = customer_orders([300, 200, 100, 50, 20, 1])
+    assert apply_customer_orders(stored(orders), orders[3:], epoch_day()) == \
+        compute_customer_metrics(orders, epoch_day())
+
+
+def test_a_cancelled_order_is_removed_in_place():
+    changed = customer_orders([300, 200, 100, 50, 20, 1], cancelled=[3])
+    metrics = apply_customer_orders(stored(customer_orders([300, 200, 100, 50, 20, 1])), [changed[2]], epoch_day())
+    assert metrics == compute_customer_metrics(changed, epoch_day())
+    assert metrics['order_count'] == 5
+
+
+def test_removing_the_first_or_last_order_needs_a_rescan():
+    orders = customer_orders([300, 200, 100])
+    first = customer_orders([300, 200, 100], cancelled=[1])[0]
+    last = customer_orders([300, 200, 100], cancelled=[3])[2]
+    assert apply_customer_orders(stored(orders), [first], epoch_day()) is None
+    assert apply_customer_orders(stored(orders), [last], epoch_day()) is None
+
+
+def test_orders_older_than_the_ring_need_a_rescan():
+    orders = customer_orders([400, 100])
+    assert apply_customer_orders(stored(orders), orders[:1], epoch_day()) is None
+    assert apply_customer_orders(None, orders[1:], epoch_day()) is None
+
+
+def test_a_sync_advances_the_watermark_page_by_page(dynamodb):
+    user = make_user()
+    client = make_store()
+    pushed = []
+    assert make_sync(user, client, pushed).run(max_pages=1)['pages'] == 1
+    first = parse_watermark(AppUser.find_by_store_hash('store', consistent_read=True).hm_last_sync_timestamp)
+    assert first == parse_bc_date(client.Orders.items[3]['date_modified'])
+
+    make_sync(AppUser.find_by_store_hash('store', consistent_read=True), client, pushed).run()
+    user.refresh()
+    assert parse_watermark(user.hm_last_sync_timestamp) == parse_bc_date(client.Orders.items[-1]['date_modified'])
+    assert CustomerMetrics.get('store', 'customer1@example.com').order_count == 4
+    assert sorted(set(pushed)) == ['customer{}@example.com'.format(n) for n in range(3)]
+
+
+def test_a_sync_past_its_deadline_stops_after_one_page(dynamodb):
+    user = make_user()
+    assert make_sync(user, make_store(), []).run(deadline=time.time() - 1)['pages'] == 1
+
+
+def test_a_watermark_moved_by_another_run_is_a_conflict(dynamodb):
+    user = make_user()
+    client = make_store()
+    stale = AppUser.find_by_store_hash('store', consistent_read=True)
+    make_sync(user, client, []).run(max_pages=1)
+    watermark = AppUser.find_by_store_hash('store', consistent_read=True).hm_last_sync_timestamp
+
+    with pytest.raises(SyncConflict):
+        make_sync(stale, client, []).run()
+    assert AppUser.find_by_store_hash('store', consistent_read=True).hm_last_sync_timestamp == watermark
+
+
+def test_two_runs_from_the_same_watermark_advance_it_once(dynamodb):
+    make_user(hm_last_sync_timestamp=watermark_string(0))
+    client = make_store()
+    first = AppUser.find_by_store_hash('store', consistent_read=True)
+    second = AppUser.find_by_store_hash('store', consistent_read=True)
+    make_sync(first, client, []).run(max_pages=1)
+
+    with pytest.raises(SyncConflict):
+        make_sync(second, client, []).run(max_pages=1)
+    assert AppUser.find_by_store_hash('store', consistent_read=True).hm_last_sync_timestamp == \
+        first.hm_last_sync_timestamp
+
+
+def test_metrics_written_since_they_were_read_are_recomputed_not_overwritten(dynamodb):
+    user = make_user()
+    client = make_store()
+    make_sync(user, client, []).run()
+    pushed = []
+
+    def push(email, properties):
+        if not pushed:
+            CustomerMetrics.get('store', email).update(actions=[CustomerMetrics.synced_at.set(1)])
+        pushed.append(email)
+
+    sync = IncrementalSync(user, client, push)
+    sync.sync_metrics([('customer1@example.com', dict(compute_customer_metrics([]), order_count=99))])
+    assert CustomerMetrics.get('store', 'customer1@example.com').order_count == 4
+    assert sync.stats()['rescanned'] == 1
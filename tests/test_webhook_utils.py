@@ -0,0 +1,73 @@
+"""
+Webhook reconciliation against a stand-in BigCommerce client.
+"""
+from types import SimpleNamespace
+
+from bigcommerce.exception import ServerException
+
+from webhook_utils import reconcile_bc_webhooks, webhooks_ok
+
+DESIRED = [('store/order/created', 'https://app/bc-ingest-orders')]
+
+
+class Hook(SimpleNamespace):
+    def update(self, **values):
+        self.__dict__.update(values)
+
+    def delete(self):
+        self.deleted = True
+
+
+class Webhooks(object):
+    def __init__(self, hooks=None, error=None):
+        self.hooks = hooks or []
+        self.error = error
+        self.created = []
+
+    def all(self):
+        if self.error:
+            raise self.error
+        return self.hooks
+
+    def create(self, **values):
+        hook = Hook(id=len(self.created) + 100, **values)
+        self.created.append(hook)
+        return hook
+
+
+def test_listing_errors_fail_the_reconcile():
+    client = SimpleNamespace(Webhooks=Webhooks(error=ServerException('Service unavailable', None)))
+    outcomes = reconcile_bc_webhooks(client, DESIRED, active=True)
+    assert [(outcome.action, outcome.ok) for outcome in outcomes] == [('list', False)]
+    assert not webhooks_ok(outcomes)
+    assert client.Webhooks.created == []
+
+
+def test_missing_hooks_are_created_and_extra_ones_deleted():
+    extra = Hook(id=1, scope='store/cart/created', destination='https://app/other', is_active=True)
+    client = SimpleNamespace(Webhooks=Webhooks(hooks=[extra]))
+    outcomes = reconcile_bc_webhooks(client, DESIRED, active=True)
+    assert sorted(outcome.action for outcome in outcomes) == ['create', 'delete']
+    assert webhooks_ok(outcomes)
+    assert extra.deleted
+
+
+def test_deactivating_leaves_matching_hooks_inactive():
+    hook = Hook(id=1, scope=DESIRED[0][0], destination=DESIRED[0][1], is_active=True)
+    client = SimpleNamespace(Webhooks=Webhooks(hooks=[hook]))
+    outcomes = reconcile_bc_webhooks(client, DESIRED, active=False)
+    assert [outcome.action for outcome in outcomes] == ['deactivate']
+    assert hook.is_active is False
+
+
+def test_hooks_without_the_token_header_are_updated():
+    hook = Hook(id=1, scope=DESIRED[0][0], destination=DESIRED[0][1], is_active=True, headers=None)
+    client = SimpleNamespace(Webhooks=Webhooks(hooks=[hook]))
+    headers = {'X-Hubmetrix-Token': 'token'}
+    assert [outcome.action for outcome in reconcile_bc_webhooks(client, DESIRED, headers=headers)] == ['update']
+    assert hook.headers == headers
+    assert [outcome.action for outcome in reconcile_bc_webhooks(client, DESIRED, headers=headers)] == ['noop']
+
+    client = SimpleNamespace(Webhooks=Webhooks())
+    reconcile_bc_webhooks(client, DESIRED, headers=headers)
+    assert client.Webhooks.created[0].headers == headers
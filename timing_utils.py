@@ -0,0 +1,248 @@
+import bisect
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g, request
+
+__all__ = ['LatencyHistogram', 'RequestTimings', 'TimedAdapter', 'bind_request_timings', 'current_request_timings',
+           'install_dynamodb_timing', 'install_request_timing', 'timed', 'upstream_timings']
+
+timing_logger = logging.getLogger('hubmetrix.timing')
+
+TIMING_LOG_ENABLED = os.environ.get('TIMING_LOG_ENABLED', '1') == '1'
+
+# Upper bounds in milliseconds; one more bucket counts everything slower.
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+_local = threading.local()
+
+
+class LatencyHistogram(object):
+    """
+    Call count, total and bucketed latency of one upstream. Not thread safe on its
+    own; owners lock around it.
+    """
+    def __init__(self, buckets=LATENCY_BUCKETS_MS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.calls = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def observe(self, ms, error=False):
+        self.counts[bisect.bisect_left(self.buckets, ms)] += 1
+        self.calls += 1
+        self.errors += int(error)
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+
+    def percentile(self, fraction):
+        """
+        The upper bound of the bucket holding the given fraction of calls; calls
+        slower than the last bucket report the slowest call seen.
+        """
+        rank = fraction * self.calls
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return self.buckets[index] if index < len(self.buckets) else self.max_ms
+        return 0
+
+    def as_dict(self):
+        buckets = dict(('le_{}'.format(bound), count) for bound, count in zip(self.buckets, self.counts) if count)
+        if self.counts[-1]:
+            buckets['gt_{}'.format(self.buckets[-1])] = self.counts[-1]
+        return dict(calls=self.calls, errors=self.errors, ms=round(self.total_ms, 1), max_ms=round(self.max_ms, 1),
+                    p50_ms=self.percentile(0.5), p95_ms=self.percentile(0.95), p99_ms=self.percentile(0.99),
+                    histogram=buckets)
+
+
+class UpstreamTimings(object):
+    """
+    Thread-safe latency histograms keyed by upstream (dynamodb, chargebee,
+    bigcommerce, hubspot).
+    """
+    def __init__(self):
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def record(self, upstream, ms, error=False):
+        with self._lock:
+            histogram = self._histograms.get(upstream)
+            if histogram is None:
+                histogram = self._histograms[upstream] = LatencyHistogram()
+            histogram.observe(ms, error)
+
+    def calls(self):
+        with self._lock:
+            return sum(histogram.calls for histogram in self._histograms.values())
+
+    def stats(self):
+        with self._lock:
+            return dict((upstream, histogram.as_dict()) for upstream, histogram in sorted(self._histograms.items()))
+
+    def items(self):
+        with self._lock:
+            return [(upstream, histogram.calls, histogram.total_ms)
+                    for upstream, histogram in sorted(self._histograms.items())]
+
+
+class RequestTimings(UpstreamTimings):
+    """
+    The upstream calls made while serving one request, including calls from
+    steps it runs on other threads (see bind_request_timings).
+    """
+    def __init__(self):
+        super(RequestTimings, self).__init__()
+        self.started = time.time()
+
+    def server_timing(self, total_ms=None):
+        """
+        A Server-Timing header value with each upstream's summed call time and the
+        request total, e.g. dynamodb;dur=12.4;desc="3 calls", total;dur=80.2
+        """
+        metrics = ['{};dur={:.1f};desc="{} call{}"'.format(upstream, ms, calls, '' if calls == 1 else 's')
+                   for upstream, calls, ms in self.items()]
+        if total_ms is None:
+            total_ms = (time.time() - self.started) * 1000
+        metrics.append('total;dur={:.1f}'.format(total_ms))
+        return ', '.join(metrics)
+
+
+upstream_timings = UpstreamTimings()
+
+
+def current_request_timings():
+    return getattr(_local, 'timings', None)
+
+
+def bind_request_timings(func, timings=None):
+    """
+    Wraps func so calls it makes on another thread are recorded against the
+    current request's timings (or the given ones).
+    """
+    timings = timings or current_request_timings()
+    if timings is None:
+        return func
+
+    @functools.wraps(func)
+    def bound(*args, **kwargs):
+        previous = current_request_timings()
+        _local.timings = timings
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.timings = previous
+
+    return bound
+
+
+def _record(upstream, ms, error):
+    upstream_timings.record(upstream, ms, error)
+    timings = current_request_timings()
+    if timings is not None:
+        timings.record(upstream, ms, error)
+
+
+@contextmanager
+def timed(upstream):
+    """
+    Records the duration of the enclosed call for upstream, as an error when it raises.
+    """
+    started = time.perf_counter()
+    error = True
+    try:
+        yield
+        error = False
+    finally:
+        _record(upstream, (time.perf_counter() - started) * 1000, error)
+
+
+class TimedAdapter(object):
+    """
+    Wraps a requests transport adapter and records every request's latency,
+    including time spent waiting for a rate limit token. Responses of 429 or 5xx
+    count as errors.
+    """
+    def __init__(self, adapter, upstream):
+        self.adapter = adapter
+        self.upstream = upstream
+
+    def send(self, request, **kwargs):
+        started = time.perf_counter()
+        response = None
+        try:
+            response = self.adapter.send(request, **kwargs)
+            return response
+        finally:
+            error = response is None or response.status_code == 429 or response.status_code >= 500
+            _record(self.upstream, (time.perf_counter() - started) * 1000, error)
+
+    def close(self):
+        self.adapter.close()
+
+    def __getattr__(self, name):
+        return getattr(self.adapter, name)
+
+
+_dynamodb_installed = []
+
+
+def install_dynamodb_timing():
+    """
+    Times every DynamoDB API call PynamoDB makes, including each page of a query
+    or scan, by wrapping Connection.dispatch once per process.
+    """
+    if _dynamodb_installed:
+        return
+    from pynamodb.connection.base import Connection
+
+    dispatch = Connection.dispatch
+
+    @functools.wraps(dispatch)
+    def timed_dispatch(self, operation_name, operation_kwargs):
+        with timed('dynamodb'):
+            return dispatch(self, operation_name, operation_kwargs)
+
+    Connection.dispatch = timed_dispatch
+    _dynamodb_installed.append(dispatch)
+
+
+def install_request_timing(app):
+    """
+    Adds each request's upstream timings to its response as a Server-Timing header and
+    logs them. Install before after_request hooks that make upstream calls.
+    """
+    @app.before_request
+    def start_request_timing():
+        g.request_timings = _local.timings = RequestTimings()
+
+    @app.after_request
+    def finish_request_timing(response):
+        timings = g.pop('request_timings', None)
+        if timings is None:
+            return response
+        total_ms = (time.time() - timings.started) * 1000
+        response.headers['Server-Timing'] = timings.server_timing(total_ms)
+        if TIMING_LOG_ENABLED:
+            timing_logger.info(json.dumps(dict(type='request_timing',
+                                               method=request.method,
+                                               route=request.url_rule.rule if request.url_rule else request.path,
+                                               status=response.status_code,
+                                               ms=round(total_ms, 1),
+                                               upstream_calls=timings.calls(),
+                                               upstreams=timings.stats()), sort_keys=True))
+        return response
+
+    @app.teardown_request
+    def clear_request_timing(exc=None):
+        _local.timings = None
+
+    return app
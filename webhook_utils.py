@@ -0,0 +1,111 @@
+import hashlib
+import hmac
+import os
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.exceptions import BadGateway
+
+from import_utils import lazy_import
+from timing_utils import bind_request_timings
+
+__all__ = ['BC_WEBHOOK_TOKEN_HEADER', 'HookOutcome', 'WEBHOOK_SCOPES', 'bc_webhook_headers', 'bc_webhook_token',
+           'desired_bc_webhooks', 'get_existing_webhooks', 'plan_webhook_changes', 'reconcile_bc_webhooks',
+           'webhooks_ok']
+
+WEBHOOK_MAX_WORKERS = int(os.environ.get('WEBHOOK_MAX_WORKERS', 4))
+
+WEBHOOK_SCOPES = (('store/order/created', '/dev/bc-ingest-orders'),
+                  ('store/order/statusUpdated', '/dev/bc-ingest-orders'),
+                  ('store/customer/updated', '/dev/bc-ingest-customers'))
+
+# BigCommerce sends a hook's headers with every delivery; the ingest routes check
+# this one against the store's token.
+BC_WEBHOOK_TOKEN_HEADER = 'X-Hubmetrix-Token'
+
+HookOutcome = namedtuple('HookOutcome', ['scope', 'destination', 'hook_id', 'action', 'ok', 'error'])
+
+bc_exceptions = lazy_import('bigcommerce.exception')
+
+_executor = ThreadPoolExecutor(max_workers=WEBHOOK_MAX_WORKERS)
+
+
+def desired_bc_webhooks(config):
+    return [(scope, config['APP_BACKEND_URL'] + path) for scope, path in WEBHOOK_SCOPES]
+
+
+def bc_webhook_token(bc_store_hash, secret):
+    return hmac.new(secret.encode('utf-8'), bc_store_hash.encode('utf-8'), hashlib.sha256).hexdigest()
+
+
+def bc_webhook_headers(bc_store_hash, secret):
+    return {BC_WEBHOOK_TOKEN_HEADER: bc_webhook_token(bc_store_hash, secret)}
+
+
+def get_existing_webhooks(client):
+    return client.Webhooks.all() or []
+
+
+def plan_webhook_changes(existing, desired, active=True, headers=None):
+    """
+    Diffs a store's hooks against the desired (scope, destination) set. Returns (action,
+    scope, destination, hook) tuples, 'noop' for hooks that already match.
+    """
+    by_key = {}
+    changes = []
+    for hook in existing:
+        key = (hook.scope, hook.destination)
+        if key in desired and key not in by_key:
+            by_key[key] = hook
+        else:
+            changes.append(('delete', hook.scope, hook.destination, hook))
+
+    for scope, destination in desired:
+        hook = by_key.get((scope, destination))
+        if hook is None:
+            changes.append(('create' if active else 'noop', scope, destination, None))
+        elif bool(hook.is_active) != active:
+            changes.append(('activate' if active else 'deactivate', scope, destination, hook))
+        elif headers is not None and (getattr(hook, 'headers', None) or {}) != headers:
+            changes.append(('update', scope, destination, hook))
+        else:
+            changes.append(('noop', scope, destination, hook))
+    return changes
+
+
+def reconcile_bc_webhooks(client, desired, active=True, existing=None, headers=None):
+    """
+    Brings a store's webhooks in line with the desired set, concurrently. Returns one
+    outcome per hook, or a single failed 'list' outcome when the hooks can't be listed.
+    """
+    if existing is None:
+        try:
+            existing = get_existing_webhooks(client)
+        except (bc_exceptions.HttpException, BadGateway) as e:
+            return [HookOutcome(None, None, None, 'list', False, str(e))]
+    changes = plan_webhook_changes(existing, desired, active, headers)
+    apply_change = bind_request_timings(_apply_change)
+    futures = [_executor.submit(apply_change, client, change, headers) for change in changes]
+    return [future.result() for future in futures]
+
+
+def webhooks_ok(outcomes):
+    return all(outcome.ok for outcome in outcomes)
+
+
+def _apply_change(client, change, headers=None):
+    action, scope, destination, hook = change
+    hook_id = hook.id if hook is not None else None
+    extra = {'headers': headers} if headers is not None else {}
+    try:
+        if action == 'create':
+            hook_id = client.Webhooks.create(scope=scope, destination=destination, is_active=True, **extra).id
+        elif action in ('activate', 'deactivate'):
+            hook.update(is_active=action == 'activate', **extra)
+        elif action == 'update':
+            hook.update(**extra)
+        elif action == 'delete':
+            hook.delete()
+    except (bc_exceptions.HttpException, BadGateway) as e:
+        return HookOutcome(scope, destination, hook_id, action, False, str(e))
+    return HookOutcome(scope, destination, hook_id, action, True, None)